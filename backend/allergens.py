@@ -0,0 +1,162 @@
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+# Canonical allergen -> ingredients that contain or are derived from it
+ALLERGEN_TAXONOMY = {
+    "dairy": [
+        "milk", "butter", "buttermilk", "cheese", "cream", "sour cream", "whey", "casein", "caseinate",
+        "lactose", "yogurt", "yoghurt", "ghee", "kefir", "curd", "custard", "parmesan", "mozzarella",
+        "cheddar", "feta", "ricotta", "mascarpone", "brie", "gouda", "paneer", "half-and-half", "creme fraiche"
+    ],
+    "eggs": ["egg", "egg white", "egg yolk", "mayonnaise", "mayo", "meringue", "albumin", "aioli"],
+    "peanuts": ["peanut", "peanut butter", "groundnut", "peanut oil"],
+    "tree nuts": [
+        "almond", "cashew", "walnut", "pecan", "pistachio", "hazelnut", "macadamia", "brazil nut",
+        "pine nut", "praline", "marzipan", "nutella", "almond milk", "almond flour"
+    ],
+    "gluten": [
+        "wheat", "flour", "bread", "breadcrumb", "panko", "pasta", "spaghetti", "noodle", "couscous",
+        "barley", "rye", "seitan", "semolina", "spelt", "bulgur", "farro", "malt", "soy sauce",
+        "tortilla", "pita", "cracker", "crouton", "orzo", "bagel"
+    ],
+    "soy": ["soy", "soya", "tofu", "tempeh", "edamame", "miso", "soy sauce", "tamari", "soy milk"],
+    "fish": [
+        "fish", "salmon", "tuna", "cod", "tilapia", "anchovy", "sardine", "halibut", "trout",
+        "mackerel", "haddock", "bass", "fish sauce", "worcestershire"
+    ],
+    "shellfish": [
+        "shellfish", "shrimp", "prawn", "crab", "lobster", "clam", "mussel", "oyster", "scallop",
+        "crayfish", "langoustine"
+    ],
+    "sesame": ["sesame", "tahini", "sesame oil", "halva"],
+}
+
+# User-entered names that mean one of the canonical allergens
+ALLERGEN_ALIASES = {
+    "milk": "dairy", "lactose": "dairy", "lactose intolerance": "dairy", "cheese": "dairy",
+    "egg": "eggs", "peanut": "peanuts", "nuts": "tree nuts", "tree nut": "tree nuts",
+    "wheat": "gluten", "celiac": "gluten", "coeliac": "gluten", "soya": "soy",
+    "seafood": "shellfish", "shrimp": "shellfish", "sesame seeds": "sesame",
+}
+
+# Phrases that contain an allergen term without containing the allergen
+SAFE_PHRASES = {
+    "milk": ["coconut milk", "almond milk", "oat milk", "soy milk", "rice milk", "cashew milk"],
+    "butter": ["peanut butter", "almond butter", "cashew butter", "nut butter", "cocoa butter", "apple butter", "sunflower butter"],
+    "cream": ["cream of tartar", "coconut cream"],
+    "cheese": ["vegan cheese"],
+    "yogurt": ["coconut yogurt", "soy yogurt"],
+    "flour": ["almond flour", "coconut flour", "rice flour", "chickpea flour", "oat flour", "corn flour", "cornflour"],
+    "noodle": ["rice noodle"],
+    "tortilla": ["corn tortilla"],
+}
+
+def canonical_allergen(restriction: str) -> str:
+    key = restriction.strip().lower()
+    return ALLERGEN_ALIASES.get(key, key)
+
+class AllergenMatcher:
+    """One compiled regex over every term implied by a user's restrictions.
+
+    Known allergens expand through the taxonomy; anything else is matched as a
+    literal term. Matching is whole-word, case-insensitive and allows a plural
+    "s"/"es", so "eggs" matches egg and "butternut squash" does not match butter.
+    """
+
+    def __init__(self, restrictions: Iterable[str]):
+        self.term_allergen: Dict[str, str] = {}
+        for restriction in restrictions:
+            if not restriction or not restriction.strip():
+                continue
+            allergen = canonical_allergen(restriction)
+            terms = ALLERGEN_TAXONOMY.get(allergen, [allergen])
+            for term in terms:
+                self.term_allergen.setdefault(term.lower(), allergen)
+
+        if self.term_allergen:
+            # Longest first so multi-word terms win over their prefixes
+            alternation = "|".join(re.escape(t) for t in sorted(self.term_allergen, key=len, reverse=True))
+            self.pattern: Optional[re.Pattern] = re.compile(rf"\b({alternation})(?:e?s)?\b", re.IGNORECASE)
+        else:
+            self.pattern = None
+
+    def _is_safe(self, text: str, start: int, term: str) -> bool:
+        for phrase in SAFE_PHRASES.get(term, []):
+            offset = phrase.find(term)
+            begin = start - offset
+            if begin >= 0 and text[begin:begin + len(phrase)].lower() == phrase:
+                return True
+        return False
+
+    def find(self, text: str) -> List[Tuple[str, str, int]]:
+        """(allergen, matched term, offset) for every hit in the text"""
+        if self.pattern is None or not text:
+            return []
+        hits = []
+        for match in self.pattern.finditer(text):
+            term = match.group(1).lower()
+            if self._is_safe(text, match.start(), term):
+                continue
+            hits.append((self.term_allergen[term], term, match.start()))
+        return hits
+
+    def meal_violations(self, meal: dict) -> List[str]:
+        """Allergens present in a stored meal (name or ingredients)"""
+        texts = [meal.get("name") or ""]
+        for ingredient in meal.get("ingredients") or []:
+            texts.append(ingredient.get("name", "") if isinstance(ingredient, dict) else str(ingredient))
+        return sorted({allergen for allergen, _, _ in self.find("\n".join(texts))})
+
+@lru_cache(maxsize=256)
+def _cached_matcher(restrictions: FrozenSet[str]) -> AllergenMatcher:
+    return AllergenMatcher(restrictions)
+
+def get_matcher(restrictions: Iterable[str]) -> AllergenMatcher:
+    """Matchers are cached per restriction set so the regex compiles once per user profile"""
+    return _cached_matcher(frozenset(r.strip().lower() for r in restrictions if r and r.strip()))
+
+def _ingredient_text(ingredient) -> str:
+    if isinstance(ingredient, dict):
+        return ingredient.get("name", "")
+    return str(ingredient)
+
+def screen_plan(
+    plan_days: List[dict],
+    matcher: AllergenMatcher,
+    targets: Optional[Dict[str, List[str]]] = None
+) -> Dict[Tuple[str, str], List[dict]]:
+    """Scan every meal name and ingredient of the plan in a single regex pass.
+
+    All slot texts are joined into one buffer; each hit is mapped back to its
+    slot by offset. Returns {(day, meal_type): [{allergen, term, ingredient}]}
+    for the offending slots only, optionally limited to `targets`.
+    """
+    segments: List[Tuple[Tuple[str, str], str]] = []
+    for day in plan_days:
+        day_name = day.get("day")
+        for meal_type, meal_name in (day.get("meals") or {}).items():
+            if targets is not None and meal_type not in targets.get(day_name, []):
+                continue
+            if meal_name:
+                segments.append(((day_name, meal_type), meal_name))
+            recipe = (day.get("recipes") or {}).get(meal_type) or {}
+            for ingredient in recipe.get("ingredients") or []:
+                segments.append(((day_name, meal_type), _ingredient_text(ingredient)))
+
+    if not segments or matcher.pattern is None:
+        return {}
+
+    starts, pos = [], 0
+    for _, text in segments:
+        starts.append(pos)
+        pos += len(text) + 1
+    buffer = "\n".join(text for _, text in segments)
+
+    violations: Dict[Tuple[str, str], List[dict]] = {}
+    for allergen, term, offset in matcher.find(buffer):
+        idx = bisect_right(starts, offset) - 1
+        slot, text = segments[idx]
+        violations.setdefault(slot, []).append({"allergen": allergen, "term": term, "ingredient": text})
+    return violations
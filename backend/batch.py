@@ -0,0 +1,240 @@
+import json
+import logging
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import openai
+
+try:
+    from . import llm
+except ImportError:
+    import llm
+
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+# Provider cap on requests per batch file
+MAX_BATCH_REQUESTS = 50000
+
+# Batch states after which the provider will not produce more output
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+@dataclass
+class BatchRequest:
+    custom_id: str
+    prompt: str
+    system_message: Optional[str] = None
+    response_format: Optional[Dict[str, Any]] = None
+
+@dataclass
+class BatchStatus:
+    status: str
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+    counts: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def done(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+@dataclass
+class BatchResult:
+    custom_id: str
+    content: Optional[str] = None
+    error: Optional[str] = None
+
+def chat_body(model: str, request: BatchRequest) -> Dict[str, Any]:
+    """Same request body the interactive OpenAI adapter sends"""
+    messages = []
+    if request.system_message:
+        messages.append({"role": "system", "content": request.system_message})
+    messages.append({"role": "user", "content": request.prompt})
+    body: Dict[str, Any] = {"model": model, "messages": messages, "temperature": 0.7}
+    if request.response_format:
+        body["response_format"] = llm.openai_response_format(request.response_format)
+    return body
+
+def to_jsonl(model: str, requests: List[BatchRequest]) -> bytes:
+    """One chat completion request per line, keyed by custom_id"""
+    lines = [
+        json.dumps({
+            "custom_id": request.custom_id,
+            "method": "POST",
+            "url": CHAT_COMPLETIONS_ENDPOINT,
+            "body": chat_body(model, request),
+        })
+        for request in requests
+    ]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+def parse_output(jsonl: str) -> Dict[str, BatchResult]:
+    """Map custom_id to the completion text or error from batch output/error files"""
+    results: Dict[str, BatchResult] = {}
+    for line in jsonl.splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            logging.error(f"Skipping unreadable batch output line: {line[:200]}")
+            continue
+        custom_id = record.get("custom_id")
+        if not custom_id:
+            continue
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+        if record.get("error") or response.get("status_code", 200) >= 400:
+            error = record.get("error") or body.get("error") or f"HTTP {response.get('status_code')}"
+            results[custom_id] = BatchResult(custom_id, error=json.dumps(error) if isinstance(error, dict) else str(error))
+            continue
+        try:
+            results[custom_id] = BatchResult(custom_id, content=body["choices"][0]["message"]["content"])
+        except (KeyError, IndexError, TypeError):
+            results[custom_id] = BatchResult(custom_id, error="Malformed batch response")
+    return results
+
+# ============== Batch Clients ==============
+
+class OpenAIBatchClient:
+    """Files + Batches API: upload the JSONL, create the batch, poll, download output"""
+    name = "openai"
+
+    def _client(self, target: llm.LLMTarget, timeout: float) -> openai.AsyncOpenAI:
+        return openai.AsyncOpenAI(api_key=target.api_key, timeout=timeout, max_retries=2)
+
+    async def submit(
+        self,
+        target: llm.LLMTarget,
+        requests: List[BatchRequest],
+        metadata: Optional[Dict[str, str]] = None,
+        timeout: float = llm.DEFAULT_TIMEOUT_SECONDS
+    ) -> str:
+        client = self._client(target, timeout)
+        try:
+            input_file = await client.files.create(
+                file=("batch.jsonl", to_jsonl(target.model, requests)),
+                purpose="batch"
+            )
+            batch = await client.batches.create(
+                input_file_id=input_file.id,
+                endpoint=CHAT_COMPLETIONS_ENDPOINT,
+                completion_window=COMPLETION_WINDOW,
+                metadata=metadata or {}
+            )
+        except openai.APIConnectionError as e:
+            raise llm.LLMProviderError(self.name, str(e), retryable=True)
+        except openai.APIStatusError as e:
+            raise llm.LLMProviderError(self.name, str(e), retryable=llm._is_retryable_status(e.status_code), status_code=e.status_code)
+        finally:
+            await client.close()
+        return batch.id
+
+    async def retrieve(self, target: llm.LLMTarget, batch_id: str, timeout: float = llm.DEFAULT_TIMEOUT_SECONDS) -> BatchStatus:
+        client = self._client(target, timeout)
+        try:
+            batch = await client.batches.retrieve(batch_id)
+        except openai.APIConnectionError as e:
+            raise llm.LLMProviderError(self.name, str(e), retryable=True)
+        except openai.APIStatusError as e:
+            raise llm.LLMProviderError(self.name, str(e), retryable=llm._is_retryable_status(e.status_code), status_code=e.status_code)
+        finally:
+            await client.close()
+        counts = batch.request_counts
+        return BatchStatus(
+            status=batch.status,
+            output_file_id=batch.output_file_id,
+            error_file_id=batch.error_file_id,
+            counts={"total": counts.total, "completed": counts.completed, "failed": counts.failed} if counts else {}
+        )
+
+    async def results(self, target: llm.LLMTarget, status: BatchStatus, timeout: float = llm.DEFAULT_TIMEOUT_SECONDS) -> Dict[str, BatchResult]:
+        client = self._client(target, timeout)
+        try:
+            chunks = []
+            for file_id in (status.output_file_id, status.error_file_id):
+                if file_id:
+                    content = await client.files.content(file_id)
+                    chunks.append(content.text)
+        except openai.APIConnectionError as e:
+            raise llm.LLMProviderError(self.name, str(e), retryable=True)
+        except openai.APIStatusError as e:
+            raise llm.LLMProviderError(self.name, str(e), retryable=llm._is_retryable_status(e.status_code), status_code=e.status_code)
+        finally:
+            await client.close()
+        return parse_output("\n".join(chunks))
+
+class FakeBatchClient:
+    """In-process batch backend for development and tests.
+
+    Accepts the same JSONL as the real API, reports the batch in progress for
+    `polls_until_done` polls and then answers every line with the mock provider,
+    in the provider's output file format.
+    """
+    name = "mock"
+
+    def __init__(self, polls_until_done: int = 1):
+        self.polls_until_done = polls_until_done
+        self._batches: Dict[str, Dict[str, Any]] = {}
+        self._files: Dict[str, str] = {}
+        self._provider = llm.MockProvider()
+
+    async def submit(
+        self,
+        target: llm.LLMTarget,
+        requests: List[BatchRequest],
+        metadata: Optional[Dict[str, str]] = None,
+        timeout: float = llm.DEFAULT_TIMEOUT_SECONDS
+    ) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self._batches[batch_id] = {"input": to_jsonl(target.model, requests).decode("utf-8"), "polls": 0, "output_file_id": None}
+        return batch_id
+
+    async def retrieve(self, target: llm.LLMTarget, batch_id: str, timeout: float = llm.DEFAULT_TIMEOUT_SECONDS) -> BatchStatus:
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            raise llm.LLMProviderError(self.name, f"No such batch {batch_id}", status_code=404)
+        total = batch["input"].count("\n")
+        batch["polls"] += 1
+        if batch["polls"] < self.polls_until_done:
+            return BatchStatus(status="in_progress", counts={"total": total, "completed": 0, "failed": 0})
+
+        if batch["output_file_id"] is None:
+            batch["output_file_id"] = f"file_{uuid.uuid4().hex}"
+            self._files[batch["output_file_id"]] = await self._answer(target, batch["input"])
+        return BatchStatus(
+            status="completed",
+            output_file_id=batch["output_file_id"],
+            counts={"total": total, "completed": total, "failed": 0}
+        )
+
+    async def _answer(self, target: llm.LLMTarget, jsonl: str) -> str:
+        lines = []
+        for line in jsonl.splitlines():
+            request = json.loads(line)
+            body = request["body"]
+            system = next((m["content"] for m in body["messages"] if m["role"] == "system"), None)
+            prompt = next(m["content"] for m in body["messages"] if m["role"] == "user")
+            response_format = body.get("response_format", {}).get("json_schema")
+            content = await self._provider.complete(target, prompt, system, 0, response_format)
+            lines.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]}
+                },
+                "error": None,
+            }))
+        return "\n".join(lines)
+
+    async def results(self, target: llm.LLMTarget, status: BatchStatus, timeout: float = llm.DEFAULT_TIMEOUT_SECONDS) -> Dict[str, BatchResult]:
+        return parse_output(self._files.get(status.output_file_id or "", ""))
+
+# Providers with a batch interface; jobs for any other provider use the interactive queue
+BATCH_CLIENTS = {
+    "openai": OpenAIBatchClient(),
+    "mock": FakeBatchClient(),
+}
+
+def supports_batch(provider: Optional[str]) -> bool:
+    return provider in BATCH_CLIENTS
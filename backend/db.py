@@ -2,8 +2,8 @@ import asyncpg
 import os
 import json
 import uuid
-from datetime import datetime, timezone
-from typing import Optional, List, Dict, Any
+from datetime import date, datetime, timezone
+from typing import Optional, List, Dict, Any, Tuple, Callable, Awaitable
 
 pool: Optional[asyncpg.Pool] = None
 
@@ -17,11 +17,137 @@ async def close_pool():
     if pool:
         await pool.close()
 
+# Additive DDL for tables and columns introduced after the initial schema.
+# Every statement must be idempotent since it runs on each startup.
+SCHEMA_STATEMENTS = [
+    "ALTER TABLE shopping_lists ADD COLUMN IF NOT EXISTS contributions JSONB",
+    "ALTER TABLE shopping_lists ADD COLUMN IF NOT EXISTS totals JSONB",
+    "ALTER TABLE shopping_lists ADD COLUMN IF NOT EXISTS subtract_pantry BOOLEAN DEFAULT TRUE",
+    "ALTER TABLE shopping_lists ADD COLUMN IF NOT EXISTS updated_at TEXT",
+    "CREATE INDEX IF NOT EXISTS idx_shopping_lists_meal_plan ON shopping_lists (meal_plan_id)",
+    """CREATE TABLE IF NOT EXISTS ai_jobs (
+           id TEXT PRIMARY KEY,
+           user_id TEXT NOT NULL,
+           job_type TEXT NOT NULL,
+           payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+           status TEXT NOT NULL DEFAULT 'queued',
+           priority INTEGER NOT NULL DEFAULT 0,
+           attempts INTEGER NOT NULL DEFAULT 0,
+           max_attempts INTEGER NOT NULL DEFAULT 3,
+           result JSONB,
+           error TEXT,
+           run_after TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+           locked_at TIMESTAMPTZ,
+           created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+           updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+       )""",
+    "CREATE INDEX IF NOT EXISTS idx_ai_jobs_queued ON ai_jobs (priority DESC, created_at) WHERE status = 'queued'",
+    "CREATE INDEX IF NOT EXISTS idx_ai_jobs_user_status ON ai_jobs (user_id, status)",
+    "ALTER TABLE ai_configs ADD COLUMN IF NOT EXISTS fallback_provider TEXT",
+    "ALTER TABLE ai_configs ADD COLUMN IF NOT EXISTS fallback_model TEXT",
+    "ALTER TABLE ai_configs ADD COLUMN IF NOT EXISTS fallback_api_key TEXT",
+    "ALTER TABLE meal_plans ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'active'",
+    "ALTER TABLE meal_plans ADD COLUMN IF NOT EXISTS source_plan_id TEXT",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_meal_plans_source_plan ON meal_plans (source_plan_id) WHERE source_plan_id IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_meal_plans_active_end ON meal_plans (end_date) WHERE status = 'active'",
+    """CREATE TABLE IF NOT EXISTS ai_batches (
+           id TEXT PRIMARY KEY,
+           provider TEXT NOT NULL,
+           model TEXT NOT NULL,
+           key_user_id TEXT NOT NULL,
+           provider_batch_id TEXT,
+           status TEXT NOT NULL DEFAULT 'submitted',
+           request_count INTEGER NOT NULL DEFAULT 0,
+           succeeded INTEGER NOT NULL DEFAULT 0,
+           failed INTEGER NOT NULL DEFAULT 0,
+           error TEXT,
+           created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+           completed_at TIMESTAMPTZ
+       )""",
+    "CREATE INDEX IF NOT EXISTS idx_ai_batches_open ON ai_batches (created_at) WHERE completed_at IS NULL",
+    "ALTER TABLE ai_jobs ADD COLUMN IF NOT EXISTS batch_id TEXT",
+    "CREATE INDEX IF NOT EXISTS idx_ai_jobs_batch ON ai_jobs (batch_id) WHERE batch_id IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_ai_jobs_batch_pending ON ai_jobs (created_at) WHERE status = 'batch_pending'",
+    """CREATE TABLE IF NOT EXISTS stripe_events (
+           id TEXT PRIMARY KEY,
+           event_type TEXT NOT NULL,
+           customer_id TEXT,
+           payload JSONB NOT NULL,
+           status TEXT NOT NULL DEFAULT 'pending',
+           attempts INTEGER NOT NULL DEFAULT 0,
+           max_attempts INTEGER NOT NULL DEFAULT 8,
+           error TEXT,
+           stripe_created BIGINT NOT NULL DEFAULT 0,
+           run_after TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+           locked_at TIMESTAMPTZ,
+           received_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+           processed_at TIMESTAMPTZ
+       )""",
+    "CREATE INDEX IF NOT EXISTS idx_stripe_events_pending ON stripe_events (stripe_created, received_at) WHERE status = 'pending'",
+    "CREATE INDEX IF NOT EXISTS idx_stripe_events_customer_status ON stripe_events (customer_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_stripe_events_status_received ON stripe_events (status, received_at DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_users_stripe_customer ON users (stripe_customer_id) WHERE stripe_customer_id IS NOT NULL",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions (user_id)",
+    """CREATE TABLE IF NOT EXISTS promo_redemptions (
+           id TEXT PRIMARY KEY,
+           promo_code TEXT NOT NULL,
+           user_id TEXT NOT NULL,
+           redeemed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+           UNIQUE (promo_code, user_id)
+       )""",
+    "ALTER TABLE promo_codes ADD COLUMN IF NOT EXISTS campaign TEXT",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_promo_codes_code ON promo_codes (code)",
+    "CREATE INDEX IF NOT EXISTS idx_promo_codes_campaign ON promo_codes (campaign, created_at DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_promo_codes_created ON promo_codes (created_at DESC, code)",
+    """CREATE TABLE IF NOT EXISTS reconciliation_runs (
+           id TEXT PRIMARY KEY,
+           status TEXT NOT NULL DEFAULT 'running',
+           dry_run BOOLEAN NOT NULL DEFAULT FALSE,
+           cursor TEXT,
+           report JSONB,
+           error TEXT,
+           started_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+           heartbeat_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+           finished_at TIMESTAMPTZ
+       )""",
+    # At most one run in progress across all processes
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_reconciliation_runs_running ON reconciliation_runs ((TRUE)) WHERE status = 'running'",
+    "CREATE INDEX IF NOT EXISTS idx_reconciliation_runs_started ON reconciliation_runs (started_at DESC)",
+    # Racing first checkouts could store several active prices per package; keep the oldest
+    """UPDATE stripe_prices SET active = FALSE
+       WHERE active AND id NOT IN (
+           SELECT DISTINCT ON (name) id FROM stripe_prices WHERE active ORDER BY name, created_at
+       )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_stripe_prices_active_name ON stripe_prices (name) WHERE active",
+    """CREATE TABLE IF NOT EXISTS idempotency_keys (
+           key TEXT PRIMARY KEY,
+           fingerprint TEXT NOT NULL,
+           status TEXT NOT NULL DEFAULT 'in_progress',
+           response_status INTEGER,
+           response_headers JSONB,
+           response_body BYTEA,
+           locked_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+           created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+           expires_at TIMESTAMPTZ NOT NULL
+       )""",
+    "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at)",
+]
+
+async def init_schema():
+    async with pool.acquire() as conn:
+        for statement in SCHEMA_STATEMENTS:
+            await conn.execute(statement)
+
 def _serialize_jsonb(value: Any) -> str:
     if value is None:
         return None
     return json.dumps(value)
 
+def _deserialize_jsonb(value: Any) -> Any:
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
 async def fetch_one(query: str, *args) -> Optional[Dict[str, Any]]:
     async with pool.acquire() as conn:
         row = await conn.fetchrow(query, *args)
@@ -53,6 +179,10 @@ async def find_user_by_oauth(provider: str, oauth_id: str) -> Optional[Dict[str,
         provider, oauth_id
     )
 
+async def find_user_id_by_stripe_customer(customer_id: str) -> Optional[str]:
+    row = await fetch_one("SELECT id FROM users WHERE stripe_customer_id = $1", customer_id)
+    return row["id"] if row else None
+
 async def insert_user(user_doc: Dict[str, Any]) -> None:
     await execute(
         """INSERT INTO users (id, email, password, name, subscription_status, subscription_end_date,
@@ -144,10 +274,63 @@ async def update_promo_uses(code: str, user_id: str) -> None:
         code
     )
 
-async def insert_promo_code(promo_doc: Dict[str, Any]) -> None:
-    await execute(
-        """INSERT INTO promo_codes (id, code, discount_percent, discount_amount, valid_from, valid_until, max_uses, uses, active, created_at)
-           VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)""",
+async def redeem_promo(code: str, user_id: str, subscription_end_date: str) -> Dict[str, Any]:
+    """Redeem a code for a user in a single statement.
+
+    The conditional increment, the redemption record and the user grant are one
+    statement, so they commit or roll back together and the hot promo row is
+    locked only for that statement. A second redemption by the same user hits
+    the unique (promo_code, user_id) key and rolls everything back. Returns
+    {"status": "redeemed", "uses", "max_uses"} or {"status": <reason>} where
+    reason is not_found, inactive, expired, exhausted or already_redeemed.
+    """
+    try:
+        row = await fetch_one(
+            """WITH promo AS (
+                   UPDATE promo_codes SET uses = uses + 1
+                   WHERE code = $1 AND active
+                     AND (max_uses = 0 OR uses < max_uses)
+                     AND (valid_until IS NULL OR valid_until::timestamptz > NOW())
+                   RETURNING code, uses, max_uses
+               ), redemption AS (
+                   INSERT INTO promo_redemptions (id, promo_code, user_id)
+                   SELECT $3, code, $2 FROM promo
+               ), granted AS (
+                   UPDATE users SET subscription_status = 'active', subscription_end_date = $4
+                   WHERE id = $2 AND EXISTS (SELECT 1 FROM promo)
+               )
+               SELECT uses, max_uses FROM promo""",
+            code, user_id, str(uuid.uuid4()), subscription_end_date
+        )
+    except asyncpg.UniqueViolationError:
+        return {"status": "already_redeemed"}
+    if row:
+        return {"status": "redeemed", "uses": row["uses"], "max_uses": row["max_uses"]}
+
+    # Rejected: one more read to say why
+    promo = await fetch_one(
+        """SELECT active, uses, max_uses,
+                  (valid_until IS NOT NULL AND valid_until::timestamptz <= NOW()) AS expired,
+                  EXISTS (SELECT 1 FROM promo_redemptions r WHERE r.promo_code = $1 AND r.user_id = $2) AS redeemed
+           FROM promo_codes WHERE code = $1""",
+        code, user_id
+    )
+    if not promo:
+        return {"status": "not_found"}
+    if promo["redeemed"]:
+        return {"status": "already_redeemed"}
+    if not promo["active"]:
+        return {"status": "inactive"}
+    if promo["expired"]:
+        return {"status": "expired"}
+    return {"status": "exhausted"}
+
+async def insert_promo_code(promo_doc: Dict[str, Any]) -> bool:
+    """Insert a code; False when the code already exists"""
+    result = await execute(
+        """INSERT INTO promo_codes (id, code, discount_percent, discount_amount, valid_from, valid_until, max_uses, uses, active, created_at, campaign)
+           VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+           ON CONFLICT (code) DO NOTHING""",
         promo_doc.get("id"),
         promo_doc.get("code"),
         promo_doc.get("discount_percent"),
@@ -157,8 +340,76 @@ async def insert_promo_code(promo_doc: Dict[str, Any]) -> None:
         promo_doc.get("max_uses", 0),
         promo_doc.get("uses", 0),
         promo_doc.get("active", True),
-        promo_doc.get("created_at")
+        promo_doc.get("created_at"),
+        promo_doc.get("campaign")
     )
+    return result == "INSERT 0 1"
+
+PROMO_BULK_COLUMNS = ["id", "code", "valid_from", "valid_until", "max_uses", "uses", "active", "created_at", "campaign"]
+
+async def insert_promo_codes_bulk(promo_docs: List[Dict[str, Any]]) -> List[str]:
+    """COPY codes into a staging table and move them over in one transaction.
+    Codes that already exist are skipped; returns the codes actually inserted."""
+    records = [tuple(doc.get(column) for column in PROMO_BULK_COLUMNS) for doc in promo_docs]
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                "CREATE TEMP TABLE promo_codes_staging (LIKE promo_codes INCLUDING DEFAULTS) ON COMMIT DROP"
+            )
+            await conn.copy_records_to_table("promo_codes_staging", records=records, columns=PROMO_BULK_COLUMNS)
+            rows = await conn.fetch(
+                f"""INSERT INTO promo_codes ({', '.join(PROMO_BULK_COLUMNS)})
+                    SELECT {', '.join(PROMO_BULK_COLUMNS)} FROM promo_codes_staging
+                    ON CONFLICT (code) DO NOTHING
+                    RETURNING code"""
+            )
+    return [row["code"] for row in rows]
+
+def _promo_filters(search: Optional[str], status: Optional[str], campaign: Optional[str]) -> tuple:
+    clauses, args = [], []
+    if search:
+        args.append(f"{search.upper()}%")
+        clauses.append(f"code LIKE ${len(args)}")
+    if campaign:
+        args.append(campaign)
+        clauses.append(f"campaign = ${len(args)}")
+    expired = "(valid_until IS NOT NULL AND valid_until::timestamptz <= NOW())"
+    exhausted = "(max_uses > 0 AND uses >= max_uses)"
+    if status == "active":
+        clauses.append(f"active AND NOT {exhausted} AND NOT {expired}")
+    elif status == "revoked":
+        clauses.append("NOT active")
+    elif status == "exhausted":
+        clauses.append(exhausted)
+    elif status == "expired":
+        clauses.append(expired)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, args
+
+async def find_promo_codes_page(
+    search: Optional[str] = None,
+    status: Optional[str] = None,
+    campaign: Optional[str] = None,
+    limit: int = 50,
+    offset: int = 0
+) -> Dict[str, Any]:
+    """One page of codes plus totals over everything matching the filters"""
+    where, args = _promo_filters(search, status, campaign)
+    rows = await fetch_all(
+        f"""SELECT * FROM promo_codes {where}
+            ORDER BY created_at DESC, code
+            LIMIT ${len(args) + 1} OFFSET ${len(args) + 2}""",
+        *args, limit, offset
+    )
+    summary = await fetch_one(
+        f"""SELECT COUNT(*) AS total,
+                   COUNT(*) FILTER (WHERE active) AS active,
+                   COUNT(*) FILTER (WHERE uses > 0) AS redeemed_codes,
+                   COALESCE(SUM(uses), 0) AS total_uses
+            FROM promo_codes {where}""",
+        *args
+    )
+    return {"items": rows, "summary": summary}
 
 async def find_all_promo_codes() -> List[Dict[str, Any]]:
     return await fetch_all("SELECT * FROM promo_codes ORDER BY created_at DESC")
@@ -209,8 +460,8 @@ async def find_meal_by_id(meal_id: str) -> Optional[Dict[str, Any]]:
 
 async def insert_meal_plan(plan_doc: Dict[str, Any]) -> None:
     await execute(
-        """INSERT INTO meal_plans (id, user_id, plan_type, start_date, end_date, days, dietary_preferences, cooking_methods, servings, goal, created_at)
-           VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)""",
+        """INSERT INTO meal_plans (id, user_id, plan_type, start_date, end_date, days, dietary_preferences, cooking_methods, servings, goal, created_at, status, source_plan_id)
+           VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)""",
         plan_doc.get("id"),
         plan_doc.get("user_id"),
         plan_doc.get("plan_type"),
@@ -221,11 +472,79 @@ async def insert_meal_plan(plan_doc: Dict[str, Any]) -> None:
         _serialize_jsonb(plan_doc.get("cooking_methods", [])),
         plan_doc.get("servings", 1),
         plan_doc.get("goal"),
-        plan_doc.get("created_at")
+        plan_doc.get("created_at"),
+        plan_doc.get("status", "active"),
+        plan_doc.get("source_plan_id")
     )
 
 async def find_meal_plans_by_user(user_id: str) -> List[Dict[str, Any]]:
-    return await fetch_all("SELECT * FROM meal_plans WHERE user_id = $1 ORDER BY created_at DESC", user_id)
+    return await fetch_all(
+        "SELECT * FROM meal_plans WHERE user_id = $1 AND status <> 'draft' ORDER BY created_at DESC",
+        user_id
+    )
+
+async def find_draft_meal_plans(user_id: str) -> List[Dict[str, Any]]:
+    return await fetch_all(
+        "SELECT * FROM meal_plans WHERE user_id = $1 AND status = 'draft' ORDER BY start_date",
+        user_id
+    )
+
+async def find_plans_due_for_pregeneration(
+    window_start: str,
+    window_end: str,
+    limit: int,
+    retry_cooldown_seconds: int,
+    max_failures: int
+) -> List[Dict[str, Any]]:
+    """Latest active plan per user ending inside the window, skipping users who already
+    have a following plan or a draft for it. Any pre-generation job for the plan blocks
+    another one, except failed jobs older than the cooldown while fewer than
+    `max_failures` have failed."""
+    return await fetch_all(
+        """SELECT DISTINCT ON (mp.user_id) mp.*
+           FROM meal_plans mp
+           WHERE mp.status = 'active'
+             AND mp.end_date >= $1 AND mp.end_date < $2
+             AND NOT EXISTS (SELECT 1 FROM meal_plans d WHERE d.source_plan_id = mp.id)
+             AND NOT EXISTS (
+                 SELECT 1 FROM meal_plans later
+                 WHERE later.user_id = mp.user_id AND later.status = 'active' AND later.start_date >= mp.end_date
+             )
+             AND NOT EXISTS (
+                 SELECT 1 FROM ai_jobs j
+                 WHERE j.job_type = 'pregenerate_meal_plan'
+                   AND j.payload->>'source_plan_id' = mp.id
+                   AND (j.status <> 'failed' OR j.updated_at > NOW() - make_interval(secs => $4))
+             )
+             AND (
+                 SELECT COUNT(*) FROM ai_jobs j
+                 WHERE j.job_type = 'pregenerate_meal_plan'
+                   AND j.payload->>'source_plan_id' = mp.id
+                   AND j.status = 'failed'
+             ) < $5
+           ORDER BY mp.user_id, mp.end_date DESC
+           LIMIT $3""",
+        window_start, window_end, limit, retry_cooldown_seconds, max_failures
+    )
+
+async def find_meal_plans_for_consolidation(
+    user_id: str,
+    plan_ids: Optional[List[str]] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None
+) -> List[Dict[str, Any]]:
+    """Fetch every plan matching the given ids or overlapping the date range in one query.
+    Both range dates are inclusive; a plan's own end_date is the day after its last day."""
+    return await fetch_all(
+        """SELECT * FROM meal_plans
+           WHERE user_id = $1
+             AND (id = ANY($2::text[])
+                  OR ($3::date IS NOT NULL AND $4::date IS NOT NULL
+                      AND start_date::date <= $4 AND end_date::date > $3
+                      AND status <> 'draft'))
+           ORDER BY start_date""",
+        user_id, plan_ids or [], start_date, end_date
+    )
 
 async def find_meal_plan_by_id(plan_id: str, user_id: str) -> Optional[Dict[str, Any]]:
     return await fetch_one("SELECT * FROM meal_plans WHERE id = $1 AND user_id = $2", plan_id, user_id)
@@ -246,6 +565,33 @@ async def update_meal_plan(plan_id: str, user_id: str, updates: Dict[str, Any])
     query = f"UPDATE meal_plans SET {', '.join(set_clauses)} WHERE id = ${param_idx} AND user_id = ${param_idx + 1}"
     await execute(query, *values)
 
+async def update_meal_plan_slot(
+    plan_id: str,
+    user_id: str,
+    day_index: int,
+    meal_type: str,
+    meal_name: str,
+    recipe: Optional[Dict[str, Any]],
+    instruction: str
+) -> int:
+    """Rewrite a single day/meal slot in place with jsonb_set instead of resending all days.
+    A replaced meal is never a leftover, so its is_leftover flag is cleared too."""
+    params = [plan_id, user_id, str(day_index), meal_type, meal_name, instruction, day_index]
+    if recipe is not None:
+        params.append(_serialize_jsonb(recipe))
+        recipes_expr = "COALESCE(days -> $7::int -> 'recipes', '{}'::jsonb) || jsonb_build_object($4::text, $8::jsonb)"
+    else:
+        recipes_expr = "COALESCE(days -> $7::int -> 'recipes', '{}'::jsonb) - $4::text"
+    
+    query = f"""UPDATE meal_plans SET days = jsonb_set(jsonb_set(jsonb_set(jsonb_set(days,
+                    ARRAY[$3::text, 'meals', $4::text], to_jsonb($5::text), true),
+                    ARRAY[$3::text, 'is_leftover', $4::text], 'false'::jsonb, true),
+                    ARRAY[$3::text, 'instructions'], COALESCE(days -> $7::int -> 'instructions', '{{}}'::jsonb) || jsonb_build_object($4::text, $6::text), true),
+                    ARRAY[$3::text, 'recipes'], {recipes_expr}, true)
+                WHERE id = $1 AND user_id = $2"""
+    result = await execute(query, *params)
+    return int(result.split()[-1]) if result else 0
+
 async def delete_meal_plan(plan_id: str, user_id: str) -> int:
     result = await execute("DELETE FROM meal_plans WHERE id = $1 AND user_id = $2", plan_id, user_id)
     return int(result.split()[-1]) if result else 0
@@ -255,14 +601,85 @@ async def delete_shopping_lists_by_meal_plan(meal_plan_id: str) -> None:
 
 async def insert_shopping_list(list_doc: Dict[str, Any]) -> None:
     await execute(
-        """INSERT INTO shopping_lists (id, user_id, meal_plan_id, items, created_at)
-           VALUES ($1, $2, $3, $4, $5)""",
+        """INSERT INTO shopping_lists (id, user_id, meal_plan_id, items, contributions, totals, subtract_pantry, created_at, updated_at)
+           VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)""",
         list_doc.get("id"),
         list_doc.get("user_id"),
         list_doc.get("meal_plan_id"),
         _serialize_jsonb(list_doc.get("items", [])),
-        list_doc.get("created_at")
+        _serialize_jsonb(list_doc.get("contributions")),
+        _serialize_jsonb(list_doc.get("totals")),
+        list_doc.get("subtract_pantry", True),
+        list_doc.get("created_at"),
+        list_doc.get("updated_at", list_doc.get("created_at"))
+    )
+
+async def find_shopping_list_by_meal_plan(meal_plan_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+    row = await fetch_one(
+        "SELECT * FROM shopping_lists WHERE meal_plan_id = $1 AND user_id = $2 ORDER BY created_at DESC LIMIT 1",
+        meal_plan_id, user_id
     )
+    if row:
+        for key in ["items", "contributions", "totals"]:
+            row[key] = _deserialize_jsonb(row.get(key))
+    return row
+
+async def update_shopping_list(list_id: str, user_id: str, updates: Dict[str, Any]) -> None:
+    set_sql, values = _shopping_list_update_query(updates)
+    values.extend([list_id, user_id])
+    query = f"UPDATE shopping_lists SET {set_sql} WHERE id = ${len(values) - 1} AND user_id = ${len(values)}"
+    await execute(query, *values)
+
+def _shopping_list_update_query(updates: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    set_clauses = []
+    values = []
+    for key, value in updates.items():
+        if key in ["items", "contributions", "totals"]:
+            value = _serialize_jsonb(value)
+        values.append(value)
+        set_clauses.append(f"{key} = ${len(values)}")
+    return ", ".join(set_clauses), values
+
+async def modify_shopping_list(
+    user_id: str,
+    modify: Callable[[Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]],
+    list_id: Optional[str] = None,
+    meal_plan_id: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    """Read-modify-write a shopping list (by id, or the latest for a meal plan) under a row lock.
+    
+    `modify` gets the locked row and returns the columns to update, or None to leave it.
+    Concurrent refreshes and item checks on the same list are serialized instead of
+    overwriting each other. Returns the row as written, or None when there is no list.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if list_id is not None:
+                row = await conn.fetchrow(
+                    "SELECT * FROM shopping_lists WHERE id = $1 AND user_id = $2 FOR UPDATE", list_id, user_id
+                )
+            else:
+                row = await conn.fetchrow(
+                    """SELECT * FROM shopping_lists WHERE meal_plan_id = $1 AND user_id = $2
+                       ORDER BY created_at DESC LIMIT 1 FOR UPDATE""",
+                    meal_plan_id, user_id
+                )
+            if row is None:
+                return None
+            row = dict(row)
+            for key in ["items", "contributions", "totals"]:
+                row[key] = _deserialize_jsonb(row.get(key))
+            
+            updates = await modify(row)
+            if not updates:
+                return row
+            set_sql, values = _shopping_list_update_query(updates)
+            values.extend([row["id"], user_id])
+            await conn.execute(
+                f"UPDATE shopping_lists SET {set_sql} WHERE id = ${len(values) - 1} AND user_id = ${len(values)}",
+                *values
+            )
+    return {**row, **updates}
 
 async def find_shopping_lists_by_user(user_id: str) -> List[Dict[str, Any]]:
     return await fetch_all("SELECT * FROM shopping_lists WHERE user_id = $1 ORDER BY created_at DESC", user_id)
@@ -374,13 +791,17 @@ async def find_ai_config(user_id: str) -> Optional[Dict[str, Any]]:
 
 async def insert_ai_config(config_doc: Dict[str, Any]) -> None:
     await execute(
-        """INSERT INTO ai_configs (id, user_id, provider, model, api_key, created_at)
-           VALUES ($1, $2, $3, $4, $5, NOW())""",
+        """INSERT INTO ai_configs (id, user_id, provider, model, api_key,
+                                   fallback_provider, fallback_model, fallback_api_key, created_at)
+           VALUES ($1, $2, $3, $4, $5, $6, $7, $8, NOW())""",
         config_doc.get("id"),
         config_doc.get("user_id"),
         config_doc.get("provider", "openai"),
         config_doc.get("model", "gpt-5.2"),
-        config_doc.get("api_key")
+        config_doc.get("api_key"),
+        config_doc.get("fallback_provider"),
+        config_doc.get("fallback_model"),
+        config_doc.get("fallback_api_key")
     )
 
 async def update_ai_config(user_id: str, updates: Dict[str, Any]) -> None:
@@ -400,10 +821,16 @@ async def update_ai_config(user_id: str, updates: Dict[str, Any]) -> None:
 async def find_stripe_price(package_id: str) -> Optional[Dict[str, Any]]:
     return await fetch_one("SELECT * FROM stripe_prices WHERE name = $1 AND active = true", package_id)
 
-async def insert_stripe_price(price_doc: Dict[str, Any]) -> None:
-    await execute(
+async def find_active_stripe_prices() -> List[Dict[str, Any]]:
+    return await fetch_all("SELECT * FROM stripe_prices WHERE active = true")
+
+async def insert_stripe_price(price_doc: Dict[str, Any]) -> str:
+    """Store the active price for a package; if another process stored one first, returns theirs"""
+    row = await fetch_one(
         """INSERT INTO stripe_prices (id, stripe_price_id, name, amount, currency, interval, active, created_at)
-           VALUES ($1, $2, $3, $4, $5, $6, $7, NOW())""",
+           VALUES ($1, $2, $3, $4, $5, $6, $7, NOW())
+           ON CONFLICT (name) WHERE active DO NOTHING
+           RETURNING stripe_price_id""",
         price_doc.get("id"),
         price_doc.get("price_id"),
         price_doc.get("package_id"),
@@ -412,6 +839,12 @@ async def insert_stripe_price(price_doc: Dict[str, Any]) -> None:
         price_doc.get("interval"),
         True
     )
+    if row is None:
+        row = await find_stripe_price(price_doc.get("package_id"))
+    return row["stripe_price_id"]
+
+async def deactivate_stripe_price(package_id: str) -> None:
+    await execute("UPDATE stripe_prices SET active = false WHERE name = $1 AND active = true", package_id)
 
 async def insert_payment_transaction(txn_doc: Dict[str, Any]) -> None:
     async with pool.acquire() as conn:
@@ -467,6 +900,32 @@ async def insert_subscription(sub_doc: Dict[str, Any]) -> None:
         sub_doc.get('updated_at', datetime.now(timezone.utc))
     )
 
+async def upsert_subscription(sub_doc: Dict[str, Any]) -> None:
+    """Create or update a user's subscription row; fields left as None keep their stored value"""
+    now = datetime.now(timezone.utc)
+    await execute(
+        """INSERT INTO subscriptions (id, user_id, stripe_subscription_id, status, plan,
+           current_period_start, current_period_end, cancel_at_period_end, created_at, updated_at)
+           VALUES ($1, $2, $3, $4, $5, $6, $7, COALESCE($8, FALSE), $9, $9)
+           ON CONFLICT (user_id) DO UPDATE SET
+               stripe_subscription_id = COALESCE(EXCLUDED.stripe_subscription_id, subscriptions.stripe_subscription_id),
+               status = EXCLUDED.status,
+               plan = COALESCE(EXCLUDED.plan, subscriptions.plan),
+               current_period_start = COALESCE(EXCLUDED.current_period_start, subscriptions.current_period_start),
+               current_period_end = COALESCE(EXCLUDED.current_period_end, subscriptions.current_period_end),
+               cancel_at_period_end = COALESCE($8, subscriptions.cancel_at_period_end),
+               updated_at = EXCLUDED.updated_at""",
+        str(uuid.uuid4()),
+        sub_doc["user_id"],
+        sub_doc.get("stripe_subscription_id"),
+        sub_doc.get("status", "active"),
+        sub_doc.get("plan"),
+        sub_doc.get("current_period_start"),
+        sub_doc.get("current_period_end"),
+        sub_doc.get("cancel_at_period_end"),
+        now
+    )
+
 async def update_subscription(user_id: str, updates: Dict[str, Any]) -> None:
     set_clauses = []
     values = []
@@ -481,6 +940,57 @@ async def update_subscription(user_id: str, updates: Dict[str, Any]) -> None:
     query = f"UPDATE subscriptions SET {', '.join(set_clauses)} WHERE user_id = ${param_idx}"
     await execute(query, *values)
 
+async def find_subscription_state_by_customers(customer_ids: List[str]) -> List[Dict[str, Any]]:
+    """Local subscription state for a page of Stripe customers: the user row and its subscription, if any"""
+    return await fetch_all(
+        """SELECT u.id AS user_id, u.stripe_customer_id, u.subscription_status AS user_status,
+                  u.subscription_end_date, s.stripe_subscription_id, s.status, s.plan,
+                  s.current_period_end, s.cancel_at_period_end
+           FROM users u LEFT JOIN subscriptions s ON s.user_id = u.id
+           WHERE u.stripe_customer_id = ANY($1::text[])""",
+        customer_ids
+    )
+
+async def apply_subscription_corrections(subscriptions: List[Dict[str, Any]], users: List[Dict[str, Any]]) -> None:
+    """Upsert many subscription rows and mirror their state onto the user rows in one transaction"""
+    now = datetime.now(timezone.utc)
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if subscriptions:
+                await conn.execute(
+                    """INSERT INTO subscriptions (id, user_id, stripe_subscription_id, status, plan,
+                       current_period_end, cancel_at_period_end, created_at, updated_at)
+                       SELECT c.id, c.user_id, c.stripe_subscription_id, c.status, c.plan,
+                              c.current_period_end, c.cancel_at_period_end, $8, $8
+                       FROM unnest($1::text[], $2::text[], $3::text[], $4::text[], $5::text[],
+                                   $6::timestamptz[], $7::boolean[])
+                            AS c(id, user_id, stripe_subscription_id, status, plan, current_period_end, cancel_at_period_end)
+                       ON CONFLICT (user_id) DO UPDATE SET
+                           stripe_subscription_id = EXCLUDED.stripe_subscription_id,
+                           status = EXCLUDED.status,
+                           plan = COALESCE(EXCLUDED.plan, subscriptions.plan),
+                           current_period_end = COALESCE(EXCLUDED.current_period_end, subscriptions.current_period_end),
+                           cancel_at_period_end = EXCLUDED.cancel_at_period_end,
+                           updated_at = EXCLUDED.updated_at""",
+                    [str(uuid.uuid4()) for _ in subscriptions],
+                    [sub["user_id"] for sub in subscriptions],
+                    [sub["stripe_subscription_id"] for sub in subscriptions],
+                    [sub["status"] for sub in subscriptions],
+                    [sub.get("plan") for sub in subscriptions],
+                    [sub.get("current_period_end") for sub in subscriptions],
+                    [bool(sub.get("cancel_at_period_end")) for sub in subscriptions],
+                    now
+                )
+            if users:
+                await conn.execute(
+                    """UPDATE users u SET subscription_status = c.status, subscription_end_date = c.end_date
+                       FROM unnest($1::text[], $2::text[], $3::text[]) AS c(user_id, status, end_date)
+                       WHERE u.id = c.user_id""",
+                    [user["user_id"] for user in users],
+                    [user["subscription_status"] for user in users],
+                    [user.get("subscription_end_date") for user in users]
+                )
+
 async def insert_payment(payment_doc: Dict[str, Any]) -> None:
     await execute(
         """INSERT INTO payments (id, user_id, stripe_payment_id, amount, currency, status, 
@@ -498,3 +1008,377 @@ async def insert_payment(payment_doc: Dict[str, Any]) -> None:
 
 async def find_payments_by_user(user_id: str) -> List[Dict[str, Any]]:
     return await fetch_all("SELECT * FROM payments WHERE user_id = $1 ORDER BY created_at DESC", user_id)
+
+async def insert_ai_job(job_doc: Dict[str, Any]) -> None:
+    await execute(
+        """INSERT INTO ai_jobs (id, user_id, job_type, payload, priority, max_attempts, status)
+           VALUES ($1, $2, $3, $4, $5, $6, $7)""",
+        job_doc.get("id"),
+        job_doc.get("user_id"),
+        job_doc.get("job_type"),
+        _serialize_jsonb(job_doc.get("payload", {})),
+        job_doc.get("priority", 0),
+        job_doc.get("max_attempts", 3),
+        job_doc.get("status", "queued")
+    )
+
+def _normalize_ai_job(row: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if row:
+        row["payload"] = _deserialize_jsonb(row.get("payload"))
+        row["result"] = _deserialize_jsonb(row.get("result"))
+    return row
+
+async def find_ai_job(job_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+    row = await fetch_one("SELECT * FROM ai_jobs WHERE id = $1 AND user_id = $2", job_id, user_id)
+    return _normalize_ai_job(row)
+
+async def claim_ai_job(per_user_limit: int) -> Optional[Dict[str, Any]]:
+    """Take the highest-priority runnable job whose user is under the running-job cap.
+    SKIP LOCKED lets any number of workers (and processes) poll the table concurrently."""
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            row = await conn.fetchrow(
+                """SELECT * FROM ai_jobs j
+                   WHERE j.status = 'queued' AND j.run_after <= NOW()
+                     AND (SELECT COUNT(*) FROM ai_jobs r WHERE r.user_id = j.user_id AND r.status = 'running') < $1
+                   ORDER BY j.priority DESC, j.created_at
+                   LIMIT 1
+                   FOR UPDATE SKIP LOCKED""",
+                per_user_limit
+            )
+            if not row:
+                return None
+            await conn.execute(
+                """UPDATE ai_jobs SET status = 'running', attempts = attempts + 1, locked_at = NOW(), updated_at = NOW()
+                   WHERE id = $1""",
+                row["id"]
+            )
+            job = dict(row)
+            job["attempts"] += 1
+            return _normalize_ai_job(job)
+
+async def complete_ai_job(job_id: str, result: Dict[str, Any]) -> None:
+    await execute(
+        "UPDATE ai_jobs SET status = 'succeeded', result = $2, error = NULL, updated_at = NOW() WHERE id = $1",
+        job_id, _serialize_jsonb(result)
+    )
+
+async def fail_ai_job(job_id: str, error: str, retry_in_seconds: Optional[float] = None) -> None:
+    """Requeue with a delay while attempts remain, otherwise mark the job failed"""
+    if retry_in_seconds is None:
+        await execute(
+            "UPDATE ai_jobs SET status = 'failed', error = $2, updated_at = NOW() WHERE id = $1",
+            job_id, error
+        )
+        return
+    await execute(
+        """UPDATE ai_jobs SET
+               status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+               run_after = NOW() + make_interval(secs => $3),
+               error = $2, updated_at = NOW()
+           WHERE id = $1""",
+        job_id, error, float(retry_in_seconds)
+    )
+
+async def defer_ai_job(job_id: str, delay_seconds: float) -> None:
+    """Put a job back in the queue without counting the attempt against it"""
+    await execute(
+        """UPDATE ai_jobs SET status = 'queued', attempts = GREATEST(attempts - 1, 0),
+               run_after = NOW() + make_interval(secs => $2), updated_at = NOW()
+           WHERE id = $1""",
+        job_id, float(delay_seconds)
+    )
+
+async def requeue_stale_ai_jobs(stale_after_seconds: int) -> int:
+    """Hand jobs left 'running' by a crashed or restarted process back to the queue.
+    Jobs claimed for a batch that was never submitted go back to waiting for one."""
+    result = await execute(
+        """UPDATE ai_jobs SET status = 'queued', updated_at = NOW()
+           WHERE status = 'running' AND locked_at < NOW() - make_interval(secs => $1)""",
+        float(stale_after_seconds)
+    )
+    unsubmitted = await execute(
+        """UPDATE ai_jobs SET status = 'batch_pending', updated_at = NOW()
+           WHERE status = 'batched' AND batch_id IS NULL AND locked_at < NOW() - make_interval(secs => $1)""",
+        float(stale_after_seconds)
+    )
+    return sum(int(r.split()[-1]) for r in (result, unsubmitted) if r)
+
+async def sum_ai_job_tokens(job_type: str, since: datetime) -> int:
+    """Estimated tokens of jobs of a type enqueued since a point in time"""
+    return await fetch_count(
+        """SELECT COALESCE(SUM((payload->>'estimated_tokens')::int), 0)
+           FROM ai_jobs WHERE job_type = $1 AND created_at >= $2""",
+        job_type, since
+    )
+
+async def claim_batch_pending_ai_jobs(limit: int) -> List[Dict[str, Any]]:
+    """Take up to `limit` jobs waiting for a batch, oldest first"""
+    rows = await fetch_all(
+        """UPDATE ai_jobs SET status = 'batched', attempts = attempts + 1, locked_at = NOW(), updated_at = NOW()
+           WHERE id IN (
+               SELECT id FROM ai_jobs WHERE status = 'batch_pending'
+               ORDER BY created_at
+               LIMIT $1
+               FOR UPDATE SKIP LOCKED
+           )
+           RETURNING *""",
+        limit
+    )
+    return [_normalize_ai_job(row) for row in rows]
+
+async def assign_ai_jobs_to_batch(job_ids: List[str], batch_id: str) -> None:
+    await execute(
+        "UPDATE ai_jobs SET batch_id = $2, updated_at = NOW() WHERE id = ANY($1::text[])",
+        job_ids, batch_id
+    )
+
+async def release_ai_jobs_to_queue(job_ids: List[str]) -> None:
+    """Send batched jobs to the interactive worker queue instead"""
+    if not job_ids:
+        return
+    await execute(
+        """UPDATE ai_jobs SET status = 'queued', batch_id = NULL, run_after = NOW(), updated_at = NOW()
+           WHERE id = ANY($1::text[]) AND status = 'batched'""",
+        job_ids
+    )
+
+async def find_ai_jobs_by_batch(batch_id: str) -> List[Dict[str, Any]]:
+    rows = await fetch_all("SELECT * FROM ai_jobs WHERE batch_id = $1 AND status = 'batched'", batch_id)
+    return [_normalize_ai_job(row) for row in rows]
+
+async def insert_ai_batch(batch_doc: Dict[str, Any]) -> None:
+    await execute(
+        """INSERT INTO ai_batches (id, provider, model, key_user_id, provider_batch_id, request_count)
+           VALUES ($1, $2, $3, $4, $5, $6)""",
+        batch_doc.get("id"),
+        batch_doc.get("provider"),
+        batch_doc.get("model"),
+        batch_doc.get("key_user_id"),
+        batch_doc.get("provider_batch_id"),
+        batch_doc.get("request_count", 0)
+    )
+
+async def find_open_ai_batches() -> List[Dict[str, Any]]:
+    return await fetch_all("SELECT * FROM ai_batches WHERE completed_at IS NULL ORDER BY created_at")
+
+async def find_recent_ai_batches(limit: int = 50) -> List[Dict[str, Any]]:
+    return await fetch_all("SELECT * FROM ai_batches ORDER BY created_at DESC LIMIT $1", limit)
+
+async def finish_ai_batch(batch_id: str, status: str, succeeded: int, failed: int, error: Optional[str] = None) -> None:
+    await execute(
+        """UPDATE ai_batches SET status = $2, succeeded = $3, failed = $4, error = $5, completed_at = NOW()
+           WHERE id = $1""",
+        batch_id, status, succeeded, failed, error
+    )
+
+async def update_ai_batch_status(batch_id: str, status: str) -> None:
+    await execute("UPDATE ai_batches SET status = $2 WHERE id = $1", batch_id, status)
+
+async def insert_stripe_event(event_doc: Dict[str, Any]) -> bool:
+    """Store a webhook event once; False when the event id was already received"""
+    result = await execute(
+        """INSERT INTO stripe_events (id, event_type, customer_id, payload, stripe_created)
+           VALUES ($1, $2, $3, $4, $5)
+           ON CONFLICT (id) DO NOTHING""",
+        event_doc.get("id"),
+        event_doc.get("event_type"),
+        event_doc.get("customer_id"),
+        _serialize_jsonb(event_doc.get("payload", {})),
+        event_doc.get("stripe_created", 0)
+    )
+    return result == "INSERT 0 1"
+
+def _normalize_stripe_event(row: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if row:
+        row["payload"] = _deserialize_jsonb(row.get("payload"))
+    return row
+
+async def claim_stripe_event() -> Optional[Dict[str, Any]]:
+    """Take the oldest runnable event whose customer has nothing older pending or in progress,
+    so each customer's events apply in the order Stripe created them"""
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            row = await conn.fetchrow(
+                """SELECT * FROM stripe_events e
+                   WHERE e.status = 'pending' AND e.run_after <= NOW()
+                     AND NOT EXISTS (
+                         SELECT 1 FROM stripe_events p
+                         WHERE p.customer_id = e.customer_id AND p.id <> e.id
+                           AND (p.status = 'processing'
+                                OR (p.status = 'pending'
+                                    AND (p.stripe_created, p.received_at) < (e.stripe_created, e.received_at)))
+                     )
+                   ORDER BY e.stripe_created, e.received_at
+                   LIMIT 1
+                   FOR UPDATE SKIP LOCKED"""
+            )
+            if not row:
+                return None
+            await conn.execute(
+                """UPDATE stripe_events SET status = 'processing', attempts = attempts + 1, locked_at = NOW()
+                   WHERE id = $1""",
+                row["id"]
+            )
+            event = dict(row)
+            event["attempts"] += 1
+            return _normalize_stripe_event(event)
+
+async def complete_stripe_event(event_id: str) -> None:
+    await execute(
+        "UPDATE stripe_events SET status = 'processed', error = NULL, processed_at = NOW() WHERE id = $1",
+        event_id
+    )
+
+async def fail_stripe_event(event_id: str, error: str, retry_in_seconds: float) -> None:
+    """Retry later while attempts remain; a failed event stops blocking its customer's later events"""
+    await execute(
+        """UPDATE stripe_events SET
+               status = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END,
+               run_after = NOW() + make_interval(secs => $3),
+               error = $2
+           WHERE id = $1""",
+        event_id, error, float(retry_in_seconds)
+    )
+
+async def requeue_stale_stripe_events(stale_after_seconds: int) -> int:
+    result = await execute(
+        """UPDATE stripe_events SET status = 'pending'
+           WHERE status = 'processing' AND locked_at < NOW() - make_interval(secs => $1)""",
+        float(stale_after_seconds)
+    )
+    return int(result.split()[-1]) if result else 0
+
+async def find_stripe_events(status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+    if status:
+        rows = await fetch_all(
+            "SELECT * FROM stripe_events WHERE status = $1 ORDER BY received_at DESC LIMIT $2",
+            status, limit
+        )
+    else:
+        rows = await fetch_all("SELECT * FROM stripe_events ORDER BY received_at DESC LIMIT $1", limit)
+    return [_normalize_stripe_event(row) for row in rows]
+
+async def count_stripe_events_by_status() -> Dict[str, int]:
+    rows = await fetch_all("SELECT status, COUNT(*) AS count FROM stripe_events GROUP BY status")
+    return {row["status"]: row["count"] for row in rows}
+
+async def replay_stripe_events(event_ids: Optional[List[str]] = None, status: Optional[str] = None) -> int:
+    """Queue stored events for processing again, by id or by current status"""
+    if event_ids:
+        result = await execute(
+            """UPDATE stripe_events SET status = 'pending', attempts = 0, error = NULL, run_after = NOW()
+               WHERE id = ANY($1::text[]) AND status <> 'processing'""",
+            event_ids
+        )
+    elif status:
+        result = await execute(
+            """UPDATE stripe_events SET status = 'pending', attempts = 0, error = NULL, run_after = NOW()
+               WHERE status = $1""",
+            status
+        )
+    else:
+        return 0
+    return int(result.split()[-1]) if result else 0
+
+def _normalize_reconciliation_run(row: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if row:
+        row["report"] = _deserialize_jsonb(row.get("report"))
+    return row
+
+async def claim_reconciliation_run(
+    run_id: str,
+    dry_run: bool,
+    stale_after_seconds: int,
+    min_interval_seconds: Optional[int] = None
+) -> Optional[Dict[str, Any]]:
+    """Resume a run whose process stopped heartbeating, or start a new one unless a
+    non-dry run started within `min_interval_seconds`. None when there is nothing to do
+    or another process has a run in progress."""
+    row = await fetch_one(
+        """UPDATE reconciliation_runs SET heartbeat_at = NOW()
+           WHERE status = 'running' AND heartbeat_at < NOW() - make_interval(secs => $1)
+           RETURNING *""",
+        float(stale_after_seconds)
+    )
+    if row is None:
+        row = await fetch_one(
+            """INSERT INTO reconciliation_runs (id, dry_run)
+               SELECT $1, $2
+               WHERE $3::float8 IS NULL OR NOT EXISTS (
+                   SELECT 1 FROM reconciliation_runs
+                   WHERE NOT dry_run AND started_at > NOW() - make_interval(secs => $3::float8)
+               )
+               ON CONFLICT DO NOTHING
+               RETURNING *""",
+            run_id, dry_run, float(min_interval_seconds) if min_interval_seconds is not None else None
+        )
+    return _normalize_reconciliation_run(row)
+
+async def checkpoint_reconciliation_run(run_id: str, cursor: Optional[str], report: Dict[str, Any]) -> None:
+    await execute(
+        "UPDATE reconciliation_runs SET cursor = $2, report = $3, heartbeat_at = NOW() WHERE id = $1",
+        run_id, cursor, _serialize_jsonb(report)
+    )
+
+async def finish_reconciliation_run(run_id: str, status: str, report: Dict[str, Any], error: Optional[str] = None) -> None:
+    await execute(
+        """UPDATE reconciliation_runs SET status = $2, report = $3, error = $4, finished_at = NOW()
+           WHERE id = $1""",
+        run_id, status, _serialize_jsonb(report), error
+    )
+
+async def find_recent_reconciliation_runs(limit: int = 20) -> List[Dict[str, Any]]:
+    rows = await fetch_all("SELECT * FROM reconciliation_runs ORDER BY started_at DESC LIMIT $1", limit)
+    return [_normalize_reconciliation_run(row) for row in rows]
+
+async def claim_idempotency_key(
+    key: str,
+    fingerprint: str,
+    ttl_seconds: int,
+    lock_seconds: int
+) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """Take a key for this request, also taking over expired keys and requests that
+    stopped responding. Otherwise returns (False, the row currently holding it)."""
+    row = await fetch_one(
+        """INSERT INTO idempotency_keys (key, fingerprint, expires_at)
+           VALUES ($1, $2, NOW() + make_interval(secs => $3))
+           ON CONFLICT (key) DO UPDATE SET
+               fingerprint = EXCLUDED.fingerprint,
+               status = 'in_progress',
+               response_status = NULL,
+               response_headers = NULL,
+               response_body = NULL,
+               locked_at = NOW(),
+               created_at = NOW(),
+               expires_at = EXCLUDED.expires_at
+           WHERE idempotency_keys.expires_at < NOW()
+              OR (idempotency_keys.status = 'in_progress'
+                  AND idempotency_keys.locked_at < NOW() - make_interval(secs => $4))
+           RETURNING key""",
+        key, fingerprint, float(ttl_seconds), float(lock_seconds)
+    )
+    if row:
+        return True, None
+    return False, await find_idempotency_key(key)
+
+async def find_idempotency_key(key: str) -> Optional[Dict[str, Any]]:
+    row = await fetch_one("SELECT * FROM idempotency_keys WHERE key = $1 AND expires_at > NOW()", key)
+    if row:
+        row["response_headers"] = _deserialize_jsonb(row.get("response_headers"))
+    return row
+
+async def complete_idempotency_key(key: str, status: int, headers: List[Tuple[str, str]], body: bytes) -> None:
+    await execute(
+        """UPDATE idempotency_keys
+           SET status = 'completed', response_status = $2, response_headers = $3, response_body = $4
+           WHERE key = $1""",
+        key, status, _serialize_jsonb([list(header) for header in headers]), body
+    )
+
+async def release_idempotency_key(key: str) -> None:
+    await execute("DELETE FROM idempotency_keys WHERE key = $1 AND status = 'in_progress'", key)
+
+async def delete_expired_idempotency_keys() -> int:
+    result = await execute("DELETE FROM idempotency_keys WHERE expires_at < NOW()")
+    return int(result.split()[-1]) if result else 0
@@ -0,0 +1,99 @@
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+try:
+    from . import cache
+except ImportError:
+    import cache
+
+# Stripe statuses that still grant access while the period lasts; past_due covers dunning retries
+PREMIUM_STATUSES = {"active", "trialing", "past_due"}
+
+@dataclass(frozen=True)
+class Entitlement:
+    user_id: str
+    is_premium: bool
+    status: str
+    plan: Optional[str] = None
+    current_period_end: Optional[datetime] = None
+    cancel_at_period_end: bool = False
+    source: str = "none"
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data["current_period_end"] = self.current_period_end.isoformat() if self.current_period_end else None
+        return data
+
+def as_datetime(value: Any) -> Optional[datetime]:
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        parsed = datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def resolve_entitlement(user_id: str, subscription: Optional[dict], user: Optional[dict], now: Optional[datetime] = None) -> Entitlement:
+    """Stripe subscriptions (kept current by webhooks) win; grants written straight
+    onto the user row, such as promo codes, cover users without a live subscription"""
+    now = now or datetime.now(timezone.utc)
+    stripe_entitlement = None
+    if subscription:
+        period_end = as_datetime(subscription.get("current_period_end"))
+        status = subscription.get("status") or "inactive"
+        stripe_entitlement = Entitlement(
+            user_id=user_id,
+            is_premium=status in PREMIUM_STATUSES and (period_end is None or period_end > now),
+            status=status,
+            plan=subscription.get("plan"),
+            current_period_end=period_end,
+            cancel_at_period_end=bool(subscription.get("cancel_at_period_end")),
+            source="stripe"
+        )
+        if stripe_entitlement.is_premium:
+            return stripe_entitlement
+
+    if user and user.get("subscription_status") == "active":
+        end = as_datetime(user.get("subscription_end_date"))
+        if end is None or end > now:
+            return Entitlement(user_id=user_id, is_premium=True, status="active", current_period_end=end, source="grant")
+    return stripe_entitlement or Entitlement(user_id=user_id, is_premium=False, status="inactive")
+
+class EntitlementService:
+    """Answers premium checks from the local database through a short-lived cache.
+
+    Webhook handlers and other writers call `invalidate` after changing a
+    user's subscription so this process sees the change immediately; other
+    processes see it within `ttl_seconds`.
+    """
+
+    def __init__(
+        self,
+        load_subscription: Callable[[str], Awaitable[Optional[dict]]],
+        load_user: Callable[[str], Awaitable[Optional[dict]]],
+        ttl_seconds: float = 60.0,
+        maxsize: int = 50000
+    ):
+        self.load_subscription = load_subscription
+        self.load_user = load_user
+        self._cache: cache.TTLCache[Entitlement] = cache.TTLCache(maxsize=maxsize, ttl_seconds=ttl_seconds)
+
+    async def get(self, user_id: str) -> Entitlement:
+        entitlement = self._cache.get(user_id)
+        if entitlement is not None and (
+            entitlement.current_period_end is None or entitlement.current_period_end > datetime.now(timezone.utc)
+        ):
+            return entitlement
+        subscription = await self.load_subscription(user_id)
+        entitlement = resolve_entitlement(user_id, subscription, None)
+        if not entitlement.is_premium:
+            entitlement = resolve_entitlement(user_id, subscription, await self.load_user(user_id))
+        self._cache.set(user_id, entitlement)
+        return entitlement
+
+    def invalidate(self, user_id: str) -> None:
+        self._cache.invalidate(user_id)
+
+    def stats(self) -> dict:
+        return self._cache.stats()
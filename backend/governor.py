@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+
+# Idle buckets are dropped once a table grows past this many entries
+MAX_TRACKED_BUCKETS = 10000
+
+class RateLimited(Exception):
+    """The request would exceed a rate or queue limit; retry after `retry_after` seconds"""
+
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"{scope} rate limit exceeded, retry in {retry_after:.1f}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+class TokenBucket:
+    """Refills continuously at `per_minute / 60` per second up to `per_minute`"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` is available; requests larger than the bucket wait for a full one"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if amount <= self.tokens:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+    def drain(self, seconds: float, now: float) -> None:
+        """Hold the bucket empty for `seconds`, e.g. after the provider itself answered 429"""
+        self._refill(now)
+        self.tokens = min(self.tokens, -self.rate * seconds)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+def _key_id(api_key: Optional[str]) -> Optional[str]:
+    # Buckets are keyed by a digest so the table never holds raw API keys
+    if not api_key:
+        return None
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+class LLMGovernor:
+    """Admission control in front of every LLM call.
+
+    A request first has to fit the per-user and per-API-key token buckets
+    (requests and tokens per minute); otherwise it is rejected with the time
+    until it would fit. It then takes one of `max_concurrency` global slots and
+    is charged to the buckets only once the slot is granted. When all slots are
+    busy, waiters queue per user and slots are handed out round-robin across
+    users, so one user's burst cannot starve everyone else; a user with
+    `max_waiting_per_user` requests already queued, or a wait longer than
+    `max_wait_seconds`, is rejected instead of queued.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 16,
+        user_rpm: float = 10,
+        user_tpm: float = 60000,
+        key_rpm: float = 60,
+        key_tpm: float = 200000,
+        max_waiting_per_user: int = 2,
+        max_wait_seconds: float = 30.0
+    ):
+        self.max_concurrency = max_concurrency
+        self.user_rpm = user_rpm
+        self.user_tpm = user_tpm
+        self.key_rpm = key_rpm
+        self.key_tpm = key_tpm
+        self.max_waiting_per_user = max_waiting_per_user
+        self.max_wait_seconds = max_wait_seconds
+        self._user_buckets: Dict[str, List[TokenBucket]] = {}
+        self._key_buckets: Dict[str, List[TokenBucket]] = {}
+        self._active = 0
+        self._waiters: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self.rejected = 0
+
+    def _buckets(self, table: Dict[str, List[TokenBucket]], key: str, rpm: float, tpm: float) -> List[TokenBucket]:
+        buckets = table.get(key)
+        if buckets is None:
+            if len(table) >= MAX_TRACKED_BUCKETS:
+                self._prune(table)
+            buckets = table[key] = [TokenBucket(rpm), TokenBucket(tpm)]
+        return buckets
+
+    def _prune(self, table: Dict[str, List[TokenBucket]]) -> None:
+        now = time.monotonic()
+        for key in [k for k, buckets in table.items() if all(b.is_full(now) for b in buckets)]:
+            del table[key]
+
+    def _checks(self, user_id: Optional[str], api_key: Optional[str]) -> List[tuple]:
+        checks = []
+        if user_id is not None:
+            checks.append(("user", self._buckets(self._user_buckets, user_id, self.user_rpm, self.user_tpm)))
+        key_id = _key_id(api_key)
+        if key_id:
+            checks.append(("api key", self._buckets(self._key_buckets, key_id, self.key_rpm, self.key_tpm)))
+        return checks
+
+    def _check(self, checks: List[tuple], tokens: int) -> None:
+        now = time.monotonic()
+        for scope, (requests, token_bucket) in checks:
+            wait = max(requests.wait_time(1, now), token_bucket.wait_time(tokens, now))
+            if wait > 0:
+                self.rejected += 1
+                raise RateLimited(scope, wait)
+
+    def check(self, user_id: str, api_key: Optional[str], tokens: int) -> None:
+        """Raise RateLimited if the request would not fit right now, without charging anything"""
+        self._check(self._checks(user_id, api_key), tokens)
+
+    def admit(self, user_id: Optional[str], api_key: Optional[str], tokens: int) -> None:
+        """Charge one request and `tokens` to the user's and key's buckets, or raise RateLimited"""
+        checks = self._checks(user_id, api_key)
+        self._check(checks, tokens)
+        for _, (requests, token_bucket) in checks:
+            requests.take(1)
+            token_bucket.take(tokens)
+
+    def admit_key(self, api_key: Optional[str], tokens: int) -> None:
+        """Charge a key on its own, for fallback or hedged attempts made inside a slot"""
+        self.admit(None, api_key, tokens)
+
+    def penalize_key(self, api_key: Optional[str], seconds: float) -> None:
+        """Back off everyone sharing a key the provider has started rate limiting"""
+        key_id = _key_id(api_key)
+        if key_id:
+            now = time.monotonic()
+            for bucket in self._buckets(self._key_buckets, key_id, self.key_rpm, self.key_tpm):
+                bucket.drain(seconds, now)
+
+    async def _acquire(self, user_id: str) -> None:
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            return
+
+        queue = self._waiters.get(user_id)
+        if queue is not None and len(queue) >= self.max_waiting_per_user:
+            self.rejected += 1
+            raise RateLimited("concurrency", self.max_wait_seconds / 2)
+        if queue is None:
+            queue = self._waiters[user_id] = deque()
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+
+        try:
+            await asyncio.wait_for(future, self.max_wait_seconds)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Granted a slot just as the waiter gave up; hand it on
+                self._release()
+            else:
+                self._discard(user_id, future)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.rejected += 1
+            raise RateLimited("concurrency", self.max_wait_seconds / 2)
+
+    def _discard(self, user_id: str, future: asyncio.Future) -> None:
+        queue = self._waiters.get(user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+        except ValueError:
+            pass
+        if not queue:
+            del self._waiters[user_id]
+
+    def _release(self) -> None:
+        self._active -= 1
+        while self._active < self.max_concurrency and self._waiters:
+            # Round-robin: serve the user at the head, then move them to the back
+            user_id, queue = next(iter(self._waiters.items()))
+            future = queue.popleft()
+            if queue:
+                self._waiters.move_to_end(user_id)
+            else:
+                del self._waiters[user_id]
+            if future.done():
+                continue
+            self._active += 1
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, api_key: Optional[str], tokens: int) -> AsyncIterator[None]:
+        """Hold a concurrency slot for one call. Buckets are checked up front so a request
+        that cannot fit is rejected without queuing, but only charged once the slot is
+        granted, so requests rejected for concurrency cost nothing."""
+        self.check(user_id, api_key, tokens)
+        await self._acquire(user_id)
+        try:
+            self.admit(user_id, api_key, tokens)
+        except RateLimited:
+            self._release()
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self._active,
+            "max_concurrency": self.max_concurrency,
+            "waiting": sum(len(q) for q in self._waiters.values()),
+            "waiting_users": len(self._waiters),
+            "rejected": self.rejected,
+        }
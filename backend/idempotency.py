@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    from . import cache
+except ImportError:
+    import cache
+
+HEADER = b"idempotency-key"
+MAX_KEY_LENGTH = 255
+# Larger responses are passed through but not stored
+MAX_STORED_BODY_BYTES = 1024 * 1024
+
+@dataclass(frozen=True)
+class StoredResponse:
+    fingerprint: str
+    status: int
+    headers: List[Tuple[str, str]]
+    body: bytes
+
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> "StoredResponse":
+        headers = row.get("response_headers") or []
+        if isinstance(headers, str):
+            headers = json.loads(headers)
+        return cls(row["fingerprint"], row["response_status"], [tuple(h) for h in headers], bytes(row["response_body"] or b""))
+
+class IdempotencyStore:
+    """Completed responses by idempotency key, in Postgres with a process-local tier in front.
+
+    `claim` either takes ownership of a key for this request or returns the row
+    another request already holds. Responses never change once stored, so the
+    memory tier needs no invalidation. Requests in this process that share a key
+    wait on the first one directly instead of polling the database.
+    """
+
+    def __init__(
+        self,
+        claim: Callable[[str, str, int, int], Awaitable[Tuple[bool, Optional[Dict[str, Any]]]]],
+        complete: Callable[[str, int, List[Tuple[str, str]], bytes], Awaitable[None]],
+        release: Callable[[str], Awaitable[None]],
+        ttl_seconds: int = 24 * 3600,
+        lock_seconds: int = 300,
+        memory_maxsize: int = 10000
+    ):
+        self._claim = claim
+        self._complete = complete
+        self._release = release
+        self.ttl_seconds = ttl_seconds
+        self.lock_seconds = lock_seconds
+        self._memory: cache.TTLCache[StoredResponse] = cache.TTLCache(maxsize=memory_maxsize, ttl_seconds=ttl_seconds)
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def cached(self, key: str) -> Optional[StoredResponse]:
+        return self._memory.get(key)
+
+    def inflight(self, key: str) -> Optional[asyncio.Future]:
+        return self._inflight.get(key)
+
+    async def claim(self, key: str, fingerprint: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        claimed, row = await self._claim(key, fingerprint, self.ttl_seconds, self.lock_seconds)
+        if claimed:
+            self._inflight[key] = asyncio.get_running_loop().create_future()
+        return claimed, row
+
+    def remember(self, key: str, response: StoredResponse) -> None:
+        self._memory.set(key, response)
+
+    async def finish(self, key: str, response: Optional[StoredResponse]) -> None:
+        """Store the owner's response, or release the key so a retry runs again"""
+        future = self._inflight.pop(key, None)
+        try:
+            if response is None:
+                await self._release(key)
+            else:
+                await self._complete(key, response.status, response.headers, response.body)
+                self._memory.set(key, response)
+        finally:
+            if future is not None and not future.done():
+                future.set_result(response)
+
+class IdempotencyMiddleware:
+    """Replays the stored response for repeated POSTs that carry an `Idempotency-Key`.
+
+    Keys are scoped to the caller's Authorization header and the path. The first
+    request with a key runs normally and its response is kept for
+    `store.ttl_seconds`; server errors are not kept, so retrying after one runs
+    the request again. A duplicate that arrives while the first is still running
+    waits up to `wait_seconds` for its result, then gets 409. Reusing a key with
+    a different body is rejected with 422.
+    """
+
+    def __init__(
+        self,
+        app,
+        store: IdempotencyStore,
+        paths: Iterable[str],
+        wait_seconds: float = 60.0,
+        poll_interval: float = 0.5
+    ):
+        self.app = app
+        self.store = store
+        self.paths = set(paths)
+        self.wait_seconds = wait_seconds
+        self.poll_interval = poll_interval
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        idempotency_key = headers.get(HEADER)
+        if idempotency_key is None:
+            return await self.app(scope, receive, send)
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            return await _send_error(send, 400, "Idempotency-Key must be 1-255 characters")
+
+        body = await _read_body(receive)
+        fingerprint = hashlib.sha256(body).hexdigest()
+        caller = hashlib.sha256(headers.get(b"authorization", b"")).hexdigest()[:16]
+        key = f"{caller}:{scope['path']}:{idempotency_key.decode('latin-1')}"
+
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            stored = self.store.cached(key)
+            if stored is None:
+                future = self.store.inflight(key)
+                if future is not None:
+                    try:
+                        stored = await asyncio.wait_for(asyncio.shield(future), max(deadline - time.monotonic(), 0))
+                    except asyncio.TimeoutError:
+                        return await _send_error(send, 409, "A request with this Idempotency-Key is still in progress")
+                    if stored is None:
+                        # The first request failed and released the key; run this one
+                        continue
+            if stored is not None:
+                if stored.fingerprint != fingerprint:
+                    return await _send_error(send, 422, "Idempotency-Key was already used with a different request body")
+                return await _replay(send, stored)
+
+            claimed, row = await self.store.claim(key, fingerprint)
+            if claimed:
+                break
+            if row is None:
+                continue
+            if row["status"] == "completed":
+                stored = StoredResponse.from_row(row)
+                self.store.remember(key, stored)
+                continue
+            if row["fingerprint"] != fingerprint:
+                return await _send_error(send, 422, "Idempotency-Key was already used with a different request body")
+            # Held by another process; poll until it finishes or is released
+            if time.monotonic() >= deadline:
+                return await _send_error(send, 409, "A request with this Idempotency-Key is still in progress")
+            await asyncio.sleep(self.poll_interval)
+
+        await self._run(scope, body, receive, send, key, fingerprint)
+
+    async def _run(self, scope, body: bytes, receive, send, key: str, fingerprint: str) -> None:
+        body_sent = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        start: Dict[str, Any] = {}
+        chunks: List[bytes] = []
+        size = 0
+
+        async def capture_send(message):
+            nonlocal size
+            if message["type"] == "http.response.start":
+                start.update(message)
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+                if size <= MAX_STORED_BODY_BYTES:
+                    chunks.append(message.get("body", b""))
+            await send(message)
+
+        response = None
+        try:
+            await self.app(scope, replay_receive, capture_send)
+            status = start.get("status", 500)
+            if status < 500 and size <= MAX_STORED_BODY_BYTES:
+                response = StoredResponse(
+                    fingerprint,
+                    status,
+                    [(name.decode("latin-1"), value.decode("latin-1")) for name, value in start.get("headers", [])],
+                    b"".join(chunks)
+                )
+        finally:
+            try:
+                await asyncio.shield(self.store.finish(key, response))
+            except Exception as e:
+                logging.error(f"Failed to store idempotent response for {scope['path']}: {e}")
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+async def _replay(send, stored: StoredResponse) -> None:
+    headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in stored.headers]
+    headers.append((b"idempotent-replayed", b"true"))
+    await send({"type": "http.response.start", "status": stored.status, "headers": headers})
+    await send({"type": "http.response.body", "body": stored.body})
+
+async def _send_error(send, status: int, detail: str) -> None:
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+class JobWorkerPool:
+    """In-process pool of async workers draining a Postgres-backed queue.
+
+    `claim` atomically takes the next runnable job (or returns None) and `process`
+    handles it. Workers sleep for `poll_interval` when the queue is empty and are
+    woken early by `notify()` after an enqueue from the same process.
+    """
+
+    def __init__(
+        self,
+        claim: Callable[[], Awaitable[Optional[Dict[str, Any]]]],
+        process: Callable[[Dict[str, Any]], Awaitable[None]],
+        concurrency: int = 4,
+        poll_interval: float = 2.0,
+        name: str = "jobs"
+    ):
+        self.claim = claim
+        self.process = process
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.name = name
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._stopping = False
+        self._tasks = [
+            asyncio.create_task(self._run(i), name=f"{self.name}-worker-{i}")
+            for i in range(self.concurrency)
+        ]
+        logging.info(f"Started {self.concurrency} {self.name} workers")
+
+    async def stop(self) -> None:
+        self._stopping = True
+        self._wakeup.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    async def _run(self, worker_idx: int) -> None:
+        while not self._stopping:
+            try:
+                job = await self.claim()
+            except Exception as e:
+                logging.error(f"{self.name} worker {worker_idx} failed to claim a job: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self.process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"{self.name} worker {worker_idx} crashed processing {job.get('id')}: {e}")
+
+class PeriodicTask:
+    """Run `fn` every `interval` seconds in the background until stopped.
+
+    Exceptions are logged and the loop keeps going; the first run happens one
+    interval after `start()` so startup is not slowed down.
+    """
+
+    def __init__(self, fn: Callable[[], Awaitable[Any]], interval: float, name: str = "periodic"):
+        self.fn = fn
+        self.interval = interval
+        self.name = name
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name=self.name)
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.fn()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"{self.name} run failed: {e}")
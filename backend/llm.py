@@ -0,0 +1,471 @@
+import asyncio
+import json
+import logging
+import re
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+import httpx
+import openai
+
+DEFAULT_TIMEOUT_SECONDS = 120.0
+DEFAULT_MAX_TOKENS = 8192
+
+DEFAULT_MODELS = {
+    "openai": "gpt-5.2",
+    "claude": "claude-sonnet-4-5",
+    "anthropic": "claude-sonnet-4-5",
+    "gemini": "gemini-2.5-flash",
+    "mock": "mock",
+}
+
+class LLMProviderError(Exception):
+    """Raised by adapters. `retryable` marks timeouts, rate limits and 5xx responses
+    that are worth sending to another provider; auth and request errors are not."""
+
+    def __init__(self, provider: str, message: str, retryable: bool = False, status_code: Optional[int] = None):
+        super().__init__(f"{provider}: {message}")
+        self.provider = provider
+        self.retryable = retryable
+        self.status_code = status_code
+
+def _is_retryable_status(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+@dataclass
+class LLMTarget:
+    provider: str
+    model: str
+    api_key: Optional[str] = None
+
+def _strict_schema(schema: Any) -> Any:
+    """Copy of a JSON schema that OpenAI strict mode accepts: every object lists all of its
+    properties as required and allows no others. Optional fields stay nullable."""
+    if isinstance(schema, list):
+        return [_strict_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    strict = {key: _strict_schema(value) for key, value in schema.items() if key != "default"}
+    if "properties" in schema:
+        strict["required"] = list(schema["properties"])
+        strict["additionalProperties"] = False
+    return strict
+
+def openai_response_format(response_format: Dict[str, Any]) -> Dict[str, Any]:
+    """Chat Completions `response_format` for a provider-neutral name + schema pair"""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": response_format["name"],
+            "schema": _strict_schema(response_format["schema"]),
+            "strict": True
+        }
+    }
+
+# ============== Provider Adapters ==============
+
+class OpenAIProvider:
+    name = "openai"
+
+    async def complete(
+        self,
+        target: LLMTarget,
+        prompt: str,
+        system_message: Optional[str],
+        timeout: float,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> str:
+        client = openai.AsyncOpenAI(api_key=target.api_key, timeout=timeout, max_retries=0)
+        messages = []
+        if system_message:
+            messages.append({"role": "system", "content": system_message})
+        messages.append({"role": "user", "content": prompt})
+        kwargs = {}
+        if response_format:
+            kwargs["response_format"] = openai_response_format(response_format)
+        try:
+            response = await client.chat.completions.create(
+                model=target.model,
+                messages=messages,
+                temperature=0.7,
+                **kwargs
+            )
+        except openai.APIConnectionError as e:
+            # Includes APITimeoutError
+            raise LLMProviderError(self.name, str(e), retryable=True)
+        except openai.APIStatusError as e:
+            raise LLMProviderError(self.name, str(e), retryable=_is_retryable_status(e.status_code), status_code=e.status_code)
+        finally:
+            await client.close()
+        return response.choices[0].message.content
+
+class _HTTPProvider:
+    name = "http"
+
+    async def _post(self, url: str, headers: Dict[str, str], body: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        try:
+            async with httpx.AsyncClient(timeout=timeout) as client:
+                response = await client.post(url, headers=headers, json=body)
+        except httpx.TimeoutException as e:
+            raise LLMProviderError(self.name, f"timeout: {e}", retryable=True)
+        except httpx.TransportError as e:
+            raise LLMProviderError(self.name, f"transport error: {e}", retryable=True)
+
+        if response.status_code >= 400:
+            raise LLMProviderError(
+                self.name,
+                f"HTTP {response.status_code}: {response.text[:200]}",
+                retryable=_is_retryable_status(response.status_code),
+                status_code=response.status_code
+            )
+        return response.json()
+
+class ClaudeProvider(_HTTPProvider):
+    name = "claude"
+    url = "https://api.anthropic.com/v1/messages"
+
+    async def complete(
+        self,
+        target: LLMTarget,
+        prompt: str,
+        system_message: Optional[str],
+        timeout: float,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> str:
+        body = {
+            "model": target.model,
+            "max_tokens": DEFAULT_MAX_TOKENS,
+            "messages": [{"role": "user", "content": prompt}],
+        }
+        if system_message:
+            # The system message is the static prompt prefix; mark it cacheable
+            body["system"] = [{"type": "text", "text": system_message, "cache_control": {"type": "ephemeral"}}]
+        if response_format:
+            # Forcing a single tool call makes the tool input follow the schema
+            body["tools"] = [{"name": response_format["name"], "input_schema": response_format["schema"]}]
+            body["tool_choice"] = {"type": "tool", "name": response_format["name"]}
+        headers = {
+            "x-api-key": target.api_key or "",
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json",
+        }
+        data = await self._post(self.url, headers, body, timeout)
+        for block in data.get("content", []):
+            if block.get("type") == "tool_use":
+                return json.dumps(block.get("input", {}))
+        return "".join(block.get("text", "") for block in data.get("content", []) if block.get("type") == "text")
+
+class GeminiProvider(_HTTPProvider):
+    name = "gemini"
+    url = "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
+
+    async def complete(
+        self,
+        target: LLMTarget,
+        prompt: str,
+        system_message: Optional[str],
+        timeout: float,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> str:
+        body = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        if system_message:
+            body["systemInstruction"] = {"parts": [{"text": system_message}]}
+        if response_format:
+            body["generationConfig"] = {
+                "responseMimeType": "application/json",
+                "responseJsonSchema": response_format["schema"]
+            }
+        headers = {"x-goog-api-key": target.api_key or "", "content-type": "application/json"}
+        data = await self._post(self.url.format(model=target.model), headers, body, timeout)
+        candidates = data.get("candidates") or []
+        if not candidates:
+            raise LLMProviderError(self.name, "response contained no candidates")
+        parts = candidates[0].get("content", {}).get("parts", [])
+        return "".join(part.get("text", "") for part in parts)
+
+class MockProvider:
+    """Deterministic offline provider for local development and tests.
+
+    Answers in the JSON shapes the meal plan, regeneration, swap and supplement
+    prompts ask for, without touching the network.
+    """
+    name = "mock"
+
+    WEEK_DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+    MEAL_TYPES = ["breakfast", "lunch", "dinner", "snack"]
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def _recipe(self, name: str) -> Dict[str, Any]:
+        return {
+            "name": name,
+            "ingredients": ["2 cups rice", "1 lb chicken breast", "1 tbsp olive oil", "1 onion"],
+            "instructions": "1. Prep the ingredients\n2. Cook everything together\n3. Serve",
+            "prep_time": 10,
+            "cook_time": 20,
+            "servings": 2
+        }
+
+    def _day(self, day: str) -> Dict[str, Any]:
+        plan_day = {"day": day, "lunch_is_leftover": False}
+        for meal_type in self.MEAL_TYPES:
+            name = f"Mock {meal_type.title()} ({day})"
+            plan_day[meal_type] = name
+            if meal_type != "snack":
+                plan_day[f"{meal_type}_recipe"] = self._recipe(name)
+        return plan_day
+
+    async def complete(
+        self,
+        target: LLMTarget,
+        prompt: str,
+        system_message: Optional[str],
+        timeout: float,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        schema_name = (response_format or {}).get("name")
+        if schema_name == "meal_swap":
+            return json.dumps({"name": "Mock Swap Meal", "recipe": self._recipe("Mock Swap Meal")})
+        if '"recommendations"' in f"{system_message or ''}{prompt}":
+            return json.dumps({"recommendations": [
+                {"name": "Vitamin D3", "dosage": "1000 IU", "reason": "General support", "timing": "Morning with food"}
+            ]})
+        if schema_name == "meal_plan" or '"days"' in prompt:
+            days = [day for day in self.WEEK_DAYS if re.search(rf"\b{day}\b", prompt)] or self.WEEK_DAYS
+            return json.dumps({"days": [self._day(day) for day in days]})
+        return json.dumps({"name": "Mock Swap Meal", "recipe": self._recipe("Mock Swap Meal")})
+
+_claude = ClaudeProvider()
+
+PROVIDERS = {
+    "openai": OpenAIProvider(),
+    "claude": _claude,
+    "anthropic": _claude,
+    "gemini": GeminiProvider(),
+    "mock": MockProvider(),
+}
+
+# ============== Health Tracking ==============
+
+class ProviderHealth:
+    """Rolling latency window and failure counter for one provider.
+
+    After `failure_threshold` consecutive retryable failures the provider is
+    considered unhealthy for `cooldown_seconds`, during which the router tries
+    the fallback first.
+    """
+
+    def __init__(self, window: int = 100, failure_threshold: int = 3, cooldown_seconds: float = 30.0):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.consecutive_failures = 0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.last_failure_at: Optional[float] = None
+
+    def record_success(self, latency: float) -> None:
+        self.latencies.append(latency)
+        self.total_requests += 1
+        self.consecutive_failures = 0
+
+    def record_failure(self) -> None:
+        self.total_requests += 1
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        self.last_failure_at = time.monotonic()
+
+    @property
+    def healthy(self) -> bool:
+        if self.consecutive_failures < self.failure_threshold:
+            return True
+        return time.monotonic() - (self.last_failure_at or 0) >= self.cooldown_seconds
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        idx = min(len(ordered) - 1, int(round(pct * (len(ordered) - 1))))
+        return ordered[idx]
+
+    def snapshot(self) -> Dict[str, Any]:
+        p50 = self.percentile(0.5)
+        p95 = self.percentile(0.95)
+        return {
+            "healthy": self.healthy,
+            "samples": len(self.latencies),
+            "p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+        }
+
+# ============== Router ==============
+
+class LLMRouter:
+    """Send a prompt to the first healthy target, with fallback and hedging.
+
+    Targets are tried in order; unhealthy providers are moved to the back. A
+    retryable failure (timeout, 429, 5xx) moves on to the next target, anything
+    else is raised. Once a provider has `hedge_min_samples` latency samples, a
+    request still running past its `hedge_percentile` latency is duplicated to
+    the next target and whichever answers first wins.
+    """
+
+    def __init__(
+        self,
+        providers: Optional[Dict[str, Any]] = None,
+        timeout: float = DEFAULT_TIMEOUT_SECONDS,
+        hedge_percentile: float = 0.95,
+        hedge_min_samples: int = 20
+    ):
+        self.providers = providers or dict(PROVIDERS)
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.health: Dict[str, ProviderHealth] = {name: ProviderHealth() for name in self.providers}
+
+    def _health(self, provider: str) -> ProviderHealth:
+        if provider not in self.health:
+            self.health[provider] = ProviderHealth()
+        return self.health[provider]
+
+    def _order(self, targets: List[LLMTarget]) -> List[LLMTarget]:
+        known = [t for t in targets if t.provider in self.providers]
+        if not known:
+            raise LLMProviderError(targets[0].provider if targets else "none", "no supported provider configured")
+        healthy = [t for t in known if self._health(t.provider).healthy]
+        return healthy + [t for t in known if t not in healthy]
+
+    def _hedge_delay(self, provider: str) -> Optional[float]:
+        health = self._health(provider)
+        if len(health.latencies) < self.hedge_min_samples:
+            return None
+        return health.percentile(self.hedge_percentile)
+
+    async def _attempt(
+        self,
+        target: LLMTarget,
+        prompt: str,
+        system_message: Optional[str],
+        response_format: Optional[Dict[str, Any]],
+        before_attempt: Optional[Callable[[LLMTarget], None]] = None
+    ) -> str:
+        if before_attempt is not None:
+            # Admission hook; its exceptions propagate without counting against provider health
+            before_attempt(target)
+        adapter = self.providers[target.provider]
+        health = self._health(target.provider)
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(
+                adapter.complete(target, prompt, system_message, self.timeout, response_format),
+                timeout=self.timeout
+            )
+        except asyncio.TimeoutError:
+            health.record_failure()
+            raise LLMProviderError(target.provider, f"timed out after {self.timeout}s", retryable=True)
+        except LLMProviderError as e:
+            if e.retryable:
+                health.record_failure()
+            raise
+        health.record_success(time.monotonic() - started)
+        return result
+
+    async def _race(self, tasks: List[asyncio.Task]) -> str:
+        """Return the first successful result; raise the last error if all fail"""
+        pending = set(tasks)
+        last_error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def complete(
+        self,
+        targets: List[LLMTarget],
+        prompt: str,
+        system_message: Optional[str] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+        before_attempt: Optional[Callable[[LLMTarget], None]] = None
+    ) -> str:
+        """`before_attempt` is called with each target right before it is sent a request,
+        including fallbacks and hedges, e.g. to charge that target's rate limits"""
+        ordered = self._order(targets)
+        last_error: Optional[LLMProviderError] = None
+
+        idx = 0
+        while idx < len(ordered):
+            primary = ordered[idx]
+            backup = ordered[idx + 1] if idx + 1 < len(ordered) else None
+            primary_task = asyncio.create_task(self._attempt(primary, prompt, system_message, response_format, before_attempt))
+
+            hedge_delay = self._hedge_delay(primary.provider) if backup else None
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait({primary_task}, timeout=hedge_delay)
+                if not done:
+                    logging.info(f"Hedging slow {primary.provider} request to {backup.provider}")
+                    backup_task = asyncio.create_task(self._attempt(backup, prompt, system_message, response_format, before_attempt))
+                    try:
+                        return await self._race([primary_task, backup_task])
+                    except LLMProviderError as e:
+                        if not e.retryable:
+                            raise
+                        last_error = e
+                        idx += 2
+                        continue
+
+            try:
+                return await primary_task
+            except LLMProviderError as e:
+                if not e.retryable:
+                    raise
+                logging.error(f"LLM provider {primary.provider} failed, falling back: {e}")
+                last_error = e
+                idx += 1
+
+        raise last_error
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: health.snapshot() for name, health in self.health.items()}
+
+def targets_from_config(ai_config: Dict[str, Any], allow_mock: bool = False) -> List[LLMTarget]:
+    """Primary plus optional fallback target from an ai_configs row.
+    A mock fallback is only used when `allow_mock` is set."""
+    provider = ai_config.get("provider") or "openai"
+    targets = [LLMTarget(
+        provider=provider,
+        model=ai_config.get("model") or DEFAULT_MODELS.get(provider, ""),
+        api_key=ai_config.get("api_key")
+    )]
+    fallback = ai_config.get("fallback_provider")
+    if fallback and (ai_config.get("fallback_api_key") if fallback != "mock" else allow_mock):
+        targets.append(LLMTarget(
+            provider=fallback,
+            model=ai_config.get("fallback_model") or DEFAULT_MODELS.get(fallback, ""),
+            api_key=ai_config.get("fallback_api_key")
+        ))
+    return targets
+
+def has_llm_access(ai_config: Optional[Dict[str, Any]], allow_mock: bool = False) -> bool:
+    """Whether calls for this config can reach a provider. The mock provider counts only
+    when `allow_mock` is set, so a stored mock config never stands in for a real model."""
+    if not ai_config:
+        return False
+    if ai_config.get("provider") == "mock":
+        return allow_mock
+    return bool(ai_config.get("api_key"))
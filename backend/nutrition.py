@@ -0,0 +1,304 @@
+import hashlib
+import json
+import re
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    from . import shopping
+except ImportError:
+    import shopping
+
+NUTRIENTS = ["calories", "protein_g", "carbs_g", "fat_g", "fiber_g"]
+
+# Per 100 g edible portion: (kcal, protein, carbs, fat, fiber), density in g/ml and
+# grams per whole item for count units. Values rounded from USDA FoodData Central.
+NUTRIENT_TABLE: Dict[str, Tuple[Tuple[float, float, float, float, float], float, float]] = {
+    # Proteins
+    "chicken breast": ((165, 31.0, 0.0, 3.6, 0.0), 1.0, 175),
+    "chicken thigh": ((209, 26.0, 0.0, 10.9, 0.0), 1.0, 115),
+    "chicken": ((190, 27.0, 0.0, 8.0, 0.0), 1.0, 150),
+    "ground turkey": ((203, 27.4, 0.0, 10.4, 0.0), 1.0, 450),
+    "turkey": ((189, 28.5, 0.0, 7.4, 0.0), 1.0, 150),
+    "ground beef": ((250, 26.0, 0.0, 15.0, 0.0), 1.0, 450),
+    "steak": ((271, 25.0, 0.0, 19.0, 0.0), 1.0, 225),
+    "beef": ((250, 26.0, 0.0, 15.0, 0.0), 1.0, 225),
+    "pork": ((242, 27.0, 0.0, 14.0, 0.0), 1.0, 150),
+    "bacon": ((541, 37.0, 1.4, 42.0, 0.0), 1.0, 8),
+    "ham": ((145, 21.0, 1.5, 5.5, 0.0), 1.0, 28),
+    "salmon": ((208, 20.0, 0.0, 13.0, 0.0), 1.0, 170),
+    "tuna": ((132, 28.0, 0.0, 1.3, 0.0), 1.0, 140),
+    "cod": ((82, 18.0, 0.0, 0.7, 0.0), 1.0, 170),
+    "shrimp": ((99, 24.0, 0.2, 0.3, 0.0), 1.0, 6),
+    "tofu": ((144, 15.7, 3.5, 8.7, 2.3), 1.03, 400),
+    "tempeh": ((192, 20.3, 7.6, 10.8, 0.0), 1.0, 225),
+    "egg white": ((52, 10.9, 0.7, 0.2, 0.0), 1.03, 33),
+    "egg": ((143, 12.6, 0.7, 9.5, 0.0), 1.03, 50),
+    # Dairy
+    "greek yogurt": ((97, 9.0, 3.9, 5.0, 0.0), 1.05, 170),
+    "yogurt": ((61, 3.5, 4.7, 3.3, 0.0), 1.05, 170),
+    "milk": ((61, 3.2, 4.8, 3.3, 0.0), 1.03, 240),
+    "cottage cheese": ((98, 11.1, 3.4, 4.3, 0.0), 1.0, 225),
+    "cheddar": ((403, 24.9, 1.3, 33.1, 0.0), 0.5, 28),
+    "mozzarella": ((280, 28.0, 3.1, 17.0, 0.0), 0.45, 28),
+    "parmesan": ((431, 38.5, 4.1, 28.6, 0.0), 0.4, 5),
+    "feta": ((264, 14.2, 4.1, 21.3, 0.0), 0.6, 28),
+    "cheese": ((380, 23.0, 2.0, 31.0, 0.0), 0.5, 28),
+    "butter": ((717, 0.9, 0.1, 81.1, 0.0), 0.96, 14),
+    "heavy cream": ((340, 2.8, 2.7, 36.0, 0.0), 1.0, 240),
+    "sour cream": ((198, 2.4, 4.6, 19.4, 0.0), 1.0, 240),
+    # Grains and starches
+    "brown rice": ((123, 2.7, 25.6, 1.0, 1.6), 0.8, 195),
+    "rice": ((130, 2.7, 28.2, 0.3, 0.4), 0.8, 185),
+    "quinoa": ((120, 4.4, 21.3, 1.9, 2.8), 0.78, 185),
+    "oats": ((389, 16.9, 66.3, 6.9, 10.6), 0.34, 80),
+    "pasta": ((371, 13.0, 74.7, 1.5, 3.2), 0.42, 85),
+    "spaghetti": ((371, 13.0, 74.7, 1.5, 3.2), 0.42, 85),
+    "noodle": ((138, 4.5, 25.0, 2.1, 1.2), 0.6, 160),
+    "bread": ((265, 9.0, 49.0, 3.2, 2.7), 0.25, 30),
+    "tortilla": ((306, 8.0, 50.0, 8.0, 3.5), 0.5, 45),
+    "flour": ((364, 10.3, 76.3, 1.0, 2.7), 0.53, 125),
+    "potato": ((77, 2.0, 17.5, 0.1, 2.2), 0.65, 210),
+    "sweet potato": ((86, 1.6, 20.1, 0.1, 3.0), 0.65, 130),
+    "couscous": ((112, 3.8, 23.2, 0.2, 1.4), 0.7, 175),
+    "granola": ((471, 10.0, 64.0, 20.0, 7.0), 0.45, 60),
+    # Legumes, nuts, seeds
+    "black beans": ((132, 8.9, 23.7, 0.5, 8.7), 0.75, 425),
+    "chickpeas": ((164, 8.9, 27.4, 2.6, 7.6), 0.7, 425),
+    "lentils": ((116, 9.0, 20.1, 0.4, 7.9), 0.8, 200),
+    "beans": ((127, 8.7, 22.8, 0.5, 6.4), 0.75, 425),
+    "peanut butter": ((588, 25.1, 20.0, 50.4, 6.0), 1.09, 16),
+    "almond butter": ((614, 21.0, 18.8, 55.5, 10.3), 1.06, 16),
+    "almonds": ((579, 21.2, 21.6, 49.9, 12.5), 0.6, 1.2),
+    "walnuts": ((654, 15.2, 13.7, 65.2, 6.7), 0.42, 4),
+    "chia seeds": ((486, 16.5, 42.1, 30.7, 34.4), 0.65, 12),
+    "hummus": ((166, 7.9, 14.3, 9.6, 6.0), 1.0, 30),
+    # Vegetables
+    "spinach": ((23, 2.9, 3.6, 0.4, 2.2), 0.13, 30),
+    "kale": ((49, 4.3, 8.8, 0.9, 3.6), 0.11, 35),
+    "lettuce": ((15, 1.4, 2.9, 0.2, 1.3), 0.2, 300),
+    "broccoli": ((34, 2.8, 6.6, 0.4, 2.6), 0.38, 150),
+    "cauliflower": ((25, 1.9, 5.0, 0.3, 2.0), 0.45, 575),
+    "bell pepper": ((31, 1.0, 6.0, 0.3, 2.1), 0.55, 120),
+    "onion": ((40, 1.1, 9.3, 0.1, 1.7), 0.65, 110),
+    "garlic": ((149, 6.4, 33.1, 0.5, 2.1), 0.6, 3),
+    "tomato": ((18, 0.9, 3.9, 0.2, 1.2), 0.75, 120),
+    "cucumber": ((15, 0.7, 3.6, 0.1, 0.5), 0.55, 300),
+    "carrot": ((41, 0.9, 9.6, 0.2, 2.8), 0.55, 60),
+    "zucchini": ((17, 1.2, 3.1, 0.3, 1.0), 0.5, 200),
+    "mushroom": ((22, 3.1, 3.3, 0.3, 1.0), 0.3, 18),
+    "avocado": ((160, 2.0, 8.5, 14.7, 6.7), 0.6, 150),
+    "corn": ((86, 3.3, 19.0, 1.4, 2.0), 0.7, 100),
+    "green beans": ((31, 1.8, 7.0, 0.2, 2.7), 0.45, 5),
+    "peas": ((81, 5.4, 14.5, 0.4, 5.1), 0.6, 145),
+    "asparagus": ((20, 2.2, 3.9, 0.1, 2.1), 0.5, 16),
+    "celery": ((16, 0.7, 3.0, 0.2, 1.6), 0.5, 40),
+    "cabbage": ((25, 1.3, 5.8, 0.1, 2.5), 0.4, 900),
+    # Fruit
+    "banana": ((89, 1.1, 22.8, 0.3, 2.6), 0.6, 118),
+    "apple": ((52, 0.3, 13.8, 0.2, 2.4), 0.55, 180),
+    "blueberries": ((57, 0.7, 14.5, 0.3, 2.4), 0.6, 1.5),
+    "strawberries": ((32, 0.7, 7.7, 0.3, 2.0), 0.6, 12),
+    "berries": ((50, 0.7, 12.0, 0.3, 3.0), 0.6, 1.5),
+    "lemon": ((29, 1.1, 9.3, 0.3, 2.8), 1.03, 60),
+    "lime": ((30, 0.7, 10.5, 0.2, 2.8), 1.03, 45),
+    "orange": ((47, 0.9, 11.8, 0.1, 2.4), 0.6, 130),
+    # Fats, sweeteners, condiments
+    "olive oil": ((884, 0.0, 0.0, 100.0, 0.0), 0.91, 14),
+    "coconut oil": ((862, 0.0, 0.0, 100.0, 0.0), 0.92, 14),
+    "oil": ((884, 0.0, 0.0, 100.0, 0.0), 0.92, 14),
+    "honey": ((304, 0.3, 82.4, 0.0, 0.2), 1.42, 21),
+    "maple syrup": ((260, 0.0, 67.0, 0.1, 0.0), 1.32, 20),
+    "sugar": ((387, 0.0, 100.0, 0.0, 0.0), 0.85, 4),
+    "soy sauce": ((53, 8.1, 4.9, 0.6, 0.8), 1.15, 16),
+    "protein powder": ((400, 80.0, 8.0, 6.0, 0.0), 0.4, 30),
+    "coconut milk": ((197, 2.0, 2.8, 21.3, 0.0), 1.0, 400),
+    "almond milk": ((15, 0.6, 0.3, 1.2, 0.0), 1.03, 240),
+    "salsa": ((36, 1.5, 7.0, 0.2, 1.9), 1.0, 16),
+    "tomato sauce": ((29, 1.3, 6.0, 0.2, 1.5), 1.03, 425),
+    "chicken broth": ((6, 0.6, 0.4, 0.2, 0.0), 1.0, 400),
+}
+
+# Preparation words that do not change what the ingredient is
+_DESCRIPTORS = re.compile(
+    r"\b(large|medium|small|fresh|frozen|chopped|diced|minced|sliced|cooked|uncooked|raw|dried|"
+    r"boneless|skinless|lean|extra[- ]virgin|organic|low[- ]fat|plain|shredded|grated|ripe|whole|"
+    r"rolled|canned|drained|rinsed|to taste|for serving|optional)\b",
+    re.IGNORECASE
+)
+_TABLE_KEYS = sorted(NUTRIENT_TABLE, key=len, reverse=True)
+_TABLE_PATTERN = re.compile(r"\b(" + "|".join(re.escape(k) for k in _TABLE_KEYS) + r")(?:e?s)?\b")
+_KEY_INDEX = {key: i for i, key in enumerate(NUTRIENT_TABLE)}
+
+# Nutrients per gram, one row per table entry
+NUTRIENT_MATRIX = np.array([values for values, _, _ in NUTRIENT_TABLE.values()], dtype=np.float64) / 100.0
+_DENSITY = np.array([density for _, density, _ in NUTRIENT_TABLE.values()], dtype=np.float64)
+_ITEM_GRAMS = np.array([item for _, _, item in NUTRIENT_TABLE.values()], dtype=np.float64)
+
+COUNT_UNITS = {"unit", "piece", "clove", "slice", "stalk", "whole", "can", "package", "bottle", ""}
+
+def canonical_ingredient(name: str) -> Optional[str]:
+    """Table key for a free-text ingredient name, or None when it is not in the table"""
+    cleaned = _DESCRIPTORS.sub(" ", (name or "").lower())
+    match = _TABLE_PATTERN.search(cleaned)
+    return match.group(1) if match else None
+
+def _grams(key: str, quantity: float, unit: str) -> float:
+    idx = _KEY_INDEX[key]
+    amount, base = shopping.to_base_unit(quantity, unit)
+    if base == "g":
+        return amount
+    if base == "ml":
+        return amount * _DENSITY[idx]
+    if base in COUNT_UNITS:
+        return amount * _ITEM_GRAMS[idx]
+    # Unknown unit ("pinch", "handful"): too small or vague to count
+    return 0.0
+
+def recipe_hash(recipe: Optional[dict]) -> str:
+    recipe = recipe or {}
+    payload = json.dumps(
+        {"ingredients": recipe.get("ingredients") or [], "servings": recipe.get("servings")},
+        sort_keys=True,
+        default=str
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _as_dict(vector: np.ndarray) -> Dict[str, float]:
+    return {name: round(float(value), 1) for name, value in zip(NUTRIENTS, vector)}
+
+class NutritionEngine:
+    """Compute per-serving macros for recipes and roll them up over a plan.
+
+    Each uncached recipe becomes one row of grams-per-serving over the nutrient
+    table; a single matrix product against the per-gram nutrient matrix gives all
+    their macros at once. Per-serving vectors are cached by recipe hash, so plans
+    that share recipes (and repeated reads of the same plan) skip the work.
+    """
+
+    def __init__(self, cache_size: int = 4096):
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Tuple[np.ndarray, float]]" = OrderedDict()
+
+    def _cache_get(self, key: str) -> Optional[Tuple[np.ndarray, float]]:
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        return None
+
+    def _cache_put(self, key: str, value: Tuple[np.ndarray, float]) -> None:
+        self._cache[key] = value
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def per_serving(self, recipes: List[Optional[dict]]) -> List[Tuple[np.ndarray, float]]:
+        """(nutrient vector per serving, fraction of ingredients recognised) per recipe"""
+        results: List[Optional[Tuple[np.ndarray, float]]] = [None] * len(recipes)
+        hashes = [recipe_hash(r) for r in recipes]
+        pending: Dict[str, List[int]] = {}
+        for i, h in enumerate(hashes):
+            cached = self._cache_get(h)
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.setdefault(h, []).append(i)
+
+        if pending:
+            order = list(pending)
+            grams = np.zeros((len(order), len(NUTRIENT_TABLE)), dtype=np.float64)
+            coverage = np.ones(len(order), dtype=np.float64)
+            for row, h in enumerate(order):
+                recipe = recipes[pending[h][0]] or {}
+                servings = max(1, int(recipe.get("servings") or 1))
+                ingredients = recipe.get("ingredients") or []
+                known = 0
+                for ingredient in ingredients:
+                    parsed = shopping.parse_ingredient(ingredient)
+                    key = canonical_ingredient(parsed["name"]) if parsed else None
+                    if key is None:
+                        continue
+                    known += 1
+                    grams[row, _KEY_INDEX[key]] += _grams(key, float(parsed["quantity"] or 0), parsed["unit"]) / servings
+                if ingredients:
+                    coverage[row] = known / len(ingredients)
+
+            vectors = grams @ NUTRIENT_MATRIX
+            for row, h in enumerate(order):
+                value = (vectors[row], float(coverage[row]))
+                self._cache_put(h, value)
+                for i in pending[h]:
+                    results[i] = value
+
+        return results
+
+    def meal_nutrition(self, meal: dict) -> Dict[str, float]:
+        vector, _ = self.per_serving([{"ingredients": meal.get("ingredients"), "servings": meal.get("servings")}])[0]
+        return _as_dict(vector)
+
+    def plan_nutrition(self, plan_days: List[dict]) -> Dict[str, Any]:
+        """Per-meal, per-day and weekly macros for one person eating the plan"""
+        slots: List[Tuple[str, str]] = []
+        recipes: List[dict] = []
+        previous_dinner = None
+        for day in plan_days:
+            day_recipes = day.get("recipes") or {}
+            for meal_type in shopping.MEAL_TYPES:
+                recipe = day_recipes.get(meal_type)
+                if recipe is None and meal_type == "lunch" and (day.get("is_leftover") or {}).get("lunch"):
+                    recipe = previous_dinner
+                if recipe and recipe.get("ingredients"):
+                    slots.append((day["day"], meal_type))
+                    recipes.append(recipe)
+            previous_dinner = day_recipes.get("dinner")
+
+        day_names = [day["day"] for day in plan_days]
+        if not recipes:
+            zero = _as_dict(np.zeros(len(NUTRIENTS)))
+            return {"meals": {}, "days": {d: zero for d in day_names}, "week": zero, "daily_average": zero, "coverage": 0.0}
+
+        computed = self.per_serving(recipes)
+        meal_matrix = np.vstack([vector for vector, _ in computed])
+        coverage = float(np.mean([c for _, c in computed]))
+
+        # Day totals are one more matrix product: (days x slots) indicator @ (slots x nutrients)
+        day_index = {name: i for i, name in enumerate(day_names)}
+        membership = np.zeros((len(day_names), len(slots)), dtype=np.float64)
+        for col, (day_name, _) in enumerate(slots):
+            membership[day_index[day_name], col] = 1.0
+        day_matrix = membership @ meal_matrix
+        week = day_matrix.sum(axis=0)
+
+        meals: Dict[str, Dict[str, Dict[str, float]]] = {}
+        for (day_name, meal_type), vector in zip(slots, meal_matrix):
+            meals.setdefault(day_name, {})[meal_type] = _as_dict(vector)
+
+        return {
+            "meals": meals,
+            "days": {name: _as_dict(day_matrix[i]) for i, name in enumerate(day_names)},
+            "week": _as_dict(week),
+            "daily_average": _as_dict(week / max(1, len(day_names))),
+            "coverage": round(coverage, 2),
+        }
+
+# Daily targets per goal: nutrient -> (min, max); None means unbounded
+GOAL_TARGETS = {
+    "lose_weight": {"calories": (None, 1900), "protein_g": (100, None)},
+    "gain_weight": {"calories": (2600, None)},
+    "gain_muscle": {"protein_g": (130, None), "calories": (2300, None)},
+    "eat_healthy": {"fiber_g": (25, None)},
+    "increase_energy": {"carbs_g": (200, None)},
+    "improve_digestion": {"fiber_g": (30, None)},
+}
+
+def goal_check(goal: Optional[str], daily_average: Dict[str, float]) -> Optional[Dict[str, Any]]:
+    targets = GOAL_TARGETS.get(goal)
+    if not targets:
+        return None
+    checks = []
+    for nutrient, (low, high) in targets.items():
+        actual = daily_average.get(nutrient, 0.0)
+        ok = (low is None or actual >= low) and (high is None or actual <= high)
+        checks.append({"nutrient": nutrient, "min": low, "max": high, "actual": actual, "ok": ok})
+    return {"goal": goal, "met": all(c["ok"] for c in checks), "checks": checks}
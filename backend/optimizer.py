@@ -0,0 +1,96 @@
+from typing import Any, Dict, FrozenSet, List, Tuple
+
+# Slot: (day, meal_type, ingredient names, movable)
+Slot = Tuple[str, str, FrozenSet[str], bool]
+# Candidate: (index into the caller's meal list, name, ingredient names, meal types it fits)
+OptimizerCandidate = Tuple[int, str, FrozenSet[str], FrozenSet[str]]
+
+def _popcount(mask: int) -> int:
+    return mask.bit_count()
+
+def _waste(masks: List[int]) -> Dict[str, Any]:
+    """Single-use ingredients are the ones most likely to be bought in a package
+    and only partly used, so their share is the waste estimate"""
+    seen_once = seen_twice = 0
+    for mask in masks:
+        seen_twice |= seen_once & mask
+        seen_once |= mask
+    single_use = _popcount(seen_once & ~seen_twice)
+    distinct = _popcount(seen_once)
+    return {
+        "single_use_ingredients": single_use,
+        "waste_ratio": round(single_use / distinct, 3) if distinct else 0.0,
+    }
+
+def optimize_plan(slots: List[Slot], candidates: List[OptimizerCandidate], max_swaps: int = 5) -> Dict[str, Any]:
+    """Greedy set-cover over ingredient bitsets.
+
+    Every ingredient name gets a bit, so each meal is one integer mask and the
+    shopping list is the OR of all slot masks. A slot's exclusive cost is the
+    number of bits only it contributes; each round picks the (slot, candidate)
+    replacement with the largest drop in distinct ingredients and applies it,
+    until nothing improves or `max_swaps` is reached. Pure function of plain
+    tuples so it can run in a worker process.
+    """
+    bit: Dict[str, int] = {}
+    def mask_of(names: FrozenSet[str]) -> int:
+        mask = 0
+        for name in names:
+            if name not in bit:
+                bit[name] = len(bit)
+            mask |= 1 << bit[name]
+        return mask
+
+    slots = list(slots)
+    slot_masks = [mask_of(names) for _, _, names, _ in slots]
+    candidate_masks = [mask_of(names) for _, _, names, _ in candidates]
+
+    before = _popcount(_union(slot_masks))
+    waste_before = _waste(slot_masks)
+    in_plan = set()
+    swaps = []
+
+    for _ in range(max_swaps):
+        best = None
+        for s_idx, (day, meal_type, _, movable) in enumerate(slots):
+            if not movable:
+                continue
+            others = _union(slot_masks[:s_idx] + slot_masks[s_idx + 1:])
+            current_cost = _popcount(slot_masks[s_idx] & ~others)
+            if current_cost == 0:
+                continue
+            for c_idx, (_, name, _, fits) in enumerate(candidates):
+                if meal_type not in fits or c_idx in in_plan:
+                    continue
+                saved = current_cost - _popcount(candidate_masks[c_idx] & ~others)
+                if saved > 0 and (best is None or saved > best[0]):
+                    best = (saved, s_idx, c_idx)
+        if best is None:
+            break
+
+        saved, s_idx, c_idx = best
+        day, meal_type, _, _ = slots[s_idx]
+        swaps.append({
+            "day": day,
+            "meal_type": meal_type,
+            "candidate": candidates[c_idx][0],
+            "to": candidates[c_idx][1],
+            "ingredients_saved": saved,
+        })
+        slot_masks[s_idx] = candidate_masks[c_idx]
+        slots[s_idx] = (day, meal_type, candidates[c_idx][2], False)
+        in_plan.add(c_idx)
+
+    return {
+        "distinct_ingredients_before": before,
+        "distinct_ingredients_after": _popcount(_union(slot_masks)),
+        "waste_before": waste_before,
+        "waste_after": _waste(slot_masks),
+        "swaps": swaps,
+    }
+
+def _union(masks: List[int]) -> int:
+    union = 0
+    for mask in masks:
+        union |= mask
+    return union
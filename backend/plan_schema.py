@@ -0,0 +1,166 @@
+import json
+import re
+from typing import Any, Dict, List, Optional, Type, TypeVar, Union
+
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
+
+T = TypeVar("T", bound=BaseModel)
+
+class StructuredOutputError(ValueError):
+    """The model response could not be parsed into the schema, even after repair"""
+
+# ============== Schema ==============
+
+class AIRecipe(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    ingredients: List[str] = []
+    instructions: str = ""
+    prep_time: Optional[Union[int, str]] = None
+    cook_time: Optional[Union[int, str]] = None
+    servings: Optional[int] = None
+
+    @field_validator("ingredients", mode="before")
+    @classmethod
+    def _ingredients_as_strings(cls, value: Any) -> Any:
+        if isinstance(value, list):
+            return [item if isinstance(item, str) else json.dumps(item) for item in value if item is not None]
+        return value
+
+    @field_validator("instructions", mode="before")
+    @classmethod
+    def _join_instruction_steps(cls, value: Any) -> Any:
+        if isinstance(value, list):
+            return "\n".join(
+                str(step) if re.match(r"\d+[.)]", str(step)) else f"{i}. {step}"
+                for i, step in enumerate(value, 1)
+            )
+        return value or ""
+
+    @field_validator("servings", mode="before")
+    @classmethod
+    def _servings_number(cls, value: Any) -> Any:
+        if isinstance(value, str):
+            match = re.search(r"\d+", value)
+            return int(match.group()) if match else None
+        return value
+
+class AIPlanDay(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    day: Optional[str] = None
+    breakfast: Optional[str] = None
+    breakfast_recipe: Optional[AIRecipe] = None
+    lunch: Optional[str] = None
+    lunch_is_leftover: Optional[bool] = None
+    lunch_recipe: Optional[AIRecipe] = None
+    dinner: Optional[str] = None
+    dinner_recipe: Optional[AIRecipe] = None
+    snack: Optional[str] = None
+
+class AIMealPlan(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    days: List[AIPlanDay] = []
+
+class AIMealSwap(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    name: str
+    recipe: Optional[AIRecipe] = None
+
+def response_format(name: str, model: Type[BaseModel]) -> Dict[str, Any]:
+    """Provider-neutral structured output request: a name plus the JSON schema"""
+    return {"name": name, "schema": model.model_json_schema()}
+
+MEAL_PLAN_FORMAT = response_format("meal_plan", AIMealPlan)
+MEAL_SWAP_FORMAT = response_format("meal_swap", AIMealSwap)
+
+# ============== Parsing ==============
+
+_CODE_FENCE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL)
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+_CLOSERS = {"{": "}", "[": "]"}
+
+def _strip_trailing_commas(text: str) -> str:
+    """Remove commas directly before a closing bracket, ignoring string contents"""
+    out = []
+    in_string = escaped = False
+    for i, ch in enumerate(text):
+        if in_string:
+            out.append(ch)
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch == "," and _TRAILING_COMMA.match(text, i):
+            continue
+        out.append(ch)
+    return "".join(out)
+
+def _close_truncated(text: str) -> str:
+    """Cut a truncated document back to its last complete element and close it.
+
+    Tracks the open brackets outside strings. When the text ends with brackets
+    still open, everything after the last comma is dropped (the element being
+    written when output stopped) and the remaining brackets are closed in order.
+    """
+    stack: List[str] = []
+    in_string = escaped = False
+    last_comma: Optional[tuple] = None
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in _CLOSERS:
+            stack.append(ch)
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                return text[:i + 1]
+        elif ch == "," and stack:
+            last_comma = (i, list(stack))
+
+    if not stack:
+        return text
+    if last_comma is not None:
+        cut, stack = last_comma
+        text = text[:cut]
+    elif in_string:
+        text += '"'
+    return text + "".join(_CLOSERS[opener] for opener in reversed(stack))
+
+def repair_json(text: str) -> str:
+    """Fix the defects models commonly produce: prose or code fences around the
+    JSON, trailing commas and output truncated mid-array"""
+    fenced = _CODE_FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    start = text.find("{")
+    if start == -1:
+        raise StructuredOutputError("response contains no JSON object")
+    return _strip_trailing_commas(_close_truncated(text[start:]))
+
+def parse_structured(model: Type[T], raw: Union[str, bytes, None]) -> T:
+    """Validate a model response against `model`, repairing it locally if needed"""
+    if raw is None:
+        raise StructuredOutputError("empty response")
+    try:
+        return model.model_validate_json(raw)
+    except ValidationError:
+        pass
+
+    text = raw.decode("utf-8", errors="replace") if isinstance(raw, bytes) else raw
+    try:
+        return model.model_validate_json(repair_json(text))
+    except ValidationError as e:
+        raise StructuredOutputError(f"response does not match {model.__name__}: {e.error_count()} errors") from e
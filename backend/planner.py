@@ -0,0 +1,154 @@
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+MEAL_TYPES = ["breakfast", "lunch", "dinner", "snack"]
+
+# Weights for the greedy score: reward shared ingredients, charge for new ones
+OVERLAP_WEIGHT = 2.0
+NEW_INGREDIENT_COST = 1.0
+REPEAT_PENALTY = 100.0
+MAX_IMPROVEMENT_ROUNDS = 3
+
+@dataclass(frozen=True)
+class Candidate:
+    meal: dict
+    name: str
+    ingredients: FrozenSet[str]
+    tags: FrozenSet[str]
+
+    def fits_slot(self, meal_type: str) -> bool:
+        # Meals tagged with a meal type only go in those slots; untagged meals go anywhere
+        slot_tags = self.tags & set(MEAL_TYPES)
+        return not slot_tags or meal_type in slot_tags
+
+def build_candidates(
+    meals: Iterable[dict],
+    ingredient_names: Callable[[dict], Set[str]],
+    cooking_methods: List[str],
+    dietary_prefs: List[str],
+    restrictions: List[str]
+) -> List[Candidate]:
+    """Turn stored meals into planner candidates that satisfy the user's constraints.
+
+    Restrictions (allergies) and dietary preferences are hard filters: a meal is
+    dropped if a restriction appears in its name or ingredients, and it must carry
+    every dietary preference as a tag. The cooking method filter is relaxed when
+    no stored meal matches it.
+    """
+    restrictions = [r.lower() for r in restrictions if r]
+    prefs = {p.lower() for p in dietary_prefs if p}
+
+    candidates = []
+    for meal in meals:
+        name = meal.get("name") or ""
+        ingredients = frozenset(i.lower() for i in ingredient_names(meal))
+        tags = frozenset(str(t).lower() for t in (meal.get("tags") or []))
+        if any(r in name.lower() or any(r in i for i in ingredients) for r in restrictions):
+            continue
+        if not prefs <= tags:
+            continue
+        candidates.append(Candidate(meal=meal, name=name, ingredients=ingredients, tags=tags))
+
+    if cooking_methods:
+        by_method = [c for c in candidates if c.meal.get("cooking_method") in cooking_methods]
+        if by_method:
+            candidates = by_method
+
+    # Stable order so equal scores always resolve the same way
+    candidates.sort(key=lambda c: (c.name.lower(), c.meal.get("id", "")))
+    return candidates
+
+def _score(candidate: Candidate, used: Counter, names_used: Counter) -> float:
+    overlap = sum(1 for i in candidate.ingredients if used[i])
+    new = len(candidate.ingredients) - overlap
+    return OVERLAP_WEIGHT * overlap - NEW_INGREDIENT_COST * new - REPEAT_PENALTY * names_used[candidate.name.lower()]
+
+def plan_slots(
+    candidates: List[Candidate],
+    targets: Dict[str, List[str]],
+    day_order: List[str],
+    kept_ingredients: Iterable[str] = (),
+    kept_names: Iterable[str] = (),
+    use_leftovers: bool = False
+) -> Dict[str, Dict[str, Tuple[Candidate, bool]]]:
+    """Fill the target slots from the candidates, maximizing ingredient overlap.
+
+    Greedy pass in day order picks the candidate that shares the most ingredients
+    with everything already planned (kept meals included) and adds the fewest new
+    ones, avoiding repeats within the week. With `use_leftovers`, a targeted lunch
+    after a dinner chosen in this run reuses that dinner. A few rounds of local
+    search then swap single slots whenever that lowers the distinct ingredient
+    count. Returns {day: {meal_type: (candidate, is_leftover)}}.
+    """
+    used: Counter = Counter(kept_ingredients)
+    names_used: Counter = Counter(n.lower() for n in kept_names if n)
+    by_slot = {meal_type: [c for c in candidates if c.fits_slot(meal_type)] for meal_type in MEAL_TYPES}
+
+    assignment: Dict[str, Dict[str, Tuple[Candidate, bool]]] = {}
+    previous_dinner: Optional[Candidate] = None
+    for day in day_order:
+        meal_types = targets.get(day)
+        if not meal_types:
+            previous_dinner = None
+            continue
+        chosen: Dict[str, Tuple[Candidate, bool]] = {}
+        for meal_type in MEAL_TYPES:
+            if meal_type not in meal_types:
+                continue
+            if meal_type == "lunch" and use_leftovers and previous_dinner is not None:
+                chosen["lunch"] = (previous_dinner, True)
+                continue
+            pool = by_slot[meal_type]
+            if not pool:
+                continue
+            best = max(pool, key=lambda c: _score(c, used, names_used))
+            chosen[meal_type] = (best, False)
+            used.update(best.ingredients)
+            names_used[best.name.lower()] += 1
+        assignment[day] = chosen
+        previous_dinner = chosen["dinner"][0] if "dinner" in chosen else None
+
+    _improve(assignment, by_slot, used, names_used)
+    return assignment
+
+def _improve(
+    assignment: Dict[str, Dict[str, Tuple[Candidate, bool]]],
+    by_slot: Dict[str, List[Candidate]],
+    used: Counter,
+    names_used: Counter
+) -> None:
+    """Single-slot swaps that reduce the distinct ingredient count, in place"""
+    leftover_sources = set()
+    days = list(assignment)
+    for idx, day in enumerate(days):
+        lunch = assignment[day].get("lunch")
+        if lunch and lunch[1] and idx > 0:
+            leftover_sources.add((days[idx - 1], "dinner"))
+
+    for _ in range(MAX_IMPROVEMENT_ROUNDS):
+        improved = False
+        for day in days:
+            for meal_type, (current, is_leftover) in list(assignment[day].items()):
+                # Leftovers and the dinners feeding them move together; leave them be
+                if is_leftover or (day, meal_type) in leftover_sources:
+                    continue
+                used.subtract(current.ingredients)
+                names_used[current.name.lower()] -= 1
+                current_cost = sum(1 for i in current.ingredients if used[i] <= 0)
+
+                best, best_cost = current, current_cost
+                for candidate in by_slot[meal_type]:
+                    if candidate is current or names_used[candidate.name.lower()] > 0:
+                        continue
+                    cost = sum(1 for i in candidate.ingredients if used[i] <= 0)
+                    if cost < best_cost:
+                        best, best_cost = candidate, cost
+
+                used.update(best.ingredients)
+                names_used[best.name.lower()] += 1
+                if best is not current:
+                    assignment[day][meal_type] = (best, False)
+                    improved = True
+        if not improved:
+            break
@@ -0,0 +1,252 @@
+import logging
+import math
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _encoding = None
+
+def count_tokens(text: str) -> int:
+    """Token count with tiktoken when installed, otherwise the ~4 chars/token estimate"""
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return math.ceil(len(text) / 4)
+
+MEAL_GOALS = {
+    "lose_weight": "focused on calorie deficit, high protein, lower carbs for weight loss",
+    "gain_weight": "calorie surplus with nutrient-dense foods for healthy weight gain",
+    "gain_muscle": "high protein (1g per lb bodyweight), balanced carbs and fats for muscle building",
+    "eat_healthy": "balanced nutrition, whole foods, variety of nutrients",
+    "increase_energy": "complex carbs, B vitamins, sustained energy foods",
+    "improve_digestion": "fiber-rich, probiotic foods, gentle on stomach"
+}
+
+SUPPLEMENT_GOALS = {
+    "lose_weight": "weight loss, fat burning, metabolism boost",
+    "gain_weight": "healthy weight gain, muscle building, calorie increase",
+    "gain_muscle": "muscle growth, strength, recovery, protein synthesis",
+    "eat_healthy": "overall health, wellness, nutritional balance",
+    "increase_energy": "energy boost, reduce fatigue, vitality",
+    "improve_digestion": "digestive health, gut health, nutrient absorption",
+    "better_sleep": "sleep quality, relaxation, recovery",
+    "reduce_stress": "stress management, mood support, mental clarity",
+    "boost_immunity": "immune system support, illness prevention",
+    "joint_health": "joint support, flexibility, inflammation reduction"
+}
+
+def meal_goal_text(goal: Optional[str]) -> str:
+    return MEAL_GOALS.get(goal, "balanced nutrition")
+
+def supplement_goal_text(goal: Optional[str]) -> str:
+    return SUPPLEMENT_GOALS.get(goal, "general wellness")
+
+@dataclass
+class Prompt:
+    """A prompt split into a static, cacheable prefix and the per-request context.
+
+    `system` never changes between requests of the same kind, so providers can
+    serve it from their prompt cache; everything user-specific lives in `user`.
+    """
+    name: str
+    system: str
+    user: str
+    static_tokens: int
+
+    @property
+    def dynamic_tokens(self) -> int:
+        return count_tokens(self.user)
+
+    @property
+    def total_tokens(self) -> int:
+        return self.static_tokens + self.dynamic_tokens
+
+    def log_usage(self) -> None:
+        logging.info(
+            f"Prompt {self.name}: {self.total_tokens} tokens "
+            f"({self.static_tokens} cacheable prefix, {self.dynamic_tokens} per-request)"
+        )
+
+def _static(text: str) -> tuple:
+    text = text.strip()
+    return text, count_tokens(text)
+
+# ============== Meal Plans ==============
+
+_RECIPE_EXAMPLE = """{
+  "ingredients": ["2 large eggs", "1 cup spinach", "1/4 cup feta cheese", "1 tbsp olive oil", "Salt and pepper to taste"],
+  "instructions": "1. Heat olive oil in a non-stick pan over medium heat.\\n2. Add spinach and sauté for 2 minutes until wilted.\\n3. Crack eggs into the pan and scramble with the spinach.\\n4. Cook for 3-4 minutes until eggs are set but still moist.\\n5. Remove from heat, crumble feta cheese on top.\\n6. Season with salt and pepper, serve immediately.",
+  "prep_time": 5,
+  "cook_time": 10,
+  "servings": <servings>
+}"""
+
+_RECIPE_RULES = """Each recipe (breakfast, lunch, dinner) MUST include:
+1. A list of ALL ingredients with exact quantities for the requested servings (e.g., "2 cups spinach", "1 tbsp olive oil")
+2. Detailed step-by-step cooking instructions (at least 4-6 steps)
+3. Prep time and cook time in minutes
+4. Number of servings
+Snacks only need a name.
+The recipe in the format below is illustrative only: size every quantity for the requested servings and put that number where it shows <servings>."""
+
+_DAY_FORMAT = f"""{{
+  "days": [
+    {{
+      "day": "Monday",
+      "breakfast": "Meal name",
+      "breakfast_recipe": {_RECIPE_EXAMPLE},
+      "lunch": "Meal name",
+      "lunch_is_leftover": false,
+      "lunch_recipe": {{"ingredients": ["ingredient list"], "instructions": "Detailed multi-step instructions", "prep_time": 10, "cook_time": 15, "servings": <servings>}},
+      "dinner": "Meal name",
+      "dinner_recipe": {{"ingredients": ["ingredient list"], "instructions": "Detailed multi-step instructions", "prep_time": 15, "cook_time": 25, "servings": <servings>}},
+      "snack": "Snack name"
+    }}
+  ]
+}}"""
+
+MEAL_PLAN_SYSTEM, MEAL_PLAN_SYSTEM_TOKENS = _static(f"""
+You are an expert nutritionist and meal planner. Create detailed, practical meal plans.
+
+You generate complete 7-day weekly meal plans with DETAILED recipes. The request that follows gives the servings, goal, restrictions and preferences.
+
+For each day (Monday through Sunday), provide:
+- Breakfast with FULL recipe
+- Lunch (can be leftover from previous dinner - mark with lunch_is_leftover: true)
+- Dinner with FULL recipe (make extra for next day's lunch if using leftovers)
+- Snack (simple)
+
+{_RECIPE_RULES}
+Use the requested servings for every recipe, or double it for dinners that make leftovers.
+
+Keep meals practical, delicious, and aligned with the goal. Reuse common ingredients across meals to minimize shopping.
+Never include anything listed under allergies or restrictions.
+
+Respond ONLY with valid JSON in this exact format:
+{_DAY_FORMAT}
+""")
+
+LEFTOVER_STRATEGY = """IMPORTANT - LEFTOVER STRATEGY:
+To minimize ingredients and food waste, plan dinners that make extra portions for the NEXT day's lunch.
+Mark these lunches as leftovers by setting "lunch_is_leftover": true.
+For leftover lunches, use the SAME recipe as the previous night's dinner (just reference it, don't duplicate ingredients).
+This means: Monday dinner → Tuesday lunch (leftover), Tuesday dinner → Wednesday lunch (leftover), etc.
+"""
+
+MEAL_PLAN_LEFTOVER_SYSTEM, MEAL_PLAN_LEFTOVER_SYSTEM_TOKENS = _static(f"{MEAL_PLAN_SYSTEM}\n\n{LEFTOVER_STRATEGY}")
+
+def _preferences_text(dietary_prefs: List[str], cooking_methods: List[str]) -> str:
+    return (
+        f"Dietary preferences: {', '.join(dietary_prefs) if dietary_prefs else 'None'}\n"
+        f"Cooking methods available: {', '.join(cooking_methods) if cooking_methods else 'Any'}\n"
+    )
+
+def meal_plan_prompt(
+    servings: int,
+    goal: Optional[str],
+    allergies: List[str],
+    dietary_prefs: List[str],
+    cooking_methods: List[str],
+    use_leftovers: bool
+) -> Prompt:
+    parts = [f"Generate the 7-day plan for {servings} person(s). Servings per meal: {servings}.\n"]
+    if goal:
+        parts.append(f"Goal: {meal_goal_text(goal)}\n")
+    if allergies:
+        parts.append(f"ALLERGIES/RESTRICTIONS: Avoid {', '.join(allergies)}\n")
+    parts.append(_preferences_text(dietary_prefs, cooking_methods))
+    if use_leftovers:
+        parts.append("Use the leftover strategy.\n")
+        return Prompt("meal_plan", MEAL_PLAN_LEFTOVER_SYSTEM, "".join(parts), MEAL_PLAN_LEFTOVER_SYSTEM_TOKENS)
+    return Prompt("meal_plan", MEAL_PLAN_SYSTEM, "".join(parts), MEAL_PLAN_SYSTEM_TOKENS)
+
+REGENERATE_SYSTEM, REGENERATE_SYSTEM_TOKENS = _static(f"""
+You are an expert nutritionist and meal planner. You replace selected meals in an existing weekly plan.
+
+Generate meals with DETAILED recipes ONLY for the days and meals listed in the request. Meals the request lists as already planned stay as they are; reuse their ingredients where it makes sense.
+
+{_RECIPE_RULES}
+
+Never include anything listed under restrictions, including ingredients that contain or are derived from them.
+
+Respond ONLY with valid JSON in this exact format, with one entry per listed day and only the listed meals:
+{_DAY_FORMAT}
+""")
+
+def regenerate_prompt(
+    servings: int,
+    targets: Dict[str, List[str]],
+    kept_context: str,
+    restrictions: List[str],
+    goal: Optional[str],
+    dietary_prefs: List[str],
+    cooking_methods: List[str]
+) -> Prompt:
+    slots_text = "\n".join(f"- {day}: {', '.join(meal_types)}" for day, meal_types in targets.items())
+    parts = [f"Servings: {servings} person(s)\n\nDays and meals to generate:\n{slots_text}\n\n"]
+    if kept_context:
+        parts.append(f"Already planned:\n{kept_context}\n\n")
+    if restrictions:
+        parts.append(f"CRITICAL RESTRICTIONS - NEVER INCLUDE: {', '.join(restrictions)}\n")
+    if goal:
+        parts.append(f"Goal: {meal_goal_text(goal)}\n")
+    parts.append(_preferences_text(dietary_prefs, cooking_methods))
+    return Prompt("regenerate_meal_plan", REGENERATE_SYSTEM, "".join(parts), REGENERATE_SYSTEM_TOKENS)
+
+SWAP_SYSTEM, SWAP_SYSTEM_TOKENS = _static("""
+You are an expert nutritionist. Suggest ONE replacement meal for a slot in a weekly plan.
+Prefer ingredients already used in the week's plan. Never include anything listed as restricted.
+Size the recipe for the requested servings and put that number where the format shows <servings>.
+
+Respond ONLY with JSON: {"name": "Meal name", "recipe": {"ingredients": ["1 cup rice"], "instructions": "1. Step", "prep_time": 5, "cook_time": 10, "servings": <servings>}}
+""")
+
+def swap_prompt(
+    slot: str,
+    servings: int,
+    current_meal: Optional[str],
+    plan_ingredients: List[str],
+    dietary_prefs: List[str],
+    restrictions: List[str]
+) -> Prompt:
+    user = (
+        f"Replace the {slot} \"{current_meal or 'nothing'}\" for {servings} person(s).\n"
+        f"Ingredients already in the week's plan: {', '.join(plan_ingredients) if plan_ingredients else 'any'}\n"
+        f"Dietary preferences: {', '.join(dietary_prefs) or 'None'}\n"
+        f"NEVER include: {', '.join(restrictions) if restrictions else 'nothing restricted'}\n"
+    )
+    return Prompt("swap_meal", SWAP_SYSTEM, user, SWAP_SYSTEM_TOKENS)
+
+# ============== Supplements ==============
+
+SUPPLEMENT_SYSTEM, SUPPLEMENT_SYSTEM_TOKENS = _static("""
+You are an expert nutritionist and supplement advisor. Recommend evidence-based supplements.
+
+Recommend 5-8 supplements for the health goal in the request, chosen only from the supplement list it provides.
+For each recommendation, provide:
+1. Supplement name (must match exactly from the list)
+2. Why it helps with the goal
+3. Suggested daily dose
+4. Best time to take it
+
+Format as JSON:
+{
+  "recommendations": [
+    {
+      "name": "Supplement Name",
+      "reason": "Why it helps",
+      "suggested_dose": "Amount",
+      "timing": "When to take"
+    }
+  ]
+}
+""")
+
+def supplement_prompt(goal: Optional[str], supplement_names: List[str]) -> Prompt:
+    user = (
+        f"Health goal: {supplement_goal_text(goal)}\n"
+        f"Available supplements: {', '.join(supplement_names)}\n"
+    )
+    return Prompt("supplement_recommendations", SUPPLEMENT_SYSTEM, user, SUPPLEMENT_SYSTEM_TOKENS)
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import stripe
+
+# Stripe caps list pages at 100 objects
+MAX_PAGE_SIZE = 100
+# Drift entries kept verbatim in a report; the counters cover everything
+MAX_REPORT_SAMPLES = 200
+
+@dataclass
+class Page:
+    items: List[Dict[str, Any]]
+    next_cursor: Optional[str]
+
+class StripeSubscriptionSource:
+    """Pages through every subscription on the account, newest first, the same way
+    `auto_paging_iter` does, but one page per call so callers can checkpoint the cursor"""
+
+    async def page(self, cursor: Optional[str], limit: int = MAX_PAGE_SIZE) -> Page:
+        params = {"limit": min(limit, MAX_PAGE_SIZE), "status": "all"}
+        if cursor:
+            params["starting_after"] = cursor
+        result = await asyncio.to_thread(stripe.Subscription.list, **params)
+        items = list(result.data)
+        return Page(items, items[-1]["id"] if result.has_more and items else None)
+
+class FakeSubscriptionSource:
+    """In-memory stand-in for the Stripe list API with the same cursor semantics.
+
+    Used for development and tests; `pages_served` counts list calls so tests can
+    check that a resumed run starts from its checkpoint.
+    """
+
+    def __init__(self, subscriptions: Optional[List[Dict[str, Any]]] = None):
+        self.subscriptions = list(subscriptions or [])
+        self.pages_served = 0
+
+    async def page(self, cursor: Optional[str], limit: int = MAX_PAGE_SIZE) -> Page:
+        self.pages_served += 1
+        start = 0
+        if cursor:
+            ids = [subscription["id"] for subscription in self.subscriptions]
+            if cursor not in ids:
+                raise stripe.error.InvalidRequestError(f"No such subscription: '{cursor}'", "starting_after")
+            start = ids.index(cursor) + 1
+        items = self.subscriptions[start:start + min(limit, MAX_PAGE_SIZE)]
+        has_more = start + len(items) < len(self.subscriptions)
+        return Page(items, items[-1]["id"] if has_more and items else None)
+
+SUBSCRIPTION_SOURCES = {
+    "stripe": StripeSubscriptionSource,
+    "fake": FakeSubscriptionSource,
+}
+
+@dataclass
+class DriftReport:
+    scanned: int = 0
+    drifted: int = 0
+    corrected: int = 0
+    skipped: int = 0
+    fields: Counter = field(default_factory=Counter)
+    samples: List[Dict[str, Any]] = field(default_factory=list)
+
+    def add(self, drifts: List[Dict[str, Any]], corrected: int) -> None:
+        self.drifted += len(drifts)
+        self.corrected += corrected
+        for drift in drifts:
+            self.fields.update(drift["fields"].keys())
+            if len(self.samples) < MAX_REPORT_SAMPLES:
+                self.samples.append(drift)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "scanned": self.scanned,
+            "drifted": self.drifted,
+            "corrected": self.corrected,
+            "skipped": self.skipped,
+            "fields": dict(self.fields),
+            "samples": self.samples,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "DriftReport":
+        data = data or {}
+        return cls(
+            scanned=data.get("scanned", 0),
+            drifted=data.get("drifted", 0),
+            corrected=data.get("corrected", 0),
+            skipped=data.get("skipped", 0),
+            fields=Counter(data.get("fields") or {}),
+            samples=list(data.get("samples") or []),
+        )
+
+@dataclass
+class PageOutcome:
+    drifts: List[Dict[str, Any]]
+    corrected: int = 0
+    skipped: int = 0
+
+class Reconciler:
+    """Walks a subscription source page by page and hands each page to `process_page`.
+
+    Listing is inherently sequential (each cursor comes from the previous page),
+    so one fetcher reads ahead while up to `concurrency` pages are diffed and
+    corrected in parallel. `checkpoint` is called with the cursor of the last
+    page such that it and every page before it are done, so a run that dies is
+    resumed without skipping anything; pages after the checkpoint may be
+    processed twice, which is harmless because corrections are idempotent.
+    """
+
+    def __init__(
+        self,
+        source,
+        process_page: Callable[[List[Dict[str, Any]]], Awaitable[PageOutcome]],
+        checkpoint: Callable[[Optional[str], DriftReport], Awaitable[None]],
+        concurrency: int = 4,
+        page_size: int = MAX_PAGE_SIZE
+    ):
+        self.source = source
+        self.process_page = process_page
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.page_size = page_size
+
+    async def run(self, cursor: Optional[str] = None, report: Optional[DriftReport] = None) -> DriftReport:
+        report = report or DriftReport()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+        # Cursor reached after each page, by sequence number, until it is checkpointed
+        finished: Dict[int, Optional[str]] = {}
+        next_to_checkpoint = 0
+        lock = asyncio.Lock()
+
+        async def fetch() -> None:
+            page_cursor = cursor
+            sequence = 0
+            while True:
+                page = await self.source.page(page_cursor, self.page_size)
+                await queue.put((sequence, page_cursor, page))
+                sequence += 1
+                if page.next_cursor is None:
+                    break
+                page_cursor = page.next_cursor
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+        async def work() -> None:
+            nonlocal next_to_checkpoint
+            while True:
+                entry = await queue.get()
+                if entry is None:
+                    return
+                sequence, page_cursor, page = entry
+                outcome = await self.process_page(page.items)
+                async with lock:
+                    report.scanned += len(page.items)
+                    report.skipped += outcome.skipped
+                    report.add(outcome.drifts, outcome.corrected)
+                    # The last page has no next cursor; keep its own last id so the
+                    # checkpoint still points past it
+                    finished[sequence] = page.next_cursor or (page.items[-1]["id"] if page.items else page_cursor)
+                    advanced = None
+                    while next_to_checkpoint in finished:
+                        advanced = finished.pop(next_to_checkpoint)
+                        next_to_checkpoint += 1
+                    if advanced is not None:
+                        await self.checkpoint(advanced, report)
+
+        fetcher = asyncio.create_task(fetch())
+        workers = [asyncio.create_task(work()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(fetcher, *workers)
+        except Exception:
+            for task in [fetcher, *workers]:
+                task.cancel()
+            await asyncio.gather(fetcher, *workers, return_exceptions=True)
+            raise
+        logging.info(
+            f"Reconciliation scanned {report.scanned} subscriptions: "
+            f"{report.drifted} drifted, {report.corrected} corrected"
+        )
+        return report
@@ -1,9 +1,11 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Request, Header
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
 import os
 import logging
 from pathlib import Path
@@ -11,32 +13,49 @@ from pathlib import Path
 # Version for deployment verification
 API_VERSION = "2026.01.25.v3"
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
+import secrets
 from datetime import datetime, timezone, timedelta
 from passlib.context import CryptContext
 import jwt
 import requests
 import stripe
-import openai
 import sys
 import importlib
 
-def _import_local_modules():
+def _import_local_module(name: str):
     if 'backend.stripe_client' in sys.modules or __name__.startswith('backend.'):
-        stripe_mod = importlib.import_module('backend.stripe_client')
-        db_mod = importlib.import_module('backend.db')
-    else:
-        stripe_mod = importlib.import_module('stripe_client')
-        db_mod = importlib.import_module('db')
-    return stripe_mod, db_mod
+        return importlib.import_module(f'backend.{name}')
+    return importlib.import_module(name)
+
+def _import_local_modules():
+    return _import_local_module('stripe_client'), _import_local_module('db')
 
 _stripe_mod, _db_mod = _import_local_modules()
+_shopping_mod = _import_local_module('shopping')
+_jobs_mod = _import_local_module('jobs')
+_singleflight_mod = _import_local_module('singleflight')
+_llm_mod = _import_local_module('llm')
+_plan_schema_mod = _import_local_module('plan_schema')
+_prompts_mod = _import_local_module('prompts')
+_planner_mod = _import_local_module('planner')
+_optimizer_mod = _import_local_module('optimizer')
+_allergens_mod = _import_local_module('allergens')
+_nutrition_mod = _import_local_module('nutrition')
+_batch_mod = _import_local_module('batch')
+_governor_mod = _import_local_module('governor')
+_cache_mod = _import_local_module('cache')
+_entitlements_mod = _import_local_module('entitlements')
+_reconcile_mod = _import_local_module('reconcile')
+_idempotency_mod = _import_local_module('idempotency')
 init_stripe_client = _stripe_mod.init_stripe
 
 init_pool = _db_mod.init_pool
+init_schema = _db_mod.init_schema
 close_pool = _db_mod.close_pool
 find_user_by_id = _db_mod.find_user_by_id
+find_user_id_by_stripe_customer = _db_mod.find_user_id_by_stripe_customer
 find_user_by_email = _db_mod.find_user_by_email
 find_user_by_oauth = _db_mod.find_user_by_oauth
 insert_user = _db_mod.insert_user
@@ -47,9 +66,10 @@ find_all_supplements = _db_mod.find_all_supplements
 find_supplement_by_id = _db_mod.find_supplement_by_id
 insert_supplement = _db_mod.insert_supplement
 find_promo_by_code = _db_mod.find_promo_by_code
-update_promo_uses = _db_mod.update_promo_uses
+redeem_promo = _db_mod.redeem_promo
 insert_promo_code = _db_mod.insert_promo_code
-find_all_promo_codes = _db_mod.find_all_promo_codes
+find_promo_codes_page = _db_mod.find_promo_codes_page
+insert_promo_codes_bulk = _db_mod.insert_promo_codes_bulk
 deactivate_promo_code = _db_mod.deactivate_promo_code
 insert_meal = _db_mod.insert_meal
 find_meals = _db_mod.find_meals
@@ -57,10 +77,14 @@ find_meal_by_id = _db_mod.find_meal_by_id
 insert_meal_plan = _db_mod.insert_meal_plan
 find_meal_plans_by_user = _db_mod.find_meal_plans_by_user
 find_meal_plan_by_id = _db_mod.find_meal_plan_by_id
+find_meal_plans_for_consolidation = _db_mod.find_meal_plans_for_consolidation
 update_meal_plan = _db_mod.update_meal_plan
+update_meal_plan_slot = _db_mod.update_meal_plan_slot
 delete_meal_plan = _db_mod.delete_meal_plan
 delete_shopping_lists_by_meal_plan = _db_mod.delete_shopping_lists_by_meal_plan
 insert_shopping_list = _db_mod.insert_shopping_list
+find_shopping_list_by_meal_plan = _db_mod.find_shopping_list_by_meal_plan
+modify_shopping_list = _db_mod.modify_shopping_list
 find_shopping_lists_by_user = _db_mod.find_shopping_lists_by_user
 delete_shopping_list = _db_mod.delete_shopping_list
 find_pantry_by_user = _db_mod.find_pantry_by_user
@@ -74,12 +98,75 @@ update_user_supplement = _db_mod.update_user_supplement
 delete_user_supplement = _db_mod.delete_user_supplement
 insert_supplement_log = _db_mod.insert_supplement_log
 find_supplement_logs = _db_mod.find_supplement_logs
+find_ai_config = _db_mod.find_ai_config
+insert_ai_config = _db_mod.insert_ai_config
+update_ai_config = _db_mod.update_ai_config
+find_stripe_price = _db_mod.find_stripe_price
+insert_stripe_price = _db_mod.insert_stripe_price
+find_active_stripe_prices = _db_mod.find_active_stripe_prices
+deactivate_stripe_price = _db_mod.deactivate_stripe_price
+insert_payment_transaction = _db_mod.insert_payment_transaction
+find_payment_transaction = _db_mod.find_payment_transaction
+update_payment_transaction = _db_mod.update_payment_transaction
+insert_ai_job = _db_mod.insert_ai_job
+find_ai_job = _db_mod.find_ai_job
+claim_ai_job = _db_mod.claim_ai_job
+complete_ai_job = _db_mod.complete_ai_job
+fail_ai_job = _db_mod.fail_ai_job
+insert_stripe_event = _db_mod.insert_stripe_event
+claim_stripe_event = _db_mod.claim_stripe_event
+complete_stripe_event = _db_mod.complete_stripe_event
+fail_stripe_event = _db_mod.fail_stripe_event
+requeue_stale_stripe_events = _db_mod.requeue_stale_stripe_events
+find_stripe_events = _db_mod.find_stripe_events
+count_stripe_events_by_status = _db_mod.count_stripe_events_by_status
+replay_stripe_events = _db_mod.replay_stripe_events
+requeue_stale_ai_jobs = _db_mod.requeue_stale_ai_jobs
+defer_ai_job = _db_mod.defer_ai_job
+sum_ai_job_tokens = _db_mod.sum_ai_job_tokens
+find_draft_meal_plans = _db_mod.find_draft_meal_plans
+find_plans_due_for_pregeneration = _db_mod.find_plans_due_for_pregeneration
+claim_batch_pending_ai_jobs = _db_mod.claim_batch_pending_ai_jobs
+assign_ai_jobs_to_batch = _db_mod.assign_ai_jobs_to_batch
+release_ai_jobs_to_queue = _db_mod.release_ai_jobs_to_queue
+find_ai_jobs_by_batch = _db_mod.find_ai_jobs_by_batch
+insert_ai_batch = _db_mod.insert_ai_batch
+find_open_ai_batches = _db_mod.find_open_ai_batches
+find_recent_ai_batches = _db_mod.find_recent_ai_batches
+finish_ai_batch = _db_mod.finish_ai_batch
+update_ai_batch_status = _db_mod.update_ai_batch_status
 find_subscription_by_user = _db_mod.find_subscription_by_user
 insert_subscription = _db_mod.insert_subscription
 update_subscription = _db_mod.update_subscription
+upsert_subscription = _db_mod.upsert_subscription
+find_subscription_state_by_customers = _db_mod.find_subscription_state_by_customers
+apply_subscription_corrections = _db_mod.apply_subscription_corrections
+claim_reconciliation_run = _db_mod.claim_reconciliation_run
+checkpoint_reconciliation_run = _db_mod.checkpoint_reconciliation_run
+finish_reconciliation_run = _db_mod.finish_reconciliation_run
+find_recent_reconciliation_runs = _db_mod.find_recent_reconciliation_runs
+claim_idempotency_key = _db_mod.claim_idempotency_key
+complete_idempotency_key = _db_mod.complete_idempotency_key
+release_idempotency_key = _db_mod.release_idempotency_key
+delete_expired_idempotency_keys = _db_mod.delete_expired_idempotency_keys
 insert_payment = _db_mod.insert_payment
 find_payments_by_user = _db_mod.find_payments_by_user
 
+categorize_ingredient = _shopping_mod.categorize_ingredient
+parse_ingredient_string = _shopping_mod.parse_ingredient_string
+plan_contributions = _shopping_mod.plan_contributions
+aggregate_contributions = _shopping_mod.aggregate_contributions
+apply_contribution_delta = _shopping_mod.apply_contribution_delta
+subtract_pantry_items = _shopping_mod.subtract_pantry
+finalize_shopping_items = _shopping_mod.finalize_items
+aggregate_normalized = _shopping_mod.aggregate_normalized
+subtract_pantry_normalized = _shopping_mod.subtract_pantry_normalized
+group_by_category = _shopping_mod.group_by_category
+scale_days = _shopping_mod.scale_days
+recipe_contribution = _shopping_mod.recipe_contribution
+ingredient_key = _shopping_mod.ingredient_key
+ingredient_text = _shopping_mod.ingredient_text
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
@@ -91,12 +178,136 @@ JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-this')
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 720
 
+# AI job queue settings
+AI_JOB_WORKERS = int(os.environ.get('AI_JOB_WORKERS', '4'))
+AI_JOBS_PER_USER = int(os.environ.get('AI_JOBS_PER_USER', '1'))
+AI_JOB_RETRY_BASE_SECONDS = 15
+AI_JOB_STALE_SECONDS = 600
+AI_JOB_PRIORITY_INTERACTIVE = 10
+AI_JOB_PRIORITY_BACKGROUND = 0
+
+# Stripe webhook event queue
+STRIPE_EVENT_WORKERS = int(os.environ.get('STRIPE_EVENT_WORKERS', '4'))
+STRIPE_EVENT_RETRY_BASE_SECONDS = 10
+STRIPE_EVENT_STALE_SECONDS = 300
+
+# Scheduled diff of Stripe subscriptions against local state, to repair missed webhooks
+RECONCILE_INTERVAL_SECONDS = int(os.environ.get('RECONCILE_INTERVAL_SECONDS', str(6 * 3600)))
+RECONCILE_CHECK_SECONDS = 600
+RECONCILE_STALE_SECONDS = 900
+RECONCILE_CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', '4'))
+RECONCILE_SOURCE = os.environ.get('RECONCILE_SOURCE', 'stripe')
+
+# POST endpoints that replay their stored response when retried with the same Idempotency-Key
+IDEMPOTENT_POST_PATHS = [
+    "/api/meal-plans",
+    "/api/shopping-lists",
+    "/api/subscriptions/checkout",
+    "/api/supplement-logs",
+]
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+# AI meal plan generation can take minutes; a key held longer than this is taken over
+IDEMPOTENCY_LOCK_SECONDS = 600
+# Stripe customer id -> user id; the mapping never changes once a customer is created
+stripe_customer_users = _cache_mod.TTLCache(maxsize=50000, ttl_seconds=24 * 3600)
+
+# Premium status is answered locally; webhooks keep the subscriptions table current
+entitlements = _entitlements_mod.EntitlementService(
+    load_subscription=find_subscription_by_user,
+    load_user=find_user_by_id,
+    ttl_seconds=int(os.environ.get('ENTITLEMENT_CACHE_SECONDS', '60'))
+)
+
+# Identical AI requests from the same user within this window share one result
+AI_SINGLE_FLIGHT_TTL_SECONDS = 30
+ai_request_flights = _singleflight_mod.SingleFlight(ttl_seconds=AI_SINGLE_FLIGHT_TTL_SECONDS)
+flight_key = _singleflight_mod.flight_key
+
+# LLM provider routing
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', '120'))
+llm_router = _llm_mod.LLMRouter(timeout=LLM_TIMEOUT_SECONDS)
+# The offline mock provider is for development and tests; production configs can't select it
+LLM_MOCK_ENABLED = os.environ.get('LLM_MOCK_ENABLED', 'false').lower() == 'true'
+SELECTABLE_LLM_PROVIDERS = {name for name in _llm_mod.PROVIDERS if LLM_MOCK_ENABLED or name != "mock"}
+
+def has_llm_access(ai_config: Optional[dict]) -> bool:
+    return _llm_mod.has_llm_access(ai_config, allow_mock=LLM_MOCK_ENABLED)
+
+def llm_targets(ai_config: dict) -> list:
+    return _llm_mod.targets_from_config(ai_config, allow_mock=LLM_MOCK_ENABLED)
+
+LLMProviderError = _llm_mod.LLMProviderError
+parse_structured = _plan_schema_mod.parse_structured
+StructuredOutputError = _plan_schema_mod.StructuredOutputError
+AIMealPlan = _plan_schema_mod.AIMealPlan
+AIMealSwap = _plan_schema_mod.AIMealSwap
+MEAL_PLAN_FORMAT = _plan_schema_mod.MEAL_PLAN_FORMAT
+MEAL_SWAP_FORMAT = _plan_schema_mod.MEAL_SWAP_FORMAT
+
+# Admission control for LLM calls: per-user and per-key rate buckets plus a fair global slot pool
+llm_governor = _governor_mod.LLMGovernor(
+    max_concurrency=int(os.environ.get('LLM_MAX_CONCURRENCY', '16')),
+    user_rpm=float(os.environ.get('LLM_USER_RPM', '10')),
+    user_tpm=float(os.environ.get('LLM_USER_TPM', '60000')),
+    key_rpm=float(os.environ.get('LLM_KEY_RPM', '60')),
+    key_tpm=float(os.environ.get('LLM_KEY_TPM', '200000')),
+    max_waiting_per_user=int(os.environ.get('LLM_MAX_WAITING_PER_USER', '2')),
+    max_wait_seconds=LLM_TIMEOUT_SECONDS / 4
+)
+RateLimited = _governor_mod.RateLimited
+# How long a key is held back after the provider itself answers 429
+LLM_PROVIDER_BACKOFF_SECONDS = 20
+# Expected completion size per response schema, charged up front against token budgets
+LLM_OUTPUT_TOKEN_ESTIMATES = {"meal_plan": 6000, "meal_swap": 800}
+LLM_DEFAULT_OUTPUT_TOKENS = 1500
+get_allergen_matcher = _allergens_mod.get_matcher
+screen_plan_allergens = _allergens_mod.screen_plan
+nutrition_engine = _nutrition_mod.NutritionEngine()
+
+# The plan optimizer is CPU-bound, so it runs in worker processes off the event loop
+OPTIMIZER_WORKERS = int(os.environ.get('OPTIMIZER_WORKERS', '2'))
+optimizer_executor = ProcessPoolExecutor(max_workers=OPTIMIZER_WORKERS)
+
+# Speculative next-week plans, generated off-peak as drafts
+PREGEN_INTERVAL_SECONDS = int(os.environ.get('PREGEN_INTERVAL_SECONDS', '1800'))
+PREGEN_OFFPEAK_START_HOUR = int(os.environ.get('PREGEN_OFFPEAK_START_HOUR', '2'))
+PREGEN_OFFPEAK_END_HOUR = int(os.environ.get('PREGEN_OFFPEAK_END_HOUR', '6'))
+PREGEN_DAILY_TOKEN_BUDGET = int(os.environ.get('PREGEN_DAILY_TOKEN_BUDGET', '2000000'))
+PREGEN_BATCH_SIZE = 200
+# A full week of recipes is roughly this many output tokens
+PREGEN_OUTPUT_TOKEN_ESTIMATE = 6000
+# A failed draft is retried after this long, and not at all after PREGEN_MAX_FAILURES
+PREGEN_RETRY_COOLDOWN_SECONDS = 6 * 3600
+PREGEN_MAX_FAILURES = 2
+
+# Scheduled generation goes through provider batch APIs when the provider has one
+AI_BATCH_ENABLED = os.environ.get('AI_BATCH_ENABLED', 'true').lower() == 'true'
+AI_BATCH_POLL_SECONDS = int(os.environ.get('AI_BATCH_POLL_SECONDS', '300'))
+AI_BATCH_MAX_REQUESTS = min(int(os.environ.get('AI_BATCH_MAX_REQUESTS', '5000')), _batch_mod.MAX_BATCH_REQUESTS)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_pool()
+    await init_schema()
     await seed_supplements()
     await init_stripe_client()
+    await warm_stripe_prices()
+    await requeue_stale_ai_jobs(AI_JOB_STALE_SECONDS)
+    await requeue_stale_stripe_events(STRIPE_EVENT_STALE_SECONDS)
+    ai_job_pool.start()
+    stripe_event_pool.start()
+    pregeneration_task.start()
+    ai_batch_task.start()
+    reconciliation_task.start()
+    idempotency_purge_task.start()
     yield
+    await idempotency_purge_task.stop()
+    await reconciliation_task.stop()
+    await ai_batch_task.stop()
+    await stripe_event_pool.stop()
+    await pregeneration_task.stop()
+    await ai_job_pool.stop()
+    optimizer_executor.shutdown(wait=False, cancel_futures=True)
     await close_pool()
 
 app = FastAPI(lifespan=lifespan)
@@ -107,24 +318,40 @@ async def get_version():
     """Get API version for deployment verification"""
     return {"version": API_VERSION, "google_callback_route": "enabled"}
 
-# Helper function for LLM calls using OpenAI API
-async def call_openai(api_key: str, prompt: str, system_message: str = None, model: str = "gpt-4") -> str:
-    """Call OpenAI API directly"""
+# Helper function for LLM calls routed to the user's configured provider
+async def call_llm(ai_config: dict, prompt: str, system_message: str = None, response_format: dict = None) -> str:
+    """Call the configured provider, falling back to the secondary one on timeouts or 5xx.
+    Calls go through the governor; when a user or key is over its limits this raises a 429."""
+    targets = llm_targets(ai_config)
+    estimated_tokens = (
+        _prompts_mod.count_tokens(system_message or "")
+        + _prompts_mod.count_tokens(prompt)
+        + LLM_OUTPUT_TOKEN_ESTIMATES.get((response_format or {}).get("name"), LLM_DEFAULT_OUTPUT_TOKENS)
+    )
+    
+    def admit_attempt(target) -> None:
+        # The slot charges the primary key; fallback and hedged attempts pay against their own key
+        if target.api_key != targets[0].api_key:
+            llm_governor.admit_key(target.api_key, estimated_tokens)
+    
     try:
-        client = openai.OpenAI(api_key=api_key)
-        messages = []
-        if system_message:
-            messages.append({"role": "system", "content": system_message})
-        messages.append({"role": "user", "content": prompt})
-        
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.7
+        async with llm_governor.slot(ai_config.get("user_id") or "", targets[0].api_key, estimated_tokens):
+            return await llm_router.complete(targets, prompt, system_message, response_format, admit_attempt)
+    except RateLimited as e:
+        logging.warning(f"LLM call rejected for user {ai_config.get('user_id')}: {e}")
+        raise HTTPException(
+            status_code=429,
+            detail="Too many AI requests. Please try again shortly.",
+            headers={"Retry-After": e.retry_after_header}
         )
-        return response.choices[0].message.content
+    except LLMProviderError as e:
+        if e.status_code == 429:
+            limited = next((t for t in targets if t.provider == e.provider), targets[0])
+            llm_governor.penalize_key(limited.api_key, LLM_PROVIDER_BACKOFF_SECONDS)
+        logging.error(f"LLM API error: {e}")
+        raise
     except Exception as e:
-        logging.error(f"OpenAI API error: {e}")
+        logging.error(f"LLM API error: {e}")
         raise
 
 # ============== Models ==============
@@ -224,6 +451,18 @@ class MealPlan(BaseModel):
     servings: int = 1
     created_at: str
     goal: Optional[str] = None
+    nutrition: Optional[Dict[str, Any]] = None
+    status: str = "active"
+    source_plan_id: Optional[str] = None
+
+class JobAccepted(BaseModel):
+    """202 body for AI work queued in the background; poll status_url for the result"""
+    job_id: str
+    status: str
+    status_url: str
+
+# AI-backed plan endpoints answer 200 with the plan when it is built locally, 202 otherwise
+PLAN_JOB_RESPONSES = {202: {"model": JobAccepted, "description": "Generation queued; poll GET /api/jobs/{job_id}"}}
 
 class PantryItem(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -250,6 +489,18 @@ class ShoppingListItem(BaseModel):
     unit: str
     category: str
     checked: bool = False
+    checked_by_user: bool = False
+
+class ShoppingItemCheck(BaseModel):
+    name: str
+    unit: str
+    checked: bool
+
+class ConsolidatedShoppingListRequest(BaseModel):
+    meal_plan_ids: List[str] = []
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    subtract_pantry: bool = True
 
 class ShoppingList(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -325,11 +576,17 @@ class AIConfig(BaseModel):
     provider: str = "openai"
     model: str = "gpt-5.2"
     api_key: Optional[str] = None
+    fallback_provider: Optional[str] = None
+    fallback_model: Optional[str] = None
+    fallback_api_key: Optional[str] = None
 
 class AIConfigUpdate(BaseModel):
     provider: str
     model: str
     api_key: Optional[str] = None
+    fallback_provider: Optional[str] = None
+    fallback_model: Optional[str] = None
+    fallback_api_key: Optional[str] = None
 
 class CheckoutRequest(BaseModel):
     package_id: str
@@ -379,6 +636,14 @@ async def get_current_user(authorization: str = Header(None)) -> dict:
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+async def require_premium(authorization: str = Header(None)) -> dict:
+    """Route dependency: the current user, or 403 without an active premium entitlement"""
+    user = await get_current_user(authorization)
+    entitlement = await entitlements.get(user["id"])
+    if not entitlement.is_premium:
+        raise HTTPException(status_code=403, detail="Premium subscription required")
+    return user
+
 # ============== Seed Data ==============
 
 async def seed_supplements():
@@ -838,30 +1103,39 @@ async def get_oauth_status():
 class PromoCodeRedeem(BaseModel):
     code: str
 
+# Codes known to be used up or switched off, rejected without a database round-trip
+unavailable_promo_codes = _cache_mod.TTLCache(maxsize=10000, ttl_seconds=300)
+
+PROMO_REJECTIONS = {
+    "not_found": (404, "Invalid promo code"),
+    "inactive": (400, "Promo code has been deactivated"),
+    "expired": (400, "Promo code has expired"),
+    "exhausted": (400, "Promo code has reached maximum uses"),
+    "already_redeemed": (400, "You have already redeemed this promo code"),
+}
+
 @api_router.post("/promo/redeem")
 async def redeem_promo_code(promo_data: PromoCodeRedeem, authorization: str = Header(None)):
     user = await get_current_user(authorization)
+    code = promo_data.code.strip().upper()
     
-    promo = await find_promo_by_code(promo_data.code.upper())
-    
-    if not promo:
-        raise HTTPException(status_code=404, detail="Invalid promo code")
-    
-    if not promo.get("active", True):
-        raise HTTPException(status_code=400, detail="Promo code has been deactivated")
-    
-    max_uses = promo.get("max_uses", 0)
-    current_uses = promo.get("uses", 0)
-    if max_uses > 0 and current_uses >= max_uses:
-        raise HTTPException(status_code=400, detail="Promo code has reached maximum uses")
+    cached_reason = unavailable_promo_codes.get(code)
+    if cached_reason:
+        status_code, detail = PROMO_REJECTIONS[cached_reason]
+        raise HTTPException(status_code=status_code, detail=detail)
     
     lifetime_end = datetime(2099, 12, 31, tzinfo=timezone.utc).isoformat()
-    await update_user(user["id"], {
-        "subscription_status": "active",
-        "subscription_end_date": lifetime_end
-    })
+    result = await redeem_promo(code, user["id"], lifetime_end)
+    
+    if result["status"] != "redeemed":
+        if result["status"] in ("inactive", "expired", "exhausted"):
+            unavailable_promo_codes.set(code, result["status"])
+        status_code, detail = PROMO_REJECTIONS[result["status"]]
+        raise HTTPException(status_code=status_code, detail=detail)
     
-    await update_promo_uses(promo_data.code.upper(), user["id"])
+    if result["max_uses"] and result["uses"] >= result["max_uses"]:
+        unavailable_promo_codes.set(code, "exhausted")
+    entitlements.invalidate(user["id"])
     
     return {
         "message": "Promo code redeemed! You now have lifetime premium access.",
@@ -880,10 +1154,6 @@ async def create_promo_code(
     if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    existing = await find_promo_by_code(code.upper())
-    if existing:
-        raise HTTPException(status_code=400, detail="Promo code already exists")
-    
     promo_doc = {
         "id": str(uuid.uuid4()),
         "code": code.upper(),
@@ -893,7 +1163,8 @@ async def create_promo_code(
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await insert_promo_code(promo_doc)
+    if not await insert_promo_code(promo_doc):
+        raise HTTPException(status_code=400, detail="Promo code already exists")
     
     return {
         "message": "Promo code created successfully",
@@ -901,15 +1172,137 @@ async def create_promo_code(
         "max_uses": max_uses
     }
 
+# Unambiguous characters only (no 0/O, 1/I/L) so codes survive being read aloud or retyped
+PROMO_CODE_ALPHABET = "ABCDEFGHJKMNPQRSTUVWXYZ23456789"
+PROMO_CODE_RANDOM_LENGTH = 10
+PROMO_BULK_MAX = 100000
+
+class PromoBulkCreate(BaseModel):
+    prefix: str
+    count: int = Field(ge=1, le=PROMO_BULK_MAX)
+    max_uses: int = Field(default=1, ge=0)
+    valid_until: Optional[datetime] = None
+    campaign: Optional[str] = None
+
+def _random_promo_code(prefix: str) -> str:
+    suffix = "".join(secrets.choice(PROMO_CODE_ALPHABET) for _ in range(PROMO_CODE_RANDOM_LENGTH))
+    return f"{prefix}-{suffix}" if prefix else suffix
+
+@api_router.post("/admin/promo/bulk")
+async def bulk_create_promo_codes(bulk: PromoBulkCreate, authorization: str = Header(None)):
+    """Generate `count` unique random codes in one COPY and stream them back as CSV"""
+    user = await get_current_user(authorization)
+    
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    prefix = bulk.prefix.strip().upper()
+    if len(prefix) > 16 or not prefix.replace("_", "").isalnum():
+        raise HTTPException(status_code=400, detail="Prefix must be up to 16 letters, digits or underscores")
+    valid_until = None
+    if bulk.valid_until:
+        until = bulk.valid_until if bulk.valid_until.tzinfo else bulk.valid_until.replace(tzinfo=timezone.utc)
+        if until <= datetime.now(timezone.utc):
+            raise HTTPException(status_code=400, detail="Expiry must be in the future")
+        valid_until = until.isoformat()
+    campaign = bulk.campaign or prefix
+    
+    created_at = datetime.now(timezone.utc).isoformat()
+    created: List[str] = []
+    # Collisions with existing codes are skipped by the insert; top up until the count is reached
+    for _ in range(3):
+        missing = bulk.count - len(created)
+        if missing <= 0:
+            break
+        codes = {_random_promo_code(prefix) for _ in range(missing)}
+        created += await insert_promo_codes_bulk([
+            {
+                "id": str(uuid.uuid4()),
+                "code": code,
+                "valid_from": created_at,
+                "valid_until": valid_until,
+                "max_uses": bulk.max_uses,
+                "uses": 0,
+                "active": True,
+                "created_at": created_at,
+                "campaign": campaign
+            }
+            for code in codes
+        ])
+    if len(created) < bulk.count:
+        logging.error(f"Bulk promo generation for {prefix} created {len(created)} of {bulk.count} codes")
+    
+    def csv_lines():
+        yield "code,max_uses,valid_until,campaign\n"
+        for code in created:
+            yield f"{code},{bulk.max_uses},{valid_until or ''},{campaign}\n"
+    
+    return StreamingResponse(
+        csv_lines(),
+        media_type="text/csv",
+        headers={
+            "Content-Disposition": f'attachment; filename="promo-{campaign.lower()}.csv"',
+            "X-Codes-Created": str(len(created))
+        }
+    )
+
+PROMO_STATUS_FILTERS = ("active", "revoked", "exhausted", "expired")
+
+def _promo_status(promo: dict, now: datetime) -> str:
+    if not promo.get("active", True):
+        return "revoked"
+    if promo.get("max_uses") and promo.get("uses", 0) >= promo["max_uses"]:
+        return "exhausted"
+    valid_until = _entitlements_mod.as_datetime(promo.get("valid_until"))
+    if valid_until and valid_until <= now:
+        return "expired"
+    return "active"
+
 @api_router.get("/admin/promo/list")
-async def list_promo_codes(authorization: str = Header(None)):
+async def list_promo_codes(
+    page: int = 1,
+    page_size: int = 50,
+    search: Optional[str] = None,
+    status: Optional[str] = None,
+    campaign: Optional[str] = None,
+    authorization: str = Header(None)
+):
     user = await get_current_user(authorization)
     
     if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
+    if status and status not in PROMO_STATUS_FILTERS:
+        raise HTTPException(status_code=400, detail=f"status must be one of {', '.join(PROMO_STATUS_FILTERS)}")
+    
+    page = max(page, 1)
+    page_size = min(max(page_size, 1), 500)
+    result = await find_promo_codes_page(search, status, campaign, page_size, (page - 1) * page_size)
     
-    promos = await find_all_promo_codes()
-    return promos
+    now = datetime.now(timezone.utc)
+    summary = result["summary"] or {}
+    return {
+        "items": [
+            {
+                "code": promo["code"],
+                "campaign": promo.get("campaign"),
+                "max_uses": promo.get("max_uses", 0),
+                "use_count": promo.get("uses", 0),
+                "active": promo.get("active", True),
+                "status": _promo_status(promo, now),
+                "valid_until": promo.get("valid_until"),
+                "created_at": promo.get("created_at")
+            }
+            for promo in result["items"]
+        ],
+        "page": page,
+        "page_size": page_size,
+        "total": summary.get("total", 0),
+        "summary": {
+            "active": summary.get("active", 0),
+            "redeemed_codes": summary.get("redeemed_codes", 0),
+            "total_uses": summary.get("total_uses", 0)
+        }
+    }
 
 @api_router.delete("/admin/promo/{code}")
 async def revoke_promo_code(code: str, authorization: str = Header(None)):
@@ -922,12 +1315,18 @@ async def revoke_promo_code(code: str, authorization: str = Header(None)):
     
     if result == 0:
         raise HTTPException(status_code=404, detail="Promo code not found")
+    unavailable_promo_codes.set(code.upper(), "inactive")
     
     return {"message": "Promo code revoked"}
 
 
 # ============== Meal Routes ==============
 
+def _meal_response(meal: dict) -> Meal:
+    if not meal.get("nutrition"):
+        meal = {**meal, "nutrition": nutrition_engine.meal_nutrition(meal)}
+    return Meal(**meal)
+
 @api_router.post("/meals", response_model=Meal)
 async def create_meal(meal_data: MealCreate, authorization: str = Header(None)):
     user = await get_current_user(authorization)
@@ -939,6 +1338,8 @@ async def create_meal(meal_data: MealCreate, authorization: str = Header(None)):
         **meal_data.model_dump(),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
+    if not meal_doc.get("nutrition"):
+        meal_doc["nutrition"] = nutrition_engine.meal_nutrition(meal_doc)
     
     await insert_meal(meal_doc)
     return Meal(**meal_doc)
@@ -953,7 +1354,7 @@ async def get_meals(
     
     tag_list = tags.split(",") if tags else None
     meals = await find_meals(cooking_method, tag_list)
-    return [Meal(**meal) for meal in meals]
+    return [_meal_response(meal) for meal in meals]
 
 @api_router.get("/meals/{meal_id}", response_model=Meal)
 async def get_meal(meal_id: str, authorization: str = Header(None)):
@@ -963,7 +1364,7 @@ async def get_meal(meal_id: str, authorization: str = Header(None)):
     if not meal:
         raise HTTPException(status_code=404, detail="Meal not found")
     
-    return Meal(**meal)
+    return _meal_response(meal)
 
 # ============== Meal Plan Routes ==============
 
@@ -974,28 +1375,195 @@ DEFAULT_MEAL_TIMES = {
     "snack": "3:00 PM"
 }
 
-@api_router.post("/meal-plans", response_model=MealPlan)
-async def create_meal_plan(plan_data: MealPlanCreate, authorization: str = Header(None)):
-    user = await get_current_user(authorization)
+MEAL_TYPES = ["breakfast", "lunch", "dinner", "snack"]
+WEEK_DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+def _empty_plan_day(day: str) -> dict:
+    return {
+        "day": day,
+        "meals": {meal_type: None for meal_type in MEAL_TYPES},
+        "meal_times": DEFAULT_MEAL_TIMES.copy(),
+        "is_leftover": {meal_type: False for meal_type in MEAL_TYPES},
+        "instructions": {},
+        "recipes": {},
+        "locked": False
+    }
+
+def _plan_response(plan: dict) -> MealPlan:
+    """MealPlan with per-meal, per-day and weekly macros computed locally"""
+    nutrition = nutrition_engine.plan_nutrition(plan.get("days") or [])
+    nutrition["goal_check"] = _nutrition_mod.goal_check(plan.get("goal"), nutrition["daily_average"])
+    return MealPlan(**{**plan, "nutrition": nutrition})
+
+def _apply_ai_day(plan_day: dict, ai_day: dict, meal_types: List[str]) -> None:
+    """Write the AI output for the given slots into a stored plan day, leaving other slots untouched"""
+    plan_day.setdefault("meals", {})
+    plan_day["meal_times"] = {**DEFAULT_MEAL_TIMES, **(plan_day.get("meal_times") or {})}
+    plan_day["is_leftover"] = {**{m: False for m in MEAL_TYPES}, **(plan_day.get("is_leftover") or {})}
+    plan_day["recipes"] = dict(plan_day.get("recipes") or {})
+    plan_day["instructions"] = dict(plan_day.get("instructions") or {})
+    
+    for meal_type in meal_types:
+        if ai_day.get(meal_type) is None:
+            # Missing from the response (e.g. cut off by truncation); keep the slot as it was
+            continue
+        plan_day["meals"][meal_type] = ai_day[meal_type]
+        plan_day["recipes"].pop(meal_type, None)
+        
+        if meal_type == "lunch":
+            plan_day["is_leftover"]["lunch"] = bool(ai_day.get("lunch_is_leftover", False))
+        
+        recipe = ai_day.get(f"{meal_type}_recipe")
+        if meal_type != "snack" and recipe:
+            plan_day["recipes"][meal_type] = {
+                "ingredients": recipe.get("ingredients", []),
+                "instructions": recipe.get("instructions", ""),
+                "prep_time": recipe.get("prep_time"),
+                "cook_time": recipe.get("cook_time"),
+                "servings": recipe.get("servings")
+            }
+            plan_day["instructions"][meal_type] = f"Prep: {recipe.get('prep_time', '?')} min | Cook: {recipe.get('cook_time', '?')} min"
+        else:
+            plan_day["instructions"][meal_type] = ""
+
+def _merge_ai_days(plan_days: List[dict], ai_plan: AIMealPlan, target_slots: Dict[str, List[str]]) -> None:
+    """Merge AI days into plan_days by day name, only touching the targeted slots"""
+    by_name = {day["day"]: day for day in plan_days}
+    for i, ai_day in enumerate(ai_plan.model_dump(exclude_none=True)["days"]):
+        plan_day = by_name.get(ai_day.get("day"))
+        if plan_day is None and not ai_day.get("day") and i < len(plan_days):
+            plan_day = plan_days[i]
+        if plan_day is None or plan_day["day"] not in target_slots:
+            continue
+        _apply_ai_day(plan_day, ai_day, target_slots[plan_day["day"]])
+
+async def _local_candidates(cooking_methods: List[str], dietary_prefs: List[str], restrictions: List[str]) -> list:
+    """Stored meals that pass the allergen matcher and the plan's dietary preferences"""
+    matcher = get_allergen_matcher(restrictions)
+    safe_meals = [meal for meal in await find_meals() if not matcher.meal_violations(meal)]
+    return _planner_mod.build_candidates(
+        safe_meals, _meal_ingredient_names, cooking_methods, dietary_prefs, restrictions
+    )
+
+async def _fill_from_local_meals(
+    plan_days: List[dict],
+    targets: Dict[str, List[str]],
+    cooking_methods: List[str],
+    dietary_prefs: List[str],
+    restrictions: List[str],
+    use_leftovers: bool
+) -> int:
+    """Fill the targeted slots from the stored meals library without calling an LLM.
+    Returns the number of slots filled."""
+    candidates = await _local_candidates(cooking_methods, dietary_prefs, restrictions)
+    
+    kept_ingredients, kept_names = [], []
+    for day in plan_days:
+        for meal_type in MEAL_TYPES:
+            if meal_type in targets.get(day["day"], []) or (day.get("is_leftover") or {}).get(meal_type):
+                continue
+            recipe = (day.get("recipes") or {}).get(meal_type)
+            kept_ingredients.extend(item["name"].lower() for item in recipe_contribution(recipe).values())
+            kept_names.append((day.get("meals") or {}).get(meal_type))
+    
+    assignment = _planner_mod.plan_slots(
+        candidates, targets, [day["day"] for day in plan_days], kept_ingredients, kept_names, use_leftovers
+    )
     
+    filled = 0
+    by_name = {day["day"]: day for day in plan_days}
+    for day_name, chosen in assignment.items():
+        local_day = {"lunch_is_leftover": chosen.get("lunch", (None, False))[1]}
+        for meal_type, (candidate, _) in chosen.items():
+            local_day[meal_type] = candidate.name
+            local_day[f"{meal_type}_recipe"] = _meal_to_recipe(candidate.meal)
+        _apply_ai_day(by_name[day_name], local_day, list(chosen))
+        filled += len(chosen)
+    return filled
+
+def _clear_slot(plan_day: dict, meal_type: str) -> None:
+    plan_day["meals"][meal_type] = None
+    (plan_day.get("recipes") or {}).pop(meal_type, None)
+    (plan_day.get("instructions") or {}).pop(meal_type, None)
+
+async def _enforce_allergens(
+    user: dict,
+    plan_days: List[dict],
+    restrictions: List[str],
+    ai_config: Optional[dict],
+    plan_context: dict,
+    targets: Optional[Dict[str, List[str]]] = None
+) -> List[dict]:
+    """Screen the plan for restricted allergens and replace only the offending slots.
+    
+    Each offending slot is swapped for a safe meal from the local library when one
+    exists; the rest get one targeted AI regeneration. Slots that still violate are
+    cleared rather than shown. Returns the violations that were found.
+    """
+    matcher = get_allergen_matcher(restrictions)
+    violations = screen_plan_allergens(plan_days, matcher, targets)
+    if not violations:
+        return []
+    
+    report = [
+        {"day": day, "meal_type": meal_type, "allergens": sorted({hit["allergen"] for hit in hits})}
+        for (day, meal_type), hits in violations.items()
+    ]
+    logging.warning(f"Allergen screen flagged {len(report)} slots for user {user['id']}: {report}")
+    
+    by_name = {day["day"]: day for day in plan_days}
+    candidates = await _local_candidates(
+        plan_context.get("cooking_methods") or [], plan_context.get("dietary_preferences") or [], restrictions
+    )
+    remaining: Dict[str, List[str]] = {}
+    for day_name, meal_type in violations:
+        local_meal = _pick_local_swap(candidates, plan_days, (day_name, meal_type))
+        if local_meal:
+            _apply_ai_day(by_name[day_name], {meal_type: local_meal["name"], f"{meal_type}_recipe": _meal_to_recipe(local_meal)}, [meal_type])
+        else:
+            remaining.setdefault(day_name, []).append(meal_type)
+    
+    if remaining and has_llm_access(ai_config):
+        prompt = _prompts_mod.regenerate_prompt(
+            plan_context.get("servings") or 1,
+            remaining,
+            _kept_meals_context(plan_days, remaining),
+            restrictions,
+            plan_context.get("goal"),
+            plan_context.get("dietary_preferences") or [],
+            plan_context.get("cooking_methods") or []
+        )
+        try:
+            response = await call_llm(ai_config, prompt.user, prompt.system, MEAL_PLAN_FORMAT)
+            _merge_ai_days(plan_days, parse_structured(AIMealPlan, response), remaining)
+        except (LLMProviderError, StructuredOutputError) as e:
+            logging.error(f"Allergen-safe regeneration failed: {e}")
+        except HTTPException as e:
+            # Over the governor's limits; the offending slots are cleared below instead
+            if e.status_code != 429:
+                raise
+            logging.warning(f"Allergen-safe regeneration rate limited for user {user['id']}")
+    
+    for day_name, meal_type in screen_plan_allergens(plan_days, matcher, remaining):
+        _clear_slot(by_name[day_name], meal_type)
+    
+    return report
+
+async def _build_meal_plan(
+    user: dict,
+    plan_data: MealPlanCreate,
+    ai_config: Optional[dict] = None,
+    start_date: Optional[datetime] = None,
+    ai_response: Optional[str] = None
+) -> dict:
+    """Build a plan document, filling it with AI recipes when an AI config is given and
+    from the local meals library otherwise (or when the AI provider is unavailable).
+    `ai_response` is a completion obtained elsewhere (e.g. a batch) to use instead of a live call."""
     plan_id = str(uuid.uuid4())
-    start_date = datetime.now(timezone.utc)
+    start_date = start_date or datetime.now(timezone.utc)
     
     end_date = start_date + timedelta(days=7)
-    days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-    
-    plan_days = [
-        {
-            "day": day, 
-            "meals": {"breakfast": None, "lunch": None, "dinner": None, "snack": None}, 
-            "meal_times": DEFAULT_MEAL_TIMES.copy(),
-            "is_leftover": {"breakfast": False, "lunch": False, "dinner": False, "snack": False},
-            "instructions": {}, 
-            "recipes": {},
-            "locked": False
-        }
-        for day in days
-    ]
+    plan_days = [_empty_plan_day(day) for day in WEEK_DAYS]
     
     dietary_prefs = plan_data.dietary_preferences or user.get("dietary_preferences", [])
     cooking_methods = plan_data.cooking_methods or user.get("cooking_methods", [])
@@ -1003,150 +1571,50 @@ async def create_meal_plan(plan_data: MealPlanCreate, authorization: str = Heade
     servings = plan_data.servings
     use_leftovers = plan_data.use_leftovers
     
-    ai_suggestions_raw = None
-    
-    if plan_data.generate_with_ai:
-        ai_config = await find_ai_config(user["id"])
-        if ai_config and ai_config.get("api_key"):
+    generated = False
+    if has_llm_access(ai_config):
+        try:
+            if ai_response is None:
+                prompt = _prompts_mod.meal_plan_prompt(
+                    servings, goal, user.get("allergies", []), dietary_prefs, cooking_methods, use_leftovers
+                )
+                prompt.log_usage()
+                response = await call_llm(ai_config, prompt.user, prompt.system, MEAL_PLAN_FORMAT)
+            else:
+                response = ai_response
+            
             try:
-                system_message = "You are an expert nutritionist and meal planner. Create detailed, practical meal plans."
-                model = ai_config.get("model", "gpt-5.2")
-                
-                goal_context = ""
-                if goal:
-                    goal_map = {
-                        "lose_weight": "focused on calorie deficit, high protein, lower carbs for weight loss",
-                        "gain_weight": "calorie surplus with nutrient-dense foods for healthy weight gain",
-                        "gain_muscle": "high protein (1g per lb bodyweight), balanced carbs and fats for muscle building",
-                        "eat_healthy": "balanced nutrition, whole foods, variety of nutrients",
-                        "increase_energy": "complex carbs, B vitamins, sustained energy foods",
-                        "improve_digestion": "fiber-rich, probiotic foods, gentle on stomach"
-                    }
-                    goal_context = f"Goal: {goal_map.get(goal, 'balanced nutrition')}\n"
-                
-                allergies = user.get("allergies", [])
-                allergy_context = ""
-                if allergies:
-                    allergy_context = f"ALLERGIES/RESTRICTIONS: Avoid {', '.join(allergies)}\n"
-                
-                leftover_context = ""
-                if use_leftovers:
-                    leftover_context = """IMPORTANT - LEFTOVER STRATEGY:
-To minimize ingredients and food waste, plan dinners that make extra portions for the NEXT day's lunch.
-Mark these lunches as leftovers by setting "is_leftover": true for that lunch.
-For leftover lunches, use the SAME recipe as the previous night's dinner (just reference it, don't duplicate ingredients).
-This means: Monday dinner → Tuesday lunch (leftover), Tuesday dinner → Wednesday lunch (leftover), etc.
-
-"""
-                
-                prompt = f"""Generate a complete 7-day weekly meal plan with DETAILED recipes for {servings} person(s).
-
-{goal_context}{allergy_context}{leftover_context}Dietary preferences: {', '.join(dietary_prefs) if dietary_prefs else 'None'}
-Cooking methods available: {', '.join(cooking_methods) if cooking_methods else 'Any'}
-Servings per meal: {servings}
-
-For each day (Monday through Sunday), provide:
-- Breakfast with FULL recipe
-- Lunch (can be leftover from previous dinner - mark with is_leftover: true)
-- Dinner with FULL recipe (make extra for next day's lunch if using leftovers)
-- Snack (simple)
-
-Each recipe MUST include:
-1. A list of ALL ingredients with exact quantities for {servings} serving(s) (e.g., "2 cups spinach", "1 tbsp olive oil")
-2. Detailed step-by-step cooking instructions (at least 4-6 steps)
-3. Prep time and cook time in minutes
-4. Number of servings (should be {servings}, or {servings * 2} for dinners if making leftovers)
-
-Keep meals practical, delicious, and aligned with the goal. Reuse common ingredients across meals to minimize shopping.
-
-Respond ONLY with valid JSON in this exact format:
-{{
-  "days": [
-    {{
-      "day": "Monday",
-      "breakfast": "Meal name",
-      "breakfast_recipe": {{
-        "ingredients": ["2 large eggs", "1 cup spinach", "1/4 cup feta cheese", "1 tbsp olive oil", "Salt and pepper to taste"],
-        "instructions": "1. Heat olive oil in a non-stick pan over medium heat.\\n2. Add spinach and sauté for 2 minutes until wilted.\\n3. Crack eggs into the pan and scramble with the spinach.\\n4. Cook for 3-4 minutes until eggs are set but still moist.\\n5. Remove from heat, crumble feta cheese on top.\\n6. Season with salt and pepper, serve immediately.",
-        "prep_time": 5,
-        "cook_time": 10,
-        "servings": {servings}
-      }},
-      "lunch": "Meal name",
-      "lunch_is_leftover": false,
-      "lunch_recipe": {{
-        "ingredients": ["ingredient list"],
-        "instructions": "Detailed multi-step instructions",
-        "prep_time": 10,
-        "cook_time": 15,
-        "servings": {servings}
-      }},
-      "dinner": "Meal name",
-      "dinner_recipe": {{
-        "ingredients": ["ingredient list - make extra for tomorrow's lunch"],
-        "instructions": "Detailed multi-step instructions",
-        "prep_time": 15,
-        "cook_time": 25,
-        "servings": 2
-      }},
-      "snack": "Snack name"
-    }}
-  ]
-}}"""
-                
-                response = await call_openai(ai_config["api_key"], prompt, system_message, model)
-                ai_suggestions_raw = response
+                ai_plan = parse_structured(AIMealPlan, response)
+            except StructuredOutputError as parse_error:
+                logging.error(f"Failed to parse AI response: {parse_error}")
+                raise
+            if not ai_plan.days:
+                raise StructuredOutputError("AI response contained no days")
+            _merge_ai_days(plan_days, ai_plan, {day: MEAL_TYPES for day in WEEK_DAYS})
+            await _enforce_allergens(user, plan_days, user.get("allergies", []), ai_config, {
+                "servings": servings,
+                "goal": goal,
+                "dietary_preferences": dietary_prefs,
+                "cooking_methods": cooking_methods
+            })
+            generated = True
                 
-                try:
-                    import json
-                    response_text = response if isinstance(response, str) else str(response)
-                    
-                    start_idx = response_text.find('{')
-                    end_idx = response_text.rfind('}') + 1
-                    
-                    if start_idx != -1 and end_idx > start_idx:
-                        json_str = response_text[start_idx:end_idx]
-                        ai_data = json.loads(json_str)
-                        
-                        if "days" in ai_data:
-                            for i, ai_day in enumerate(ai_data["days"]):
-                                if i < len(plan_days):
-                                    plan_days[i]["meals"]["breakfast"] = ai_day.get("breakfast", "")
-                                    plan_days[i]["meals"]["lunch"] = ai_day.get("lunch", "")
-                                    plan_days[i]["meals"]["dinner"] = ai_day.get("dinner", "")
-                                    plan_days[i]["meals"]["snack"] = ai_day.get("snack", "")
-                                    
-                                    is_leftover = ai_day.get("lunch_is_leftover", False)
-                                    plan_days[i]["is_leftover"] = {
-                                        "breakfast": False,
-                                        "lunch": is_leftover,
-                                        "dinner": False,
-                                        "snack": False
-                                    }
-                                    
-                                    plan_days[i]["recipes"] = {}
-                                    plan_days[i]["instructions"] = {}
-                                    
-                                    for meal_type in ["breakfast", "lunch", "dinner"]:
-                                        recipe_key = f"{meal_type}_recipe"
-                                        if recipe_key in ai_day and ai_day[recipe_key]:
-                                            recipe = ai_day[recipe_key]
-                                            plan_days[i]["recipes"][meal_type] = {
-                                                "ingredients": recipe.get("ingredients", []),
-                                                "instructions": recipe.get("instructions", ""),
-                                                "prep_time": recipe.get("prep_time"),
-                                                "cook_time": recipe.get("cook_time"),
-                                                "servings": recipe.get("servings")
-                                            }
-                                            plan_days[i]["instructions"][meal_type] = f"Prep: {recipe.get('prep_time', '?')} min | Cook: {recipe.get('cook_time', '?')} min"
-                                    
-                                    plan_days[i]["instructions"]["snack"] = ""
-                except Exception as parse_error:
-                    logging.error(f"Failed to parse AI response: {parse_error}")
-                    
-            except Exception as e:
-                logging.error(f"AI generation error: {e}")
-    
+        except LLMProviderError as e:
+            logging.error(f"AI provider unavailable, using the local planner: {e}")
+        except Exception as e:
+            logging.error(f"AI generation error: {e}")
+            raise
+    
+    if plan_data.generate_with_ai and not generated:
+        await _fill_from_local_meals(
+            plan_days,
+            {day: list(MEAL_TYPES) for day in WEEK_DAYS},
+            cooking_methods,
+            dietary_prefs,
+            user.get("allergies", []),
+            use_leftovers
+        )
+
     plan_doc = {
         "id": plan_id,
         "user_id": user["id"],
@@ -1161,15 +1629,53 @@ Respond ONLY with valid JSON in this exact format:
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
+    return plan_doc
+
+@api_router.post("/meal-plans", response_model=MealPlan, responses=PLAN_JOB_RESPONSES)
+async def create_meal_plan(plan_data: MealPlanCreate, authorization: str = Header(None)):
+    user = await get_current_user(authorization)
+    
+    if plan_data.generate_with_ai:
+        ai_config = await find_ai_config(user["id"])
+        if has_llm_access(ai_config):
+            payload = {"plan_data": plan_data.model_dump()}
+            job = await ai_request_flights.do(
+                flight_key(user["id"], "create_meal_plan", payload),
+                lambda: enqueue_ai_job(user["id"], "create_meal_plan", payload)
+            )
+            return _job_accepted_response(job)
+    
+    plan_doc = await _build_meal_plan(user, plan_data)
     await insert_meal_plan(plan_doc)
-    return MealPlan(**plan_doc)
+    return _plan_response(plan_doc)
 
 @api_router.get("/meal-plans", response_model=List[MealPlan])
 async def get_meal_plans(authorization: str = Header(None)):
     user = await get_current_user(authorization)
     
     plans = await find_meal_plans_by_user(user["id"])
-    return [MealPlan(**plan) for plan in plans]
+    return [_plan_response(plan) for plan in plans]
+
+@api_router.get("/meal-plans/drafts", response_model=List[MealPlan])
+async def get_draft_meal_plans(authorization: str = Header(None)):
+    """Pre-generated next-week plans waiting to be accepted"""
+    user = await get_current_user(authorization)
+    
+    plans = await find_draft_meal_plans(user["id"])
+    return [_plan_response(plan) for plan in plans]
+
+@api_router.post("/meal-plans/{plan_id}/accept", response_model=MealPlan)
+async def accept_draft_meal_plan(plan_id: str, authorization: str = Header(None)):
+    user = await get_current_user(authorization)
+    
+    plan = await find_meal_plan_by_id(plan_id, user["id"])
+    if not plan:
+        raise HTTPException(status_code=404, detail="Meal plan not found")
+    if plan.get("status") != "draft":
+        raise HTTPException(status_code=400, detail="Only draft plans can be accepted")
+    
+    await update_meal_plan(plan_id, user["id"], {"status": "active"})
+    return _plan_response({**plan, "status": "active"})
 
 @api_router.get("/meal-plans/{plan_id}", response_model=MealPlan)
 async def get_meal_plan(plan_id: str, authorization: str = Header(None)):
@@ -1179,7 +1685,26 @@ async def get_meal_plan(plan_id: str, authorization: str = Header(None)):
     if not plan:
         raise HTTPException(status_code=404, detail="Meal plan not found")
     
-    return MealPlan(**plan)
+    return _plan_response(plan)
+
+@api_router.get("/meal-plans/{plan_id}/allergens")
+async def screen_meal_plan_allergens(plan_id: str, authorization: str = Header(None)):
+    """List the slots of a plan that contain one of the user's allergens"""
+    user = await get_current_user(authorization)
+    
+    plan = await find_meal_plan_by_id(plan_id, user["id"])
+    if not plan:
+        raise HTTPException(status_code=404, detail="Meal plan not found")
+    
+    restrictions = user.get("allergies", [])
+    violations = screen_plan_allergens(plan.get("days") or [], get_allergen_matcher(restrictions))
+    return {
+        "restrictions": restrictions,
+        "violations": [
+            {"day": day, "meal_type": meal_type, "hits": hits}
+            for (day, meal_type), hits in violations.items()
+        ]
+    }
 
 @api_router.delete("/meal-plans/{plan_id}")
 async def delete_meal_plan_route(plan_id: str, authorization: str = Header(None)):
@@ -1204,12 +1729,137 @@ async def update_meal_plan_route(
     
     await update_meal_plan(plan_id, user["id"], updates)
     
+    if "days" in updates:
+        await refresh_shopping_list_for_plan(user["id"], {"id": plan_id, "days": updates["days"]})
+    
     return {"message": "Meal plan updated"}
 
+class RescaleRequest(BaseModel):
+    servings: int = Field(ge=1, le=50)
+
+@api_router.post("/meal-plans/{plan_id}/rescale", response_model=MealPlan)
+async def rescale_meal_plan(plan_id: str, rescale_data: RescaleRequest, authorization: str = Header(None)):
+    """Rescale every recipe to a new serving count locally, without another AI generation"""
+    user = await get_current_user(authorization)
+    
+    plan = await find_meal_plan_by_id(plan_id, user["id"])
+    if not plan:
+        raise HTTPException(status_code=404, detail="Meal plan not found")
+    
+    current_servings = plan.get("servings") or 1
+    if rescale_data.servings == current_servings:
+        return _plan_response(plan)
+    
+    scaled_days = scale_days(plan.get("days", []), current_servings, rescale_data.servings)
+    
+    # Days and servings go out in a single UPDATE so readers never see them disagree
+    await update_meal_plan(plan_id, user["id"], {"days": scaled_days, "servings": rescale_data.servings})
+    
+    updated_plan = {**plan, "days": scaled_days, "servings": rescale_data.servings}
+    await refresh_shopping_list_for_plan(user["id"], updated_plan)
+    return _plan_response(updated_plan)
+
 class RegenerateRequest(BaseModel):
     extra_restriction: Optional[str] = None
+    slots: Optional[List[str]] = None
+
+def _regeneration_targets(plan_days: List[dict], slots: Optional[List[str]]) -> Dict[str, List[str]]:
+    """Map day name -> meal types to regenerate, skipping locked days"""
+    targets = {}
+    if slots:
+        for slot in slots:
+            day_name, _, meal_type = slot.partition(":")
+            if meal_type not in MEAL_TYPES:
+                raise HTTPException(status_code=400, detail=f"Invalid slot: {slot}")
+            targets.setdefault(day_name, [])
+            if meal_type not in targets[day_name]:
+                targets[day_name].append(meal_type)
+    else:
+        targets = {day["day"]: list(MEAL_TYPES) for day in plan_days}
+    
+    locked_days = {day["day"] for day in plan_days if day.get("locked")}
+    known_days = {day["day"] for day in plan_days}
+    return {day: meal_types for day, meal_types in targets.items() if day in known_days and day not in locked_days}
+
+def _kept_meals_context(plan_days: List[dict], targets: Dict[str, List[str]]) -> str:
+    """Describe the meals that stay so the model can reuse their ingredients"""
+    lines = []
+    for day in plan_days:
+        for meal_type in MEAL_TYPES:
+            if meal_type in targets.get(day["day"], []):
+                continue
+            meal_name = (day.get("meals") or {}).get(meal_type)
+            if not meal_name:
+                continue
+            ingredients = ((day.get("recipes") or {}).get(meal_type) or {}).get("ingredients", [])
+            ingredient_text = f" ({', '.join(str(i) for i in ingredients)})" if ingredients else ""
+            lines.append(f"- {day['day']} {meal_type}: {meal_name}{ingredient_text}")
+    return "\n".join(lines)
+
+async def _regenerate_locally(user: dict, plan: dict, regen_data: RegenerateRequest, targets: Dict[str, List[str]]) -> dict:
+    """Regenerate the targeted slots from the stored meals library"""
+    plan_days = plan.get("days") or [_empty_plan_day(day) for day in WEEK_DAYS]
+    restrictions = list(user.get("allergies", []))
+    if regen_data.extra_restriction:
+        restrictions.append(regen_data.extra_restriction)
+    
+    await _fill_from_local_meals(
+        plan_days,
+        targets,
+        plan.get("cooking_methods", []),
+        plan.get("dietary_preferences", []),
+        restrictions,
+        False
+    )
+    await update_meal_plan(plan["id"], user["id"], {"days": plan_days})
+    
+    updated_plan = {**plan, "days": plan_days}
+    await refresh_shopping_list_for_plan(user["id"], updated_plan)
+    return updated_plan
 
-@api_router.post("/meal-plans/{plan_id}/regenerate", response_model=MealPlan)
+async def _regenerate_plan(user: dict, plan: dict, regen_data: RegenerateRequest, ai_config: dict, targets: Dict[str, List[str]]) -> dict:
+    """Regenerate the targeted slots of a stored plan and persist the merged days"""
+    plan_id = plan["id"]
+    plan_days = plan.get("days") or [_empty_plan_day(day) for day in WEEK_DAYS]
+    
+    all_restrictions = list(user.get("allergies", []))
+    if regen_data.extra_restriction:
+        all_restrictions.append(regen_data.extra_restriction)
+    
+    try:
+        prompt = _prompts_mod.regenerate_prompt(
+            plan.get("servings") or 1,
+            targets,
+            _kept_meals_context(plan_days, targets),
+            all_restrictions,
+            plan.get("goal"),
+            plan.get("dietary_preferences", []),
+            plan.get("cooking_methods", [])
+        )
+        prompt.log_usage()
+        
+        response = await call_llm(ai_config, prompt.user, prompt.system, MEAL_PLAN_FORMAT)
+        
+        ai_plan = parse_structured(AIMealPlan, response)
+        if not ai_plan.days:
+            raise StructuredOutputError("AI response contained no days")
+        _merge_ai_days(plan_days, ai_plan, targets)
+        await _enforce_allergens(user, plan_days, all_restrictions, ai_config, plan, targets)
+        
+        await update_meal_plan(plan_id, user["id"], {"days": plan_days})
+        
+        updated_plan = {**plan, "days": plan_days}
+        await refresh_shopping_list_for_plan(user["id"], updated_plan)
+        return updated_plan
+        
+    except LLMProviderError as e:
+        logging.error(f"AI provider unavailable, regenerating from the local planner: {e}")
+        return await _regenerate_locally(user, plan, regen_data, targets)
+    except Exception as e:
+        logging.error(f"AI regeneration error: {e}")
+        raise
+
+@api_router.post("/meal-plans/{plan_id}/regenerate", response_model=MealPlan, responses=PLAN_JOB_RESPONSES)
 async def regenerate_meal_plan(
     plan_id: str,
     regen_data: RegenerateRequest,
@@ -1221,200 +1871,641 @@ async def regenerate_meal_plan(
     if not plan:
         raise HTTPException(status_code=404, detail="Meal plan not found")
     
+    plan_days = plan.get("days") or [_empty_plan_day(day) for day in WEEK_DAYS]
+    targets = _regeneration_targets(plan_days, regen_data.slots)
+    if not targets:
+        return _plan_response(plan)
+    
     ai_config = await find_ai_config(user["id"])
-    if not ai_config or not ai_config.get("api_key"):
-        raise HTTPException(status_code=400, detail="Please configure your AI API key in Profile first")
+    if not has_llm_access(ai_config):
+        # No AI configured: the local planner answers in milliseconds, no job needed
+        return _plan_response(await _regenerate_locally(user, plan, regen_data, targets))
+    
+    payload = {"plan_id": plan_id, **regen_data.model_dump()}
+    job = await ai_request_flights.do(
+        flight_key(user["id"], "regenerate_meal_plan", payload),
+        lambda: enqueue_ai_job(user["id"], "regenerate_meal_plan", payload)
+    )
+    return _job_accepted_response(job)
+
+class SwapRequest(BaseModel):
+    extra_restriction: Optional[str] = None
+    prefer_local: bool = True
+
+def _plan_ingredient_names(plan_days: List[dict], exclude: tuple) -> set:
+    names = set()
+    for day in plan_days:
+        for meal_type, recipe in (day.get("recipes") or {}).items():
+            if (day["day"], meal_type) == exclude:
+                continue
+            names.update(item["name"].lower() for item in recipe_contribution(recipe).values())
+    return names
+
+def _meal_to_recipe(meal: dict) -> dict:
+    instructions = meal.get("instructions") or []
+    return {
+        "ingredients": [ingredient_text(ingredient) for ingredient in meal.get("ingredients") or []],
+        "instructions": "\n".join(f"{i + 1}. {step}" for i, step in enumerate(instructions)) if isinstance(instructions, list) else instructions,
+        "prep_time": meal.get("prep_time"),
+        "cook_time": meal.get("cook_time"),
+        "servings": meal.get("servings")
+    }
+
+def _meal_ingredient_names(meal: dict) -> set:
+    return {item["name"].lower() for item in recipe_contribution(_meal_to_recipe(meal)).values()}
+
+def _pick_local_swap(candidates: list, plan_days: List[dict], exclude: tuple) -> Optional[dict]:
+    """Pick the candidate sharing the most ingredients with the rest of the plan.
+    Returns None unless some candidate shares at least one ingredient, so an
+    unrelated meal never stands in for an AI suggestion."""
+    planned_names = {(day.get("meals") or {}).get(m, "") for day in plan_days for m in MEAL_TYPES}
+    planned_names = {name.lower() for name in planned_names if name}
+    plan_ingredients = _plan_ingredient_names(plan_days, exclude)
+    meal_type = exclude[1]
+    
+    best, best_score = None, 0
+    for candidate in candidates:
+        if candidate.name.lower() in planned_names or not candidate.fits_slot(meal_type):
+            continue
+        score = len(candidate.ingredients & plan_ingredients)
+        if score > best_score:
+            best, best_score = candidate.meal, score
+    return best
+
+def _repoint_leftover_lunch(plan_days: List[dict], day_index: int, meal_name: str, recipe: Optional[dict]) -> bool:
+    """After a dinner is replaced, keep the next day's leftover lunch consistent with it.
+    
+    An unlocked leftover lunch follows the new dinner; a locked one keeps its meal
+    but stops being a leftover, so its ingredients are bought. Returns whether the
+    next day changed.
+    """
+    if day_index + 1 >= len(plan_days):
+        return False
+    next_day = plan_days[day_index + 1]
+    if not (next_day.get("is_leftover") or {}).get("lunch"):
+        return False
+    if next_day.get("locked"):
+        next_day["is_leftover"] = {**next_day["is_leftover"], "lunch": False}
+    else:
+        _apply_ai_day(next_day, {"lunch": meal_name, "lunch_recipe": recipe, "lunch_is_leftover": True}, ["lunch"])
+    return True
+
+@api_router.post("/meal-plans/{plan_id}/days/{day}/{slot}/swap", response_model=MealPlan)
+async def swap_meal(
+    plan_id: str,
+    day: str,
+    slot: str,
+    swap_data: SwapRequest,
+    authorization: str = Header(None)
+):
+    """Replace one meal, from the local recipe store when possible, otherwise with a one-recipe AI prompt"""
+    user = await get_current_user(authorization)
     
-    user_allergies = user.get("allergies", [])
-    all_restrictions = list(user_allergies)
-    if regen_data.extra_restriction:
-        all_restrictions.append(regen_data.extra_restriction)
+    if slot not in MEAL_TYPES:
+        raise HTTPException(status_code=400, detail="Invalid meal slot")
     
-    restrictions_text = ""
-    if all_restrictions:
-        restrictions_text = f"CRITICAL RESTRICTIONS - NEVER INCLUDE: {', '.join(all_restrictions)}\n"
-    
-    dietary_prefs = plan.get("dietary_preferences", [])
-    cooking_methods = plan.get("cooking_methods", [])
-    goal = plan.get("goal", "")
-    
-    goal_context = ""
-    if goal:
-        goal_map = {
-            "lose_weight": "focused on calorie deficit, high protein, lower carbs for weight loss",
-            "gain_weight": "calorie surplus with nutrient-dense foods for healthy weight gain",
-            "gain_muscle": "high protein (1g per lb bodyweight), balanced carbs and fats for muscle building",
-            "eat_healthy": "balanced nutrition, whole foods, variety of nutrients",
-            "increase_energy": "complex carbs, B vitamins, sustained energy foods",
-            "improve_digestion": "fiber-rich, probiotic foods, gentle on stomach"
-        }
-        goal_context = f"Goal: {goal_map.get(goal, 'balanced nutrition')}\n"
+    plan = await find_meal_plan_by_id(plan_id, user["id"])
+    if not plan:
+        raise HTTPException(status_code=404, detail="Meal plan not found")
     
-    try:
-        import json
-        model = ai_config.get("model", "gpt-5.2")
-        
-        prompt = f"""Generate a complete 7-day weekly meal plan with DETAILED recipes.
-
-{restrictions_text}{goal_context}Dietary preferences: {', '.join(dietary_prefs) if dietary_prefs else 'None'}
-Cooking methods available: {', '.join(cooking_methods) if cooking_methods else 'Any'}
-
-For each day (Monday through Sunday), provide:
-- Breakfast with FULL recipe
-- Lunch with FULL recipe
-- Dinner with FULL recipe
-- Snack (simple)
-
-Each recipe MUST include:
-1. A list of ALL ingredients with exact quantities (e.g., "2 cups spinach", "1 tbsp olive oil")
-2. Detailed step-by-step cooking instructions (at least 4-6 steps)
-3. Prep time and cook time in minutes
-4. Number of servings
-
-IMPORTANT: DO NOT include any ingredients that contain or are derived from: {', '.join(all_restrictions) if all_restrictions else 'nothing restricted'}
-
-Respond ONLY with valid JSON in this exact format:
-{{
-  "days": [
-    {{
-      "day": "Monday",
-      "breakfast": "Meal name",
-      "breakfast_recipe": {{
-        "ingredients": ["2 large eggs", "1 cup spinach", "1/4 cup feta cheese", "1 tbsp olive oil", "Salt and pepper to taste"],
-        "instructions": "1. Heat olive oil in a non-stick pan over medium heat.\\n2. Add spinach and sauté for 2 minutes until wilted.\\n3. Crack eggs into the pan and scramble with the spinach.\\n4. Cook for 3-4 minutes until eggs are set but still moist.\\n5. Remove from heat, crumble feta cheese on top.\\n6. Season with salt and pepper, serve immediately.",
-        "prep_time": 5,
-        "cook_time": 10,
-        "servings": 1
-      }},
-      "lunch": "Meal name",
-      "lunch_recipe": {{...}},
-      "dinner": "Meal name",
-      "dinner_recipe": {{...}},
-      "snack": "Snack name"
-    }}
-  ]
-}}"""
+    plan_days = plan.get("days", [])
+    day_index = next((i for i, d in enumerate(plan_days) if d["day"].lower() == day.lower()), None)
+    if day_index is None:
+        raise HTTPException(status_code=404, detail="Day not found in meal plan")
+    plan_day = plan_days[day_index]
+    if plan_day.get("locked"):
+        raise HTTPException(status_code=400, detail="This day is locked")
+    
+    restrictions = list(user.get("allergies", []))
+    if swap_data.extra_restriction:
+        restrictions.append(swap_data.extra_restriction)
+    
+    meal_name, recipe = None, None
+    
+    if swap_data.prefer_local:
+        cooking_methods = plan.get("cooking_methods") or []
+        candidates = await _local_candidates(cooking_methods, plan.get("dietary_preferences") or [], restrictions)
+        if cooking_methods:
+            # build_candidates relaxes the method filter; a single swap should not
+            candidates = [c for c in candidates if c.meal.get("cooking_method") in cooking_methods]
+        local_meal = _pick_local_swap(candidates, plan_days, (plan_day["day"], slot))
+        if local_meal:
+            meal_name, recipe = local_meal["name"], _meal_to_recipe(local_meal)
+    
+    if meal_name is None:
+        ai_config = await find_ai_config(user["id"])
+        if not has_llm_access(ai_config):
+            raise HTTPException(status_code=400, detail="No matching saved meal. Configure your AI API key in Profile to generate one.")
         
-        response = await call_openai(ai_config["api_key"], prompt, None, model)
+        servings = plan.get("servings") or 1
+        plan_ingredients = sorted(_plan_ingredient_names(plan_days, (plan_day["day"], slot)))
+        current_meal = (plan_day.get("meals") or {}).get(slot)
         
-        response_text = response if isinstance(response, str) else str(response)
-        start_idx = response_text.find('{')
-        end_idx = response_text.rfind('}') + 1
+        prompt = _prompts_mod.swap_prompt(
+            slot, servings, current_meal, plan_ingredients[:40], plan.get("dietary_preferences") or [], restrictions
+        )
+        prompt.log_usage()
         
-        days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-        plan_days = [
-            {"day": day, "meals": {"breakfast": None, "lunch": None, "dinner": None, "snack": None}, "instructions": {}, "recipes": {}, "locked": False}
-            for day in days
-        ]
+        try:
+            response = await call_llm(ai_config, prompt.user, prompt.system, MEAL_SWAP_FORMAT)
+            ai_swap = parse_structured(AIMealSwap, response)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logging.error(f"AI swap error: {e}")
+            raise HTTPException(status_code=500, detail=f"AI generation failed: {str(e)}")
         
-        if start_idx != -1 and end_idx > start_idx:
-            json_str = response_text[start_idx:end_idx]
-            ai_data = json.loads(json_str)
-            
-            if "days" in ai_data:
-                for i, ai_day in enumerate(ai_data["days"]):
-                    if i < len(plan_days):
-                        plan_days[i]["meals"]["breakfast"] = ai_day.get("breakfast", "")
-                        plan_days[i]["meals"]["lunch"] = ai_day.get("lunch", "")
-                        plan_days[i]["meals"]["dinner"] = ai_day.get("dinner", "")
-                        plan_days[i]["meals"]["snack"] = ai_day.get("snack", "")
-                        
-                        plan_days[i]["recipes"] = {}
-                        plan_days[i]["instructions"] = {}
-                        
-                        for meal_type in ["breakfast", "lunch", "dinner"]:
-                            recipe_key = f"{meal_type}_recipe"
-                            if recipe_key in ai_day and ai_day[recipe_key]:
-                                recipe = ai_day[recipe_key]
-                                plan_days[i]["recipes"][meal_type] = {
-                                    "ingredients": recipe.get("ingredients", []),
-                                    "instructions": recipe.get("instructions", ""),
-                                    "prep_time": recipe.get("prep_time"),
-                                    "cook_time": recipe.get("cook_time"),
-                                    "servings": recipe.get("servings")
-                                }
-                                plan_days[i]["instructions"][meal_type] = f"Prep: {recipe.get('prep_time', '?')} min | Cook: {recipe.get('cook_time', '?')} min"
-                        
-                        plan_days[i]["instructions"]["snack"] = ""
+        meal_name = ai_swap.name
+        if not meal_name:
+            raise HTTPException(status_code=500, detail="AI generation returned no meal")
+        recipe = ai_swap.recipe.model_dump() if ai_swap.recipe and slot != "snack" else None
         
+        violations = get_allergen_matcher(restrictions).meal_violations(
+            {"name": meal_name, "ingredients": (recipe or {}).get("ingredients", [])}
+        )
+        if violations:
+            logging.warning(f"AI swap suggestion {meal_name} contains {violations}")
+            raise HTTPException(status_code=500, detail=f"AI suggestion contained restricted ingredients ({', '.join(violations)}). Please try again.")
+    
+    _apply_ai_day(plan_day, {slot: meal_name, f"{slot}_recipe": recipe}, [slot])
+    plan_day["is_leftover"][slot] = False
+    
+    if slot == "dinner" and _repoint_leftover_lunch(plan_days, day_index, meal_name, plan_day["recipes"].get(slot)):
+        # Two days changed, and the slot update always clears is_leftover
         await update_meal_plan(plan_id, user["id"], {"days": plan_days})
+    else:
+        await update_meal_plan_slot(
+            plan_id, user["id"], day_index, slot, meal_name,
+            plan_day["recipes"].get(slot), plan_day["instructions"].get(slot, "")
+        )
+    
+    updated_plan = {**plan, "days": plan_days}
+    await refresh_shopping_list_for_plan(user["id"], updated_plan)
+    return _plan_response(updated_plan)
+
+class OptimizeRequest(BaseModel):
+    apply: bool = False
+    max_swaps: int = Field(default=5, ge=1, le=28)
+
+@api_router.post("/meal-plans/{plan_id}/optimize")
+async def optimize_meal_plan(plan_id: str, optimize_data: OptimizeRequest, authorization: str = Header(None)):
+    """Suggest (or apply) swaps from the meals library that shrink the shopping list"""
+    user = await get_current_user(authorization)
+    
+    plan = await find_meal_plan_by_id(plan_id, user["id"])
+    if not plan:
+        raise HTTPException(status_code=404, detail="Meal plan not found")
+    
+    plan_days = plan.get("days") or []
+    slots = []
+    for idx, day in enumerate(plan_days):
+        is_leftover = day.get("is_leftover") or {}
+        feeds_leftover = idx + 1 < len(plan_days) and (plan_days[idx + 1].get("is_leftover") or {}).get("lunch")
+        for meal_type in MEAL_TYPES:
+            recipe = (day.get("recipes") or {}).get(meal_type)
+            if not recipe or is_leftover.get(meal_type):
+                continue
+            names = frozenset(item["name"].lower() for item in recipe_contribution(recipe).values())
+            movable = not day.get("locked") and not (meal_type == "dinner" and feeds_leftover)
+            slots.append((day["day"], meal_type, names, movable))
+    
+    planned_names = {(day.get("meals") or {}).get(m) for day in plan_days for m in MEAL_TYPES}
+    planned_names = {name.lower() for name in planned_names if name}
+    candidates = [
+        c for c in await _local_candidates(
+            plan.get("cooking_methods") or [],
+            plan.get("dietary_preferences") or [],
+            user.get("allergies", [])
+        )
+        if c.name.lower() not in planned_names
+    ]
+    optimizer_candidates = [
+        (i, c.name, c.ingredients, frozenset(m for m in MEAL_TYPES if c.fits_slot(m)))
+        for i, c in enumerate(candidates)
+    ]
+    
+    result = await asyncio.get_running_loop().run_in_executor(
+        optimizer_executor,
+        _optimizer_mod.optimize_plan,
+        slots,
+        optimizer_candidates,
+        optimize_data.max_swaps
+    )
+    
+    by_name = {day["day"]: day for day in plan_days}
+    for swap in result["swaps"]:
+        meal = candidates[swap.pop("candidate")].meal
+        swap["from"] = (by_name[swap["day"]].get("meals") or {}).get(swap["meal_type"])
+        if optimize_data.apply:
+            _apply_ai_day(
+                by_name[swap["day"]],
+                {swap["meal_type"]: meal["name"], f"{swap['meal_type']}_recipe": _meal_to_recipe(meal)},
+                [swap["meal_type"]]
+            )
+    
+    if optimize_data.apply and result["swaps"]:
+        await update_meal_plan(plan_id, user["id"], {"days": plan_days})
+        await refresh_shopping_list_for_plan(user["id"], {**plan, "days": plan_days})
+    
+    return {**result, "applied": optimize_data.apply and bool(result["swaps"])}
+
+# ============== AI Job Queue ==============
+
+async def enqueue_ai_job(
+    user_id: str,
+    job_type: str,
+    payload: Dict[str, Any],
+    priority: int = AI_JOB_PRIORITY_INTERACTIVE,
+    batch: bool = False
+) -> dict:
+    """Queue a job for the worker pool, or with `batch` hold it for the next provider batch"""
+    job_doc = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "job_type": job_type,
+        "payload": payload,
+        "priority": priority,
+        "status": "batch_pending" if batch else "queued"
+    }
+    await insert_ai_job(job_doc)
+    if not batch:
+        ai_job_pool.notify()
+    return job_doc
+
+def _job_accepted_response(job: dict) -> JSONResponse:
+    return JSONResponse(status_code=202, content=JobAccepted(
+        job_id=job["id"],
+        status=job["status"],
+        status_url=f"/api/jobs/{job['id']}"
+    ).model_dump())
+
+async def _run_create_meal_plan_job(user: dict, payload: Dict[str, Any]) -> Dict[str, Any]:
+    ai_config = await find_ai_config(user["id"])
+    plan_doc = await _build_meal_plan(user, MealPlanCreate(**payload["plan_data"]), ai_config)
+    await insert_meal_plan(plan_doc)
+    return {"plan_id": plan_doc["id"]}
+
+async def _run_regenerate_meal_plan_job(user: dict, payload: Dict[str, Any]) -> Dict[str, Any]:
+    plan = await find_meal_plan_by_id(payload["plan_id"], user["id"])
+    if not plan:
+        raise HTTPException(status_code=404, detail="Meal plan not found")
+    
+    ai_config = await find_ai_config(user["id"])
+    regen_data = RegenerateRequest(extra_restriction=payload.get("extra_restriction"), slots=payload.get("slots"))
+    plan_days = plan.get("days") or [_empty_plan_day(day) for day in WEEK_DAYS]
+    targets = _regeneration_targets(plan_days, regen_data.slots)
+    if targets and has_llm_access(ai_config):
+        await _regenerate_plan(user, plan, regen_data, ai_config, targets)
+    elif targets:
+        await _regenerate_locally(user, plan, regen_data, targets)
+    return {"plan_id": plan["id"]}
+
+async def _run_pregenerate_meal_plan_job(user: dict, payload: Dict[str, Any]) -> Dict[str, Any]:
+    source = await find_meal_plan_by_id(payload["source_plan_id"], user["id"])
+    if not source:
+        raise HTTPException(status_code=404, detail="Meal plan not found")
+    
+    ai_config = await find_ai_config(user["id"])
+    return await _insert_draft_plan(user, source, ai_config)
+
+def _pregeneration_plan_data(user: dict, source: dict) -> MealPlanCreate:
+    """Next week follows the user's current profile, falling back to the source plan's settings"""
+    return MealPlanCreate(
+        goal=user.get("health_goal") or source.get("goal"),
+        dietary_preferences=user.get("dietary_preferences") or source.get("dietary_preferences") or [],
+        cooking_methods=user.get("cooking_methods") or source.get("cooking_methods") or [],
+        servings=source.get("servings") or 1,
+        generate_with_ai=True
+    )
+
+async def _insert_draft_plan(user: dict, source: dict, ai_config: Optional[dict], ai_response: Optional[str] = None) -> Dict[str, Any]:
+    plan_doc = await _build_meal_plan(
+        user,
+        _pregeneration_plan_data(user, source),
+        ai_config,
+        start_date=datetime.fromisoformat(source["end_date"]),
+        ai_response=ai_response
+    )
+    plan_doc["status"] = "draft"
+    plan_doc["source_plan_id"] = source["id"]
+    await insert_meal_plan(plan_doc)
+    return {"plan_id": plan_doc["id"]}
+
+AI_JOB_HANDLERS = {
+    "create_meal_plan": _run_create_meal_plan_job,
+    "regenerate_meal_plan": _run_regenerate_meal_plan_job,
+    "pregenerate_meal_plan": _run_pregenerate_meal_plan_job,
+}
+
+def _is_offpeak(now: datetime) -> bool:
+    if PREGEN_OFFPEAK_START_HOUR <= PREGEN_OFFPEAK_END_HOUR:
+        return PREGEN_OFFPEAK_START_HOUR <= now.hour < PREGEN_OFFPEAK_END_HOUR
+    return now.hour >= PREGEN_OFFPEAK_START_HOUR or now.hour < PREGEN_OFFPEAK_END_HOUR
+
+async def schedule_pregeneration() -> int:
+    """Queue low-priority draft generation for plans ending in 24-48 hours.
+    
+    Only runs inside the off-peak window (UTC) and stops once the day's estimated
+    token spend would exceed PREGEN_DAILY_TOKEN_BUDGET. Returns the number queued.
+    """
+    now = datetime.now(timezone.utc)
+    if not _is_offpeak(now):
+        return 0
+    
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    spent = await sum_ai_job_tokens("pregenerate_meal_plan", day_start)
+    if spent >= PREGEN_DAILY_TOKEN_BUDGET:
+        return 0
+    
+    due = await find_plans_due_for_pregeneration(
+        (now + timedelta(hours=24)).isoformat(),
+        (now + timedelta(hours=48)).isoformat(),
+        PREGEN_BATCH_SIZE,
+        PREGEN_RETRY_COOLDOWN_SECONDS,
+        PREGEN_MAX_FAILURES
+    )
+    queued = 0
+    for plan in due:
+        user = await find_user_by_id(plan["user_id"])
+        ai_config = await find_ai_config(plan["user_id"])
+        if not user or not has_llm_access(ai_config):
+            # Local plans take milliseconds; nothing to gain from drafting them early
+            continue
         
-        updated_plan = await find_meal_plan_by_id(plan_id, user["id"])
-        return MealPlan(**updated_plan)
+        prompt = _prompts_mod.meal_plan_prompt(
+            plan.get("servings") or 1,
+            user.get("health_goal") or plan.get("goal"),
+            user.get("allergies") or [],
+            user.get("dietary_preferences") or [],
+            user.get("cooking_methods") or [],
+            True
+        )
+        estimated_tokens = prompt.total_tokens + PREGEN_OUTPUT_TOKEN_ESTIMATE
+        if spent + estimated_tokens > PREGEN_DAILY_TOKEN_BUDGET:
+            logging.info(f"Pre-generation token budget reached after {queued} plans")
+            break
         
+        await enqueue_ai_job(
+            plan["user_id"],
+            "pregenerate_meal_plan",
+            {"source_plan_id": plan["id"], "estimated_tokens": estimated_tokens},
+            priority=AI_JOB_PRIORITY_BACKGROUND,
+            batch=AI_BATCH_ENABLED and _batch_mod.supports_batch(ai_config.get("provider") or "openai")
+        )
+        spent += estimated_tokens
+        queued += 1
+    
+    if queued:
+        logging.info(f"Queued {queued} speculative next-week plans")
+    return queued
+
+async def process_ai_job(job: Dict[str, Any]) -> None:
+    handler = AI_JOB_HANDLERS.get(job["job_type"])
+    user = await find_user_by_id(job["user_id"])
+    if not handler or not user:
+        await fail_ai_job(job["id"], f"Cannot run {job['job_type']} job")
+        return
+    
+    try:
+        result = await handler(_normalize_user(user), job.get("payload") or {})
+        await complete_ai_job(job["id"], result)
+    except HTTPException as e:
+        if e.status_code == 429:
+            # Over the user's LLM budget; run it once the bucket refills without spending an attempt
+            await defer_ai_job(job["id"], float((e.headers or {}).get("Retry-After", AI_JOB_RETRY_BASE_SECONDS)))
+            return
+        # Validation failures will not get better on retry
+        await fail_ai_job(job["id"], str(e.detail))
     except Exception as e:
-        logging.error(f"AI regeneration error: {e}")
-        raise HTTPException(status_code=500, detail=f"AI generation failed: {str(e)}")
+        logging.error(f"AI job {job['id']} ({job['job_type']}) attempt {job['attempts']} failed: {e}")
+        await fail_ai_job(job["id"], str(e), retry_in_seconds=AI_JOB_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1))
+
+ai_job_pool = _jobs_mod.JobWorkerPool(
+    claim=lambda: claim_ai_job(AI_JOBS_PER_USER),
+    process=process_ai_job,
+    concurrency=AI_JOB_WORKERS,
+    name="ai-jobs"
+)
 
-# ============== Shopping List Routes ==============
+pregeneration_task = _jobs_mod.PeriodicTask(schedule_pregeneration, PREGEN_INTERVAL_SECONDS, name="pregeneration")
+
+# ============== Provider Batches ==============
+
+async def _pregenerate_batch_request(user: dict, payload: Dict[str, Any]) -> Optional[Any]:
+    source = await find_meal_plan_by_id(payload["source_plan_id"], user["id"])
+    if not source:
+        return None
+    plan_data = _pregeneration_plan_data(user, source)
+    prompt = _prompts_mod.meal_plan_prompt(
+        plan_data.servings,
+        plan_data.goal,
+        user.get("allergies", []),
+        plan_data.dietary_preferences,
+        plan_data.cooking_methods,
+        plan_data.use_leftovers
+    )
+    return prompt.user, prompt.system, MEAL_PLAN_FORMAT
+
+async def _apply_pregenerate_batch_result(user: dict, payload: Dict[str, Any], content: str) -> Dict[str, Any]:
+    source = await find_meal_plan_by_id(payload["source_plan_id"], user["id"])
+    if not source:
+        raise HTTPException(status_code=404, detail="Meal plan not found")
+    ai_config = await find_ai_config(user["id"])
+    return await _insert_draft_plan(user, source, ai_config, ai_response=content)
 
-INGREDIENT_CATEGORIES = {
-    "chicken": "Proteins", "beef": "Proteins", "pork": "Proteins", "fish": "Proteins",
-    "salmon": "Proteins", "tuna": "Proteins", "shrimp": "Proteins", "turkey": "Proteins",
-    "egg": "Proteins", "eggs": "Proteins", "tofu": "Proteins", "tempeh": "Proteins",
-    "milk": "Dairy", "cheese": "Dairy", "yogurt": "Dairy", "butter": "Dairy",
-    "cream": "Dairy", "feta": "Dairy", "parmesan": "Dairy", "mozzarella": "Dairy",
-    "spinach": "Produce", "lettuce": "Produce", "tomato": "Produce", "onion": "Produce",
-    "garlic": "Produce", "pepper": "Produce", "carrot": "Produce", "broccoli": "Produce",
-    "cucumber": "Produce", "avocado": "Produce", "lemon": "Produce", "lime": "Produce",
-    "apple": "Produce", "banana": "Produce", "berry": "Produce", "berries": "Produce",
-    "mushroom": "Produce", "zucchini": "Produce", "potato": "Produce", "sweet potato": "Produce",
-    "rice": "Grains & Bread", "pasta": "Grains & Bread", "bread": "Grains & Bread",
-    "oats": "Grains & Bread", "quinoa": "Grains & Bread", "tortilla": "Grains & Bread",
-    "oil": "Pantry", "olive oil": "Pantry", "salt": "Pantry",
-    "sugar": "Pantry", "flour": "Pantry", "honey": "Pantry", "vinegar": "Pantry",
-    "soy sauce": "Pantry", "sauce": "Pantry", "broth": "Pantry", "stock": "Pantry",
-    "almond": "Nuts & Seeds", "walnut": "Nuts & Seeds", "peanut": "Nuts & Seeds",
-    "cashew": "Nuts & Seeds", "seed": "Nuts & Seeds", "nut": "Nuts & Seeds",
+# job_type -> (build (prompt, system, response_format) or None, apply completion text)
+AI_BATCH_HANDLERS = {
+    "pregenerate_meal_plan": (_pregenerate_batch_request, _apply_pregenerate_batch_result),
 }
 
-def categorize_ingredient(ingredient_name: str) -> str:
-    name_lower = ingredient_name.lower()
-    for keyword, category in INGREDIENT_CATEGORIES.items():
-        if keyword in name_lower:
-            return category
-    return "Other"
+async def submit_ai_batches() -> int:
+    """Group waiting jobs by provider, model and API key and submit one batch per group.
+    Jobs whose provider has no batch interface (or whose submit fails) go to the worker queue."""
+    jobs = await claim_batch_pending_ai_jobs(AI_BATCH_MAX_REQUESTS)
+    if not jobs:
+        return 0
+    
+    groups: Dict[tuple, Dict[str, Any]] = {}
+    unbatchable: List[str] = []
+    for job in jobs:
+        handlers = AI_BATCH_HANDLERS.get(job["job_type"])
+        user = await find_user_by_id(job["user_id"])
+        ai_config = await find_ai_config(job["user_id"])
+        if not handlers or not user or not has_llm_access(ai_config):
+            unbatchable.append(job["id"])
+            continue
+        target = llm_targets(ai_config)[0]
+        if not _batch_mod.supports_batch(target.provider):
+            unbatchable.append(job["id"])
+            continue
+        
+        built = await handlers[0](_normalize_user(user), job.get("payload") or {})
+        if built is None:
+            await fail_ai_job(job["id"], "Nothing to generate")
+            continue
+        prompt, system_message, response_format = built
+        group = groups.setdefault(
+            (target.provider, target.model, target.api_key),
+            {"target": target, "key_user_id": job["user_id"], "requests": [], "job_ids": []}
+        )
+        group["requests"].append(_batch_mod.BatchRequest(job["id"], prompt, system_message, response_format))
+        group["job_ids"].append(job["id"])
+    
+    submitted = 0
+    for group in groups.values():
+        target = group["target"]
+        batch_id = str(uuid.uuid4())
+        try:
+            provider_batch_id = await _batch_mod.BATCH_CLIENTS[target.provider].submit(
+                target, group["requests"], metadata={"batch_id": batch_id}
+            )
+        except LLMProviderError as e:
+            logging.error(f"Batch submit to {target.provider} failed, using the worker queue: {e}")
+            unbatchable.extend(group["job_ids"])
+            continue
+        
+        await insert_ai_batch({
+            "id": batch_id,
+            "provider": target.provider,
+            "model": target.model,
+            "key_user_id": group["key_user_id"],
+            "provider_batch_id": provider_batch_id,
+            "request_count": len(group["requests"])
+        })
+        await assign_ai_jobs_to_batch(group["job_ids"], batch_id)
+        submitted += len(group["job_ids"])
+    
+    if unbatchable:
+        await release_ai_jobs_to_queue(unbatchable)
+        ai_job_pool.notify()
+    if submitted:
+        logging.info(f"Submitted {submitted} AI jobs in {len(groups)} provider batches")
+    return submitted
+
+async def _collect_ai_batch(batch: Dict[str, Any]) -> None:
+    ai_config = await find_ai_config(batch["key_user_id"])
+    jobs = await find_ai_jobs_by_batch(batch["id"])
+    if not has_llm_access(ai_config):
+        await release_ai_jobs_to_queue([job["id"] for job in jobs])
+        await finish_ai_batch(batch["id"], "abandoned", 0, len(jobs), "API key no longer configured")
+        return
+    
+    target = _llm_mod.LLMTarget(provider=batch["provider"], model=batch["model"], api_key=ai_config.get("api_key"))
+    client = _batch_mod.BATCH_CLIENTS[batch["provider"]]
+    try:
+        status = await client.retrieve(target, batch["provider_batch_id"])
+    except LLMProviderError as e:
+        if e.retryable:
+            return
+        logging.error(f"Batch {batch['id']} cannot be retrieved, using the worker queue: {e}")
+        await release_ai_jobs_to_queue([job["id"] for job in jobs])
+        await finish_ai_batch(batch["id"], "lost", 0, len(jobs), str(e))
+        return
+    
+    if not status.done:
+        if status.status != batch["status"]:
+            await update_ai_batch_status(batch["id"], status.status)
+        return
+    
+    results = await client.results(target, status)
+    succeeded, retry = 0, []
+    for job in jobs:
+        result = results.get(job["id"])
+        user = await find_user_by_id(job["user_id"])
+        if result is None or result.error or not user:
+            # Expired or failed lines get one more chance through the interactive path
+            retry.append(job["id"])
+            continue
+        apply = AI_BATCH_HANDLERS[job["job_type"]][1]
+        try:
+            outcome = await apply(_normalize_user(user), job.get("payload") or {}, result.content)
+            await complete_ai_job(job["id"], outcome)
+            succeeded += 1
+        except HTTPException as e:
+            await fail_ai_job(job["id"], str(e.detail))
+        except Exception as e:
+            logging.error(f"Applying batch result for job {job['id']} failed: {e}")
+            retry.append(job["id"])
+    
+    await release_ai_jobs_to_queue(retry)
+    if retry:
+        ai_job_pool.notify()
+    await finish_ai_batch(batch["id"], status.status, succeeded, len(jobs) - succeeded)
+    logging.info(f"Batch {batch['id']} {status.status}: {succeeded}/{len(jobs)} plans generated")
+
+async def run_ai_batches() -> None:
+    """Fan finished batches back into their jobs, then submit whatever has accumulated"""
+    for batch in await find_open_ai_batches():
+        await _collect_ai_batch(batch)
+    await submit_ai_batches()
+
+ai_batch_task = _jobs_mod.PeriodicTask(run_ai_batches, AI_BATCH_POLL_SECONDS, name="ai-batches")
+
+@api_router.get("/admin/ai-batches")
+async def list_ai_batches(authorization: str = Header(None)):
+    user = await get_current_user(authorization)
+    
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    batches = await find_recent_ai_batches()
+    return [
+        {**batch, "created_at": str(batch["created_at"]), "completed_at": str(batch["completed_at"]) if batch.get("completed_at") else None}
+        for batch in batches
+    ]
 
-def parse_ingredient_string(ingredient_str: str) -> dict:
-    import re
+@api_router.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, authorization: str = Header(None)):
+    user = await get_current_user(authorization)
     
-    pattern = r'^([\d\/\.\s]+)?\s*(cups?|tbsp|tsp|oz|lb|g|kg|ml|l|bunch|cloves?|pieces?|slices?|cans?|bottles?|packages?|stalks?)?\s*(.+)$'
-    match = re.match(pattern, ingredient_str.strip(), re.IGNORECASE)
+    job = await find_ai_job(job_id, user["id"])
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
     
-    if match:
-        quantity_str = match.group(1) or "1"
-        unit = match.group(2) or "unit"
-        name = match.group(3) or ingredient_str
+    return {
+        "id": job["id"],
+        "job_type": job["job_type"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "result": job.get("result"),
+        "error": job.get("error") if job["status"] == "failed" else None,
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"]
+    }
+
+# ============== Shopping List Routes ==============
+
+async def _materialize_shopping_items(user_id: str, totals: Dict[str, dict], subtract_pantry: bool, previous_items: Optional[List[dict]] = None) -> List[dict]:
+    pantry_items = await find_pantry_by_user(user_id) if subtract_pantry else []
+    items = subtract_pantry_items(totals, pantry_items)
+    return finalize_shopping_items(items, previous_items)
+
+async def refresh_shopping_list_for_plan(user_id: str, plan: dict) -> Optional[dict]:
+    """Apply a meal plan change to its materialized shopping list as a per-slot delta.
+    The list row stays locked from read to write, so concurrent edits can't drop each other's deltas."""
+    new_contributions = plan_contributions(plan.get("days", []))
+    
+    async def apply_delta(shopping_list: dict) -> Optional[dict]:
+        old_contributions = shopping_list.get("contributions")
+        totals = shopping_list.get("totals")
         
-        try:
-            if '/' in quantity_str:
-                parts = quantity_str.strip().split()
-                total = 0
-                for part in parts:
-                    if '/' in part:
-                        num, denom = part.split('/')
-                        total += float(num) / float(denom)
-                    else:
-                        total += float(part) if part else 0
-                quantity = total
-            else:
-                quantity = float(quantity_str.strip()) if quantity_str.strip() else 1
-        except:
-            quantity = 1
+        if old_contributions is None or totals is None:
+            # Lists created before contributions were tracked get rebuilt once
+            totals = aggregate_contributions(new_contributions)
+        elif not apply_contribution_delta(totals, old_contributions, new_contributions):
+            return None
         
+        items = await _materialize_shopping_items(
+            user_id, totals, shopping_list.get("subtract_pantry", True), shopping_list.get("items")
+        )
         return {
-            "name": name.strip(),
-            "quantity": quantity,
-            "unit": unit.lower(),
-            "category": categorize_ingredient(name)
+            "items": items,
+            "contributions": new_contributions,
+            "totals": totals,
+            "updated_at": datetime.now(timezone.utc).isoformat()
         }
     
-    return {
-        "name": ingredient_str.strip(),
-        "quantity": 1,
-        "unit": "unit",
-        "category": categorize_ingredient(ingredient_str)
-    }
+    return await modify_shopping_list(user_id, apply_delta, meal_plan_id=plan["id"])
 
 @api_router.post("/shopping-lists", response_model=ShoppingList)
 async def generate_shopping_list(meal_plan_id: str, subtract_pantry: bool = True, authorization: str = Header(None)):
@@ -1424,98 +2515,84 @@ async def generate_shopping_list(meal_plan_id: str, subtract_pantry: bool = True
     if not plan:
         raise HTTPException(status_code=404, detail="Meal plan not found")
     
-    servings = plan.get("servings", 1)
+    existing = await find_shopping_list_by_meal_plan(meal_plan_id, user["id"])
+    if existing and existing.get("subtract_pantry", True) == subtract_pantry:
+        refreshed = await refresh_shopping_list_for_plan(user["id"], plan)
+        return ShoppingList(**refreshed)
     
-    all_ingredients = {}
+    contributions = plan_contributions(plan.get("days", []))
+    totals = aggregate_contributions(contributions)
+    now = datetime.now(timezone.utc).isoformat()
     
-    for day in plan.get("days", []):
-        recipes = day.get("recipes", {})
-        is_leftover = day.get("is_leftover", {})
-        
-        for meal_type in ["breakfast", "lunch", "dinner", "snack"]:
-            if is_leftover.get(meal_type, False):
-                continue
-                
-            recipe = recipes.get(meal_type, {})
-            ingredients_list = recipe.get("ingredients", [])
-            
-            for ingredient in ingredients_list:
-                if isinstance(ingredient, str):
-                    parsed = parse_ingredient_string(ingredient)
-                elif isinstance(ingredient, dict):
-                    parsed = {
-                        "name": ingredient.get("name", "Unknown"),
-                        "quantity": ingredient.get("quantity", 1),
-                        "unit": ingredient.get("unit", "unit"),
-                        "category": ingredient.get("category") or categorize_ingredient(ingredient.get("name", ""))
-                    }
-                else:
-                    continue
-                
-                key = f"{parsed['name'].lower()}_{parsed['unit']}"
-                if key in all_ingredients:
-                    all_ingredients[key]["quantity"] += parsed["quantity"]
-                else:
-                    all_ingredients[key] = {
-                        "name": parsed["name"],
-                        "quantity": parsed["quantity"],
-                        "unit": parsed["unit"],
-                        "category": parsed["category"],
-                        "checked": False,
-                        "in_pantry": False,
-                        "pantry_has": 0
-                    }
-    
-    if subtract_pantry:
-        pantry_items = await find_pantry_by_user(user["id"])
+    if existing:
+        async def rebuild(shopping_list: dict) -> dict:
+            items = await _materialize_shopping_items(user["id"], totals, subtract_pantry, shopping_list.get("items"))
+            return {
+                "items": items,
+                "contributions": contributions,
+                "totals": totals,
+                "subtract_pantry": subtract_pantry,
+                "updated_at": now
+            }
         
-        for pantry_item in pantry_items:
-            pantry_name = pantry_item["name"].lower()
-            pantry_unit = pantry_item["unit"].lower()
-            pantry_qty = pantry_item["quantity"]
-            
-            for key in list(all_ingredients.keys()):
-                item = all_ingredients[key]
-                item_name = item["name"].lower()
-                
-                if pantry_name in item_name or item_name in pantry_name:
-                    if pantry_unit == item["unit"].lower() or pantry_unit in item["unit"].lower():
-                        item["in_pantry"] = True
-                        item["pantry_has"] = pantry_qty
-                        
-                        new_qty = item["quantity"] - pantry_qty
-                        if new_qty <= 0:
-                            item["quantity"] = 0
-                            item["checked"] = True
-                        else:
-                            item["quantity"] = new_qty
-    
-    final_items = []
-    for key in all_ingredients:
-        item = all_ingredients[key]
-        qty = item["quantity"]
-        if qty > 0:
-            if qty == int(qty):
-                item["quantity"] = int(qty)
-            else:
-                item["quantity"] = round(qty, 2)
-            final_items.append(item)
-        elif item.get("in_pantry"):
-            item["quantity"] = 0
-            final_items.append(item)
+        rebuilt = await modify_shopping_list(user["id"], rebuild, list_id=existing["id"])
+        if rebuilt:
+            return ShoppingList(**rebuilt)
     
-    list_id = str(uuid.uuid4())
+    items = await _materialize_shopping_items(user["id"], totals, subtract_pantry)
     list_doc = {
-        "id": list_id,
+        "id": str(uuid.uuid4()),
         "user_id": user["id"],
         "meal_plan_id": meal_plan_id,
-        "items": final_items,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "items": items,
+        "contributions": contributions,
+        "totals": totals,
+        "subtract_pantry": subtract_pantry,
+        "created_at": now,
+        "updated_at": now
     }
     
     await insert_shopping_list(list_doc)
     return ShoppingList(**list_doc)
 
+@api_router.post("/shopping-lists/consolidated")
+async def generate_consolidated_shopping_list(request_data: ConsolidatedShoppingListRequest, authorization: str = Header(None)):
+    """Combined list for several plans, streamed back as one JSON line per category"""
+    import json
+    user = await get_current_user(authorization)
+    
+    has_range = bool(request_data.start_date and request_data.end_date)
+    if not request_data.meal_plan_ids and not has_range:
+        raise HTTPException(status_code=400, detail="Provide meal_plan_ids or both start_date and end_date")
+    
+    start_date = end_date = None
+    if has_range:
+        try:
+            start_date = datetime.fromisoformat(request_data.start_date).date()
+            end_date = datetime.fromisoformat(request_data.end_date).date()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="start_date and end_date must be ISO dates")
+    
+    plans = await find_meal_plans_for_consolidation(user["id"], request_data.meal_plan_ids, start_date, end_date)
+    if not plans:
+        raise HTTPException(status_code=404, detail="No matching meal plans found")
+    
+    totals = aggregate_normalized([plan_contributions(plan.get("days", [])) for plan in plans])
+    pantry_items = await find_pantry_by_user(user["id"]) if request_data.subtract_pantry else []
+    items = finalize_shopping_items(subtract_pantry_normalized(totals, pantry_items))
+    grouped = group_by_category(items)
+    
+    def stream_lines():
+        yield json.dumps({
+            "meal_plan_ids": [plan["id"] for plan in plans],
+            "item_count": len(items),
+            "categories": list(grouped.keys())
+        }) + "\n"
+        for category, category_items in grouped.items():
+            yield json.dumps({"category": category, "items": category_items}) + "\n"
+    
+    return StreamingResponse(stream_lines(), media_type="application/x-ndjson")
+
 @api_router.get("/shopping-lists", response_model=List[ShoppingList])
 async def get_shopping_lists(authorization: str = Header(None)):
     user = await get_current_user(authorization)
@@ -1523,6 +2600,33 @@ async def get_shopping_lists(authorization: str = Header(None)):
     lists = await find_shopping_lists_by_user(user["id"])
     return [ShoppingList(**lst) for lst in lists]
 
+@api_router.put("/shopping-lists/{list_id}/items/check", response_model=ShoppingList)
+async def check_shopping_list_item(list_id: str, check: ShoppingItemCheck, authorization: str = Header(None)):
+    """Check or uncheck one item. Checks made here survive later refreshes of the list;
+    items checked automatically because the pantry covers them do not."""
+    user = await get_current_user(authorization)
+    key = ingredient_key({"name": check.name, "unit": check.unit})
+    found = False
+    
+    async def set_checked(shopping_list: dict) -> Optional[dict]:
+        nonlocal found
+        items = shopping_list.get("items") or []
+        for item in items:
+            if ingredient_key(item) == key:
+                item["checked"] = check.checked
+                item["checked_by_user"] = check.checked
+                found = True
+        if not found:
+            return None
+        return {"items": items, "updated_at": datetime.now(timezone.utc).isoformat()}
+    
+    updated = await modify_shopping_list(user["id"], set_checked, list_id=list_id)
+    if updated is None:
+        raise HTTPException(status_code=404, detail="Shopping list not found")
+    if not found:
+        raise HTTPException(status_code=404, detail="Item not found in shopping list")
+    return ShoppingList(**updated)
+
 @api_router.delete("/shopping-lists/{list_id}")
 async def delete_shopping_list_route(list_id: str, authorization: str = Header(None)):
     user = await get_current_user(authorization)
@@ -1750,59 +2854,29 @@ async def ai_recommend_supplements(
     user = await get_current_user(authorization)
     
     ai_config = await find_ai_config(user["id"])
-    if not ai_config or not ai_config.get("api_key"):
+    if not has_llm_access(ai_config):
         raise HTTPException(status_code=400, detail="AI configuration required. Please add API key in Profile settings.")
     
     all_supplements = await find_all_supplements()
     supp_names = [s["name"] for s in all_supplements]
     
-    goal_map = {
-        "lose_weight": "weight loss, fat burning, metabolism boost",
-        "gain_weight": "healthy weight gain, muscle building, calorie increase",
-        "gain_muscle": "muscle growth, strength, recovery, protein synthesis",
-        "eat_healthy": "overall health, wellness, nutritional balance",
-        "increase_energy": "energy boost, reduce fatigue, vitality",
-        "improve_digestion": "digestive health, gut health, nutrient absorption",
-        "better_sleep": "sleep quality, relaxation, recovery",
-        "reduce_stress": "stress management, mood support, mental clarity",
-        "boost_immunity": "immune system support, illness prevention",
-        "joint_health": "joint support, flexibility, inflammation reduction"
-    }
-    
-    goal_description = goal_map.get(goal, "general wellness")
-    
     try:
-        system_message = "You are an expert nutritionist and supplement advisor. Recommend evidence-based supplements."
         model = ai_config.get("model", "gpt-5.2")
+        prompt = _prompts_mod.supplement_prompt(goal, supp_names)
+        prompt.log_usage()
         
-        prompt = f"""Based on the health goal of "{goal_description}", recommend 5-8 supplements from this list:
-{', '.join(supp_names)}
-
-For each recommendation, provide:
-1. Supplement name (must match exactly from the list)
-2. Why it helps with {goal_description}
-3. Suggested daily dose
-4. Best time to take it
-
-Format as JSON:
-{{
-  "recommendations": [
-    {{
-      "name": "Supplement Name",
-      "reason": "Why it helps",
-      "suggested_dose": "Amount",
-      "timing": "When to take"
-    }}
-  ]
-}}"""
-        
-        response = await call_openai(ai_config["api_key"], prompt, system_message, model)
+        response = await ai_request_flights.do(
+            flight_key(user["id"], "ai_recommend_supplements", {"goal": goal, "provider": ai_config.get("provider"), "model": model}),
+            lambda: call_llm(ai_config, prompt.user, prompt.system)
+        )
         
         return {
             "goal": goal,
             "recommendations": response,
             "available_supplements": supp_names
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"AI supplement recommendation error: {e}")
         raise HTTPException(status_code=500, detail="Failed to generate recommendations")
@@ -1840,6 +2914,18 @@ async def update_ai_config_route(config_data: AIConfigUpdate, authorization: str
     if config_data.api_key and config_data.api_key != "********":
         update_data["api_key"] = config_data.api_key
     
+    if config_data.provider not in SELECTABLE_LLM_PROVIDERS:
+        raise HTTPException(status_code=400, detail=f"Unsupported AI provider: {config_data.provider}")
+    
+    if config_data.fallback_provider is not None:
+        if config_data.fallback_provider and config_data.fallback_provider not in SELECTABLE_LLM_PROVIDERS:
+            raise HTTPException(status_code=400, detail=f"Unsupported fallback provider: {config_data.fallback_provider}")
+        update_data["fallback_provider"] = config_data.fallback_provider or None
+        update_data["fallback_model"] = config_data.fallback_model
+    
+    if config_data.fallback_api_key and config_data.fallback_api_key != "********":
+        update_data["fallback_api_key"] = config_data.fallback_api_key
+    
     existing = await find_ai_config(user["id"])
     
     if existing:
@@ -1852,56 +2938,98 @@ async def update_ai_config_route(config_data: AIConfigUpdate, authorization: str
     
     return {"message": "AI configuration updated"}
 
+@api_router.get("/ai-config/health")
+async def get_ai_provider_health(authorization: str = Header(None)):
+    """Per-provider latency percentiles and failure counts seen by this server"""
+    await get_current_user(authorization)
+    return {"providers": llm_router.stats(), "governor": llm_governor.stats()}
+
 # ============== Subscription Routes ==============
 
 STRIPE_PRICES = {
     "monthly": {
         "amount": 999,
         "interval": "month",
-        "name": "Monthly Premium"
+        "name": "Monthly Premium",
+        "lookup_key": "conquerors_court_monthly"
     },
     "yearly": {
         "amount": 9999,
         "interval": "year",
-        "name": "Yearly Premium"
+        "name": "Yearly Premium",
+        "lookup_key": "conquerors_court_yearly"
     }
 }
 
+# Package id -> Stripe price id, filled at startup so checkout never looks prices up
+stripe_price_ids: Dict[str, str] = {}
+stripe_price_lock = asyncio.Lock()
+
+def _price_matches(package: Dict[str, Any], amount: Optional[int], interval: Optional[str]) -> bool:
+    return amount == package["amount"] and interval == package["interval"]
+
+async def _resolve_stripe_price(package_id: str, stored: Optional[Dict[str, Any]]) -> str:
+    """Price id for a package: the stored row, else the Stripe price carrying the
+    package's lookup_key, else a new one. Creation uses an idempotency key, so
+    processes starting together get the same Product and Price back."""
+    package = STRIPE_PRICES[package_id]
+    if stored and _price_matches(package, stored.get("amount"), stored.get("interval")):
+        return stored["stripe_price_id"]
+    
+    prices = await asyncio.to_thread(stripe.Price.list, lookup_keys=[package["lookup_key"]], active=True, limit=1)
+    price = prices.data[0] if prices.data else None
+    if not price or not _price_matches(package, price.unit_amount, (price.recurring or {}).get("interval")):
+        # transfer_lookup_key moves the key off a price whose amount or interval changed
+        price = await asyncio.to_thread(
+            stripe.Price.create,
+            unit_amount=package["amount"],
+            currency="usd",
+            recurring={"interval": package["interval"]},
+            lookup_key=package["lookup_key"],
+            transfer_lookup_key=True,
+            product_data={"name": f"Conqueror's Court {package['name']}"},
+            idempotency_key=f"price-{package['lookup_key']}-{package['amount']}-{package['interval']}"
+        )
+    
+    if stored:
+        await deactivate_stripe_price(package_id)
+    return await insert_stripe_price({
+        "id": str(uuid.uuid4()),
+        "package_id": package_id,
+        "price_id": price.id,
+        "amount": package["amount"],
+        "interval": package["interval"]
+    })
+
+async def warm_stripe_prices() -> None:
+    """Resolve every package's price once at startup; failures are retried lazily at checkout"""
+    if not stripe.api_key:
+        return
+    stored = {row["name"]: row for row in await find_active_stripe_prices()}
+    async with stripe_price_lock:
+        for package_id in STRIPE_PRICES:
+            try:
+                stripe_price_ids[package_id] = await _resolve_stripe_price(package_id, stored.get(package_id))
+            except stripe.error.StripeError as e:
+                logging.error(f"Stripe error resolving price for {package_id}: {e}")
+
 async def get_or_create_stripe_price(package_id: str) -> str:
     package = STRIPE_PRICES.get(package_id)
     if not package:
         raise HTTPException(status_code=400, detail="Invalid package")
     
-    cached_price = await find_stripe_price(package_id)
-    if cached_price:
-        return cached_price["stripe_price_id"]
+    price_id = stripe_price_ids.get(package_id)
+    if price_id:
+        return price_id
     
-    try:
-        product = stripe.Product.create(
-            name=f"Conqueror's Court {package['name']}",
-            description=f"Premium subscription - {package['name']}"
-        )
-        
-        price = stripe.Price.create(
-            product=product.id,
-            unit_amount=package["amount"],
-            currency="usd",
-            recurring={"interval": package["interval"]}
-        )
-        
-        await insert_stripe_price({
-            "id": str(uuid.uuid4()),
-            "package_id": package_id,
-            "price_id": price.id,
-            "product_id": product.id,
-            "amount": package["amount"],
-            "interval": package["interval"]
-        })
-        
-        return price.id
-    except stripe.error.StripeError as e:
-        logging.error(f"Stripe error creating price: {e}")
-        raise HTTPException(status_code=500, detail="Failed to create subscription price")
+    async with stripe_price_lock:
+        if package_id not in stripe_price_ids:
+            try:
+                stripe_price_ids[package_id] = await _resolve_stripe_price(package_id, await find_stripe_price(package_id))
+            except stripe.error.StripeError as e:
+                logging.error(f"Stripe error creating price: {e}")
+                raise HTTPException(status_code=500, detail="Failed to create subscription price")
+    return stripe_price_ids[package_id]
 
 @api_router.post("/subscriptions/checkout")
 async def create_checkout(checkout_req: CheckoutRequest, authorization: str = Header(None)):
@@ -1916,7 +3044,8 @@ async def create_checkout(checkout_req: CheckoutRequest, authorization: str = He
         stripe_customer_id = user.get("stripe_customer_id")
         
         if not stripe_customer_id:
-            customer = stripe.Customer.create(
+            customer = await asyncio.to_thread(
+                stripe.Customer.create,
                 email=user["email"],
                 name=user.get("name", ""),
                 metadata={"user_id": user["id"]}
@@ -1924,11 +3053,13 @@ async def create_checkout(checkout_req: CheckoutRequest, authorization: str = He
             stripe_customer_id = customer.id
             
             await update_user(user["id"], {"stripe_customer_id": stripe_customer_id})
+            stripe_customer_users.set(stripe_customer_id, user["id"])
         
         success_url = f"{checkout_req.origin_url}/subscription/success?session_id={{CHECKOUT_SESSION_ID}}"
         cancel_url = f"{checkout_req.origin_url}/subscription"
         
-        session = stripe.checkout.Session.create(
+        session = await asyncio.to_thread(
+            stripe.checkout.Session.create,
             customer=stripe_customer_id,
             payment_method_types=["card"],
             line_items=[{
@@ -1967,22 +3098,29 @@ async def create_checkout(checkout_req: CheckoutRequest, authorization: str = He
 async def check_subscription_status(session_id: str, authorization: str = Header(None)):
     user = await get_current_user(authorization)
     
+    transaction = await find_payment_transaction(session_id)
+    if transaction and transaction["payment_status"] == "completed":
+        # Settled by the webhook or an earlier poll; no need to ask Stripe again
+        return {
+            "status": "complete",
+            "payment_status": "paid",
+            "amount": round(float(transaction.get("amount") or 0) * 100),
+            "currency": transaction.get("currency")
+        }
+    
     try:
-        session = stripe.checkout.Session.retrieve(session_id)
-        
-        transaction = await find_payment_transaction(session_id)
+        session = await asyncio.to_thread(stripe.checkout.Session.retrieve, session_id, expand=["subscription"])
         
         if session.status == "complete" and session.payment_status == "paid":
-            if transaction and transaction["payment_status"] != "completed":
-                subscription = stripe.Subscription.retrieve(session.subscription)
-                
-                await update_user(user["id"], {
-                    "subscription_status": "active",
-                    "subscription_end_date": datetime.fromtimestamp(
-                        subscription.current_period_end, tz=timezone.utc
-                    ).isoformat()
-                })
-                
+            if transaction and transaction["user_id"] == user["id"]:
+                subscription = session.subscription
+                await _record_subscription(
+                    user["id"],
+                    "active",
+                    stripe_subscription_id=subscription.get("id") if subscription else None,
+                    plan=_subscription_interval(subscription) if subscription else None,
+                    period_end=_subscription_period_end(subscription) if subscription else None
+                )
                 await update_payment_transaction(session_id, {
                     "payment_status": "completed"
                 })
@@ -2002,21 +3140,27 @@ async def check_subscription_status(session_id: str, authorization: str = Header
 async def cancel_subscription(authorization: str = Header(None)):
     user = await get_current_user(authorization)
     
-    subscription_id = user.get("subscription_id")
+    local_subscription = await find_subscription_by_user(user["id"])
+    subscription_id = (local_subscription or {}).get("stripe_subscription_id") or user.get("subscription_id")
     if not subscription_id:
         raise HTTPException(status_code=400, detail="No active subscription found")
     
     try:
-        subscription = stripe.Subscription.modify(
+        subscription = await asyncio.to_thread(
+            stripe.Subscription.modify,
             subscription_id,
             cancel_at_period_end=True
         )
         
-        await update_user(user["id"], {"subscription_cancel_at_period_end": True})
+        period_end = _subscription_period_end(subscription)
+        await _record_subscription(
+            user["id"], subscription.status, stripe_subscription_id=subscription_id,
+            period_end=period_end, cancel_at_period_end=True
+        )
         
         return {
             "message": "Subscription will be cancelled at the end of the billing period",
-            "cancel_at": datetime.fromtimestamp(subscription.current_period_end, tz=timezone.utc).isoformat()
+            "cancel_at": _timestamp_iso(period_end) if period_end else None
         }
         
     except stripe.error.StripeError as e:
@@ -2027,34 +3171,30 @@ async def cancel_subscription(authorization: str = Header(None)):
 async def get_subscription_details(authorization: str = Header(None)):
     user = await get_current_user(authorization)
     
-    subscription_id = user.get("subscription_id")
-    if not subscription_id:
+    entitlement = await entitlements.get(user["id"])
+    if entitlement.source == "none":
         return {
             "status": "inactive",
             "message": "No active subscription"
         }
     
-    try:
-        subscription = stripe.Subscription.retrieve(subscription_id)
-        
-        return {
-            "status": subscription.status,
-            "current_period_end": datetime.fromtimestamp(
-                subscription.current_period_end, tz=timezone.utc
-            ).isoformat(),
-            "cancel_at_period_end": subscription.cancel_at_period_end,
-            "plan": subscription.items.data[0].price.recurring.interval if subscription.items.data else None
-        }
-        
-    except stripe.error.StripeError as e:
-        logging.error(f"Stripe details error: {e}")
-        return {
-            "status": "error",
-            "message": "Could not fetch subscription details"
-        }
+    return {
+        "status": entitlement.status,
+        "is_premium": entitlement.is_premium,
+        "current_period_end": entitlement.current_period_end.isoformat() if entitlement.current_period_end else None,
+        "cancel_at_period_end": entitlement.cancel_at_period_end,
+        "plan": entitlement.plan
+    }
+
+@api_router.get("/subscriptions/entitlement")
+async def get_entitlement(authorization: str = Header(None)):
+    user = await get_current_user(authorization)
+    entitlement = await entitlements.get(user["id"])
+    return entitlement.to_dict()
 
 @api_router.post("/webhook/stripe")
 async def stripe_webhook(request: Request):
+    """Verify, store and acknowledge. Processing happens in the stripe event workers."""
     import json
     body = await request.body()
     signature = request.headers.get("Stripe-Signature")
@@ -2065,65 +3205,463 @@ async def stripe_webhook(request: Request):
             event = stripe.Webhook.construct_event(body, signature, webhook_secret)
         else:
             event = stripe.Event.construct_from(json.loads(body), stripe.api_key)
-        
-        event_type = event.type
-        data = event.data.object
-        
-        logging.info(f"Stripe webhook received: {event_type}")
-        
-        if event_type == "checkout.session.completed":
-            user_id = data.metadata.get("user_id")
-            if user_id and data.subscription:
-                subscription = stripe.Subscription.retrieve(data.subscription)
-                await update_user(user_id, {
-                    "subscription_status": "active",
-                    "subscription_end_date": datetime.fromtimestamp(
-                        subscription.current_period_end, tz=timezone.utc
-                    ).isoformat()
-                })
-        
-        elif event_type == "invoice.paid":
-            subscription_id = data.subscription
-            if subscription_id:
-                subscription = stripe.Subscription.retrieve(subscription_id)
-                customer = stripe.Customer.retrieve(data.customer)
-                user_id = customer.metadata.get("user_id")
-                
-                if user_id:
-                    await update_user(user_id, {
-                        "subscription_status": "active",
-                        "subscription_end_date": datetime.fromtimestamp(
-                            subscription.current_period_end, tz=timezone.utc
-                        ).isoformat()
-                    })
-        
-        elif event_type == "invoice.payment_failed":
-            subscription_id = data.subscription
-            if subscription_id:
-                customer = stripe.Customer.retrieve(data.customer)
-                user_id = customer.metadata.get("user_id")
-                
-                if user_id:
-                    await update_user(user_id, {"subscription_status": "past_due"})
-        
-        elif event_type == "customer.subscription.deleted":
-            customer = stripe.Customer.retrieve(data.customer)
-            user_id = customer.metadata.get("user_id")
-            
-            if user_id:
-                await update_user(user_id, {
-                    "subscription_status": "inactive",
-                    "subscription_end_date": None
-                })
-        
-        return {"status": "success"}
-        
     except stripe.error.SignatureVerificationError as e:
         logging.error(f"Webhook signature verification failed: {e}")
         raise HTTPException(status_code=400, detail="Invalid signature")
     except Exception as e:
         logging.error(f"Webhook error: {e}")
         raise HTTPException(status_code=400, detail=str(e))
+    
+    data = event.data.object
+    customer_id = data.get("id") if data.get("object") == "customer" else data.get("customer")
+    inserted = await insert_stripe_event({
+        "id": event.id,
+        "event_type": event.type,
+        "customer_id": customer_id if isinstance(customer_id, str) else None,
+        "payload": json.loads(body),
+        "stripe_created": event.get("created") or 0
+    })
+    if inserted:
+        stripe_event_pool.notify()
+    else:
+        logging.info(f"Duplicate Stripe event {event.id} ignored")
+    
+    return {"status": "success"}
+
+async def resolve_customer_user(customer_id: Optional[str], metadata: Optional[dict] = None) -> Optional[str]:
+    """User id for a Stripe customer without calling Stripe in the common case:
+    event metadata, then the in-memory cache, then the indexed users lookup.
+    Only customers created outside checkout fall through to Customer.retrieve."""
+    user_id = (metadata or {}).get("user_id")
+    if user_id or not customer_id:
+        return user_id
+    
+    user_id = stripe_customer_users.get(customer_id)
+    if user_id:
+        return user_id
+    
+    user_id = await find_user_id_by_stripe_customer(customer_id)
+    if not user_id:
+        customer = await asyncio.to_thread(stripe.Customer.retrieve, customer_id)
+        user_id = customer.metadata.get("user_id")
+        if user_id:
+            logging.info(f"Linking Stripe customer {customer_id} to user {user_id}")
+            await update_user(user_id, {"stripe_customer_id": customer_id})
+    if user_id:
+        stripe_customer_users.set(customer_id, user_id)
+    return user_id
+
+def _invoice_period(invoice) -> Tuple[Optional[int], Optional[int]]:
+    """Start and end of the subscription period an invoice pays for, from its line items"""
+    periods = [
+        line["period"]
+        for line in ((invoice.get("lines") or {}).get("data") or [])
+        if line.get("period") and line["period"].get("end")
+    ]
+    if not periods:
+        return None, None
+    latest = max(periods, key=lambda period: period["end"])
+    return latest.get("start"), latest["end"]
+
+def _subscription_period_end(subscription) -> Optional[int]:
+    # Newer API versions report the period per subscription item
+    if subscription.get("current_period_end"):
+        return subscription["current_period_end"]
+    items = (subscription.get("items") or {}).get("data") or []
+    ends = [item["current_period_end"] for item in items if item.get("current_period_end")]
+    return max(ends) if ends else None
+
+def _subscription_interval(subscription) -> Optional[str]:
+    items = (subscription.get("items") or {}).get("data") or []
+    if not items:
+        return None
+    recurring = (items[0].get("price") or {}).get("recurring") or {}
+    return recurring.get("interval")
+
+def _timestamp_iso(ts: int) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
+
+def _timestamp_dt(ts: Optional[int]) -> Optional[datetime]:
+    return datetime.fromtimestamp(ts, tz=timezone.utc) if ts else None
+
+# Stripe subscription status -> users.subscription_status shown to the frontend
+USER_SUBSCRIPTION_STATUS = {
+    "trialing": "active",
+    "canceled": "inactive",
+    "unpaid": "inactive",
+    "incomplete_expired": "inactive",
+}
+
+async def _record_subscription(
+    user_id: str,
+    status: str,
+    stripe_subscription_id: Optional[str] = None,
+    plan: Optional[str] = None,
+    period_start: Optional[int] = None,
+    period_end: Optional[int] = None,
+    cancel_at_period_end: Optional[bool] = None
+) -> None:
+    """Write subscription state to `subscriptions`, mirror it onto the user row and
+    drop the cached entitlement"""
+    await upsert_subscription({
+        "user_id": user_id,
+        "stripe_subscription_id": stripe_subscription_id,
+        "status": status,
+        "plan": plan,
+        "current_period_start": _timestamp_dt(period_start),
+        "current_period_end": _timestamp_dt(period_end),
+        "cancel_at_period_end": cancel_at_period_end
+    })
+    
+    user_status = USER_SUBSCRIPTION_STATUS.get(status, status)
+    user_updates = {"subscription_status": user_status}
+    if user_status == "inactive":
+        user_updates["subscription_end_date"] = None
+    elif period_end:
+        user_updates["subscription_end_date"] = _timestamp_iso(period_end)
+    await update_user(user_id, user_updates)
+    entitlements.invalidate(user_id)
+
+async def _handle_checkout_completed(data) -> None:
+    user_id = await resolve_customer_user(data.get("customer"), data.get("metadata"))
+    if not user_id or not data.get("subscription"):
+        return
+    
+    package = STRIPE_PRICES.get((data.get("metadata") or {}).get("package_id"), {})
+    period_end = None
+    existing = await find_subscription_by_user(user_id)
+    current_end = _entitlements_mod.as_datetime((existing or {}).get("current_period_end"))
+    if not current_end or current_end < datetime.now(timezone.utc):
+        # The session carries no period; estimate one from the package until invoice.paid sets the exact end
+        days = 366 if package.get("interval") == "year" else 31
+        started = data.get("created") or int(datetime.now(timezone.utc).timestamp())
+        period_end = started + days * 86400
+    
+    await _record_subscription(
+        user_id,
+        "active",
+        stripe_subscription_id=data.get("subscription"),
+        plan=package.get("interval"),
+        period_end=period_end
+    )
+    if data.get("id"):
+        await update_payment_transaction(data["id"], {"payment_status": "completed"})
+
+async def _handle_invoice_paid(data) -> None:
+    subscription_id = data.get("subscription")
+    if not subscription_id:
+        return
+    user_id = await resolve_customer_user(data.get("customer"))
+    if not user_id:
+        return
+    
+    period_start, period_end = _invoice_period(data)
+    plan = None
+    if period_end is None:
+        subscription = await asyncio.to_thread(stripe.Subscription.retrieve, subscription_id)
+        period_end = _subscription_period_end(subscription)
+        plan = _subscription_interval(subscription)
+    await _record_subscription(
+        user_id, "active", stripe_subscription_id=subscription_id, plan=plan,
+        period_start=period_start, period_end=period_end
+    )
+
+async def _handle_invoice_payment_failed(data) -> None:
+    if not data.get("subscription"):
+        return
+    user_id = await resolve_customer_user(data.get("customer"))
+    if user_id:
+        await _record_subscription(user_id, "past_due", stripe_subscription_id=data.get("subscription"))
+
+async def _handle_subscription_updated(data) -> None:
+    user_id = await resolve_customer_user(data.get("customer"), data.get("metadata"))
+    if user_id:
+        await _record_subscription(
+            user_id,
+            data.get("status") or "active",
+            stripe_subscription_id=data.get("id"),
+            plan=_subscription_interval(data),
+            period_end=_subscription_period_end(data),
+            cancel_at_period_end=bool(data.get("cancel_at_period_end"))
+        )
+
+async def _handle_subscription_deleted(data) -> None:
+    user_id = await resolve_customer_user(data.get("customer"), data.get("metadata"))
+    if user_id:
+        await _record_subscription(
+            user_id, "canceled", stripe_subscription_id=data.get("id"), cancel_at_period_end=False
+        )
+
+STRIPE_EVENT_HANDLERS = {
+    "checkout.session.completed": _handle_checkout_completed,
+    "invoice.paid": _handle_invoice_paid,
+    "invoice.payment_failed": _handle_invoice_payment_failed,
+    "customer.subscription.updated": _handle_subscription_updated,
+    "customer.subscription.deleted": _handle_subscription_deleted,
+}
+
+async def process_stripe_event(row: Dict[str, Any]) -> None:
+    handler = STRIPE_EVENT_HANDLERS.get(row["event_type"])
+    try:
+        if handler:
+            event = stripe.Event.construct_from(row["payload"], stripe.api_key)
+            await handler(event.data.object)
+        await complete_stripe_event(row["id"])
+        logging.info(f"Processed Stripe event {row['id']} ({row['event_type']})")
+    except Exception as e:
+        logging.error(f"Stripe event {row['id']} ({row['event_type']}) attempt {row['attempts']} failed: {e}")
+        await fail_stripe_event(row["id"], str(e), STRIPE_EVENT_RETRY_BASE_SECONDS * 2 ** (row["attempts"] - 1))
+
+stripe_event_pool = _jobs_mod.JobWorkerPool(
+    claim=claim_stripe_event,
+    process=process_stripe_event,
+    concurrency=STRIPE_EVENT_WORKERS,
+    name="stripe-events"
+)
+
+class StripeEventReplay(BaseModel):
+    event_ids: List[str] = []
+    status: Optional[str] = None
+
+@api_router.get("/admin/stripe-events")
+async def list_stripe_events(status: Optional[str] = None, limit: int = 50, authorization: str = Header(None)):
+    user = await get_current_user(authorization)
+    
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    events = await find_stripe_events(status, min(max(limit, 1), 500))
+    return {
+        "counts": await count_stripe_events_by_status(),
+        "events": [
+            {
+                "id": event["id"],
+                "event_type": event["event_type"],
+                "customer_id": event.get("customer_id"),
+                "status": event["status"],
+                "attempts": event["attempts"],
+                "error": event.get("error"),
+                "received_at": str(event["received_at"]),
+                "processed_at": str(event["processed_at"]) if event.get("processed_at") else None
+            }
+            for event in events
+        ]
+    }
+
+@api_router.post("/admin/stripe-events/replay")
+async def replay_stripe_events_route(replay: StripeEventReplay, authorization: str = Header(None)):
+    """Reprocess stored events by id, or every event currently failed/processed"""
+    user = await get_current_user(authorization)
+    
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if not replay.event_ids and replay.status not in ("failed", "processed"):
+        raise HTTPException(status_code=400, detail="Provide event_ids or a status of failed or processed")
+    
+    replayed = await replay_stripe_events(replay.event_ids or None, None if replay.event_ids else replay.status)
+    if replayed:
+        stripe_event_pool.notify()
+    return {"replayed": replayed}
+
+# ============== Stripe Reconciliation ==============
+
+subscription_source = _reconcile_mod.SUBSCRIPTION_SOURCES[RECONCILE_SOURCE]()
+# Keeps admin-started runs referenced until they finish
+reconciliation_runs_in_flight: set = set()
+
+def _subscription_snapshot(subscription) -> Dict[str, Any]:
+    return {
+        "stripe_subscription_id": subscription["id"],
+        "status": subscription.get("status") or "incomplete",
+        "plan": _subscription_interval(subscription),
+        "current_period_end": _timestamp_dt(_subscription_period_end(subscription)),
+        "cancel_at_period_end": bool(subscription.get("cancel_at_period_end")),
+    }
+
+def _snapshot_rank(snapshot: Dict[str, Any]) -> tuple:
+    # A customer can have several subscriptions; the live one with the latest period wins
+    period_end = snapshot["current_period_end"]
+    return (
+        snapshot["status"] in _entitlements_mod.PREMIUM_STATUSES,
+        period_end.timestamp() if period_end else 0
+    )
+
+def _drift_value(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def _subscription_drift(local: Dict[str, Any], remote: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Fields where the local subscription and user rows disagree with Stripe"""
+    fields = {}
+    local_end = _entitlements_mod.as_datetime(local.get("current_period_end"))
+    remote_end = remote["current_period_end"]
+    checks = [
+        ("stripe_subscription_id", local.get("stripe_subscription_id"), remote["stripe_subscription_id"]),
+        ("status", local.get("status"), remote["status"]),
+        ("cancel_at_period_end", bool(local.get("cancel_at_period_end")), remote["cancel_at_period_end"]),
+    ]
+    if remote["plan"]:
+        checks.append(("plan", local.get("plan"), remote["plan"]))
+    if remote_end and (not local_end or int(local_end.timestamp()) != int(remote_end.timestamp())):
+        checks.append(("current_period_end", local_end, remote_end))
+    for name, local_value, remote_value in checks:
+        if local_value != remote_value:
+            fields[name] = {"local": _drift_value(local_value), "stripe": _drift_value(remote_value)}
+    
+    # Non-premium Stripe state only downgrades the user row alongside a subscription
+    # correction, so grants such as promo codes outlive an old canceled subscription
+    user_status = USER_SUBSCRIPTION_STATUS.get(remote["status"], remote["status"])
+    if fields or remote["status"] in _entitlements_mod.PREMIUM_STATUSES:
+        if local.get("user_status") != user_status:
+            fields["user.subscription_status"] = {"local": local.get("user_status"), "stripe": user_status}
+        user_end = _entitlements_mod.as_datetime(local.get("subscription_end_date"))
+        if user_status != "inactive" and remote_end and (not user_end or user_end < remote_end):
+            fields["user.subscription_end_date"] = {"local": _drift_value(user_end), "stripe": _drift_value(remote_end)}
+    return fields
+
+async def _reconcile_page(subscriptions: List[Any], dry_run: bool) -> Any:
+    snapshots: Dict[str, Dict[str, Any]] = {}
+    for subscription in subscriptions:
+        customer_id = subscription.get("customer")
+        if not isinstance(customer_id, str):
+            continue
+        snapshot = _subscription_snapshot(subscription)
+        if customer_id not in snapshots or _snapshot_rank(snapshot) > _snapshot_rank(snapshots[customer_id]):
+            snapshots[customer_id] = snapshot
+    
+    local_rows = {
+        row["stripe_customer_id"]: row
+        for row in await find_subscription_state_by_customers(list(snapshots))
+    }
+    
+    drifts = []
+    subscription_fixes = []
+    user_fixes = []
+    skipped = 0
+    for customer_id, remote in snapshots.items():
+        local = local_rows.get(customer_id)
+        if local is None:
+            # Customers that never went through our checkout
+            skipped += 1
+            continue
+        local_subscription_id = local.get("stripe_subscription_id")
+        if (
+            local_subscription_id and local_subscription_id != remote["stripe_subscription_id"]
+            and remote["status"] not in _entitlements_mod.PREMIUM_STATUSES
+        ):
+            # An older subscription listed on another page; the current one is already recorded
+            skipped += 1
+            continue
+        
+        fields = _subscription_drift(local, remote)
+        if not fields:
+            continue
+        drifts.append({
+            "user_id": local["user_id"],
+            "customer_id": customer_id,
+            "subscription_id": remote["stripe_subscription_id"],
+            "fields": fields
+        })
+        subscription_fixes.append({"user_id": local["user_id"], **remote})
+        user_status = USER_SUBSCRIPTION_STATUS.get(remote["status"], remote["status"])
+        user_end = local.get("subscription_end_date")
+        if user_status == "inactive":
+            user_end = None
+        elif "user.subscription_end_date" in fields:
+            user_end = remote["current_period_end"].isoformat()
+        user_fixes.append({"user_id": local["user_id"], "subscription_status": user_status, "subscription_end_date": user_end})
+    
+    if not dry_run and subscription_fixes:
+        await apply_subscription_corrections(subscription_fixes, user_fixes)
+        for fix in subscription_fixes:
+            entitlements.invalidate(fix["user_id"])
+    return _reconcile_mod.PageOutcome(
+        drifts=drifts,
+        corrected=0 if dry_run else len(subscription_fixes),
+        skipped=skipped
+    )
+
+async def _execute_reconciliation(run: Dict[str, Any]) -> Dict[str, Any]:
+    run_id = run["id"]
+    
+    async def checkpoint(cursor, report) -> None:
+        await checkpoint_reconciliation_run(run_id, cursor, report.to_dict())
+    
+    reconciler = _reconcile_mod.Reconciler(
+        subscription_source,
+        process_page=lambda page: _reconcile_page(page, run["dry_run"]),
+        checkpoint=checkpoint,
+        concurrency=RECONCILE_CONCURRENCY
+    )
+    report = _reconcile_mod.DriftReport.from_dict(run.get("report"))
+    if run.get("cursor"):
+        logging.info(f"Resuming reconciliation run {run_id} after {run['cursor']}")
+    try:
+        report = await reconciler.run(run.get("cursor"), report)
+    except Exception as e:
+        logging.error(f"Reconciliation run {run_id} failed: {e}")
+        await finish_reconciliation_run(run_id, "failed", report.to_dict(), str(e))
+        return report.to_dict()
+    await finish_reconciliation_run(run_id, "completed", report.to_dict())
+    if report.drifted:
+        logging.warning(
+            f"Reconciliation run {run_id} found {report.drifted} drifted subscriptions "
+            f"({dict(report.fields)}), corrected {report.corrected}"
+        )
+    return report.to_dict()
+
+async def scheduled_reconciliation() -> None:
+    """Resume an interrupted run, or start one when the last is RECONCILE_INTERVAL_SECONDS old"""
+    run = await claim_reconciliation_run(
+        str(uuid.uuid4()), False, RECONCILE_STALE_SECONDS, min_interval_seconds=RECONCILE_INTERVAL_SECONDS
+    )
+    if run:
+        await _execute_reconciliation(run)
+
+reconciliation_task = _jobs_mod.PeriodicTask(scheduled_reconciliation, RECONCILE_CHECK_SECONDS, name="stripe-reconciliation")
+
+def _reconciliation_run_response(run: Dict[str, Any]) -> Dict[str, Any]:
+    report = run.get("report") or {}
+    return {
+        "id": run["id"],
+        "status": run["status"],
+        "dry_run": run["dry_run"],
+        "scanned": report.get("scanned", 0),
+        "drifted": report.get("drifted", 0),
+        "corrected": report.get("corrected", 0),
+        "skipped": report.get("skipped", 0),
+        "fields": report.get("fields", {}),
+        "samples": report.get("samples", []),
+        "error": run.get("error"),
+        "started_at": str(run["started_at"]),
+        "finished_at": str(run["finished_at"]) if run.get("finished_at") else None
+    }
+
+@api_router.get("/admin/reconciliation")
+async def list_reconciliation_runs(limit: int = 20, authorization: str = Header(None)):
+    user = await get_current_user(authorization)
+    
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    runs = await find_recent_reconciliation_runs(min(max(limit, 1), 100))
+    return {"runs": [_reconciliation_run_response(run) for run in runs]}
+
+@api_router.post("/admin/reconciliation/run")
+async def start_reconciliation_run(dry_run: bool = True, authorization: str = Header(None)):
+    """Start a reconciliation now; dry runs only report drift"""
+    user = await get_current_user(authorization)
+    
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    run = await claim_reconciliation_run(str(uuid.uuid4()), dry_run, RECONCILE_STALE_SECONDS)
+    if run is None:
+        raise HTTPException(status_code=409, detail="A reconciliation run is already in progress")
+    
+    task = asyncio.create_task(_execute_reconciliation(run))
+    reconciliation_runs_in_flight.add(task)
+    task.add_done_callback(reconciliation_runs_in_flight.discard)
+    return _reconciliation_run_response(run)
 
 # ============== Root Routes ==============
 
@@ -2133,6 +3671,18 @@ async def root():
 
 app.include_router(api_router)
 
+idempotency_store = _idempotency_mod.IdempotencyStore(
+    claim=claim_idempotency_key,
+    complete=complete_idempotency_key,
+    release=release_idempotency_key,
+    ttl_seconds=IDEMPOTENCY_TTL_SECONDS,
+    lock_seconds=IDEMPOTENCY_LOCK_SECONDS
+)
+idempotency_purge_task = _jobs_mod.PeriodicTask(delete_expired_idempotency_keys, 3600, name="idempotency-purge")
+
+# Added before CORS so CORS stays outermost and also decorates replayed responses
+app.add_middleware(_idempotency_mod.IdempotencyMiddleware, store=idempotency_store, paths=IDEMPOTENT_POST_PATHS)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
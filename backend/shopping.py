@@ -0,0 +1,495 @@
+import re
+from typing import Optional, List, Dict, Any, Tuple
+
+import numpy as np
+
+MEAL_TYPES = ["breakfast", "lunch", "dinner", "snack"]
+
+INGREDIENT_CATEGORIES = {
+    "chicken": "Proteins", "beef": "Proteins", "pork": "Proteins", "fish": "Proteins",
+    "salmon": "Proteins", "tuna": "Proteins", "shrimp": "Proteins", "turkey": "Proteins",
+    "egg": "Proteins", "eggs": "Proteins", "tofu": "Proteins", "tempeh": "Proteins",
+    "milk": "Dairy", "cheese": "Dairy", "yogurt": "Dairy", "butter": "Dairy",
+    "cream": "Dairy", "feta": "Dairy", "parmesan": "Dairy", "mozzarella": "Dairy",
+    "spinach": "Produce", "lettuce": "Produce", "tomato": "Produce", "onion": "Produce",
+    "garlic": "Produce", "pepper": "Produce", "carrot": "Produce", "broccoli": "Produce",
+    "cucumber": "Produce", "avocado": "Produce", "lemon": "Produce", "lime": "Produce",
+    "apple": "Produce", "banana": "Produce", "berry": "Produce", "berries": "Produce",
+    "mushroom": "Produce", "zucchini": "Produce", "potato": "Produce", "sweet potato": "Produce",
+    "rice": "Grains & Bread", "pasta": "Grains & Bread", "bread": "Grains & Bread",
+    "oats": "Grains & Bread", "quinoa": "Grains & Bread", "tortilla": "Grains & Bread",
+    "oil": "Pantry", "olive oil": "Pantry", "salt": "Pantry",
+    "sugar": "Pantry", "flour": "Pantry", "honey": "Pantry", "vinegar": "Pantry",
+    "soy sauce": "Pantry", "sauce": "Pantry", "broth": "Pantry", "stock": "Pantry",
+    "almond": "Nuts & Seeds", "walnut": "Nuts & Seeds", "peanut": "Nuts & Seeds",
+    "cashew": "Nuts & Seeds", "seed": "Nuts & Seeds", "nut": "Nuts & Seeds",
+}
+
+INGREDIENT_PATTERN = re.compile(
+    r'^([\d\/\.\s]+)?\s*(?:(cups?|tbsp|tsp|oz|lb|g|kg|ml|l|bunch|cloves?|pieces?|slices?|cans?|bottles?|packages?|stalks?)\b)?\s*(.+)$',
+    re.IGNORECASE
+)
+
+# Unit families used to merge quantities written in different units. Volumes
+# are summed in ml and weights in g, then converted back for display.
+UNIT_ALIASES = {
+    "cups": "cup", "tablespoon": "tbsp", "tablespoons": "tbsp", "tbsps": "tbsp",
+    "teaspoon": "tsp", "teaspoons": "tsp", "tsps": "tsp", "ounce": "oz", "ounces": "oz",
+    "lbs": "lb", "pound": "lb", "pounds": "lb", "gram": "g", "grams": "g",
+    "kilogram": "kg", "kilograms": "kg", "milliliter": "ml", "milliliters": "ml",
+    "liter": "l", "liters": "l", "cloves": "clove", "pieces": "piece", "slices": "slice",
+    "cans": "can", "bottles": "bottle", "packages": "package", "stalks": "stalk",
+}
+
+VOLUME_TO_ML = {"tsp": 4.92892, "tbsp": 14.7868, "cup": 236.588, "ml": 1.0, "l": 1000.0}
+WEIGHT_TO_G = {"oz": 28.3495, "lb": 453.592, "g": 1.0, "kg": 1000.0}
+METRIC_UNITS = {"ml", "l", "g", "kg"}
+
+def canonical_unit(unit: str) -> str:
+    unit = (unit or "unit").lower().strip()
+    return UNIT_ALIASES.get(unit, unit)
+
+def to_base_unit(quantity: float, unit: str) -> tuple:
+    """Convert a quantity to its family base unit: (quantity, "ml" | "g" | canonical unit)"""
+    unit = canonical_unit(unit)
+    if unit in VOLUME_TO_ML:
+        return quantity * VOLUME_TO_ML[unit], "ml"
+    if unit in WEIGHT_TO_G:
+        return quantity * WEIGHT_TO_G[unit], "g"
+    return quantity, unit
+
+# Smallest increment a cook can measure in each unit; g and ml use 1 below 50 and 5 above
+KITCHEN_STEPS = {"cup": 0.25, "tbsp": 0.5, "tsp": 0.25, "lb": 0.25, "oz": 0.5, "kg": 0.05, "l": 0.05}
+
+def round_kitchen(quantity: float, unit: str) -> float:
+    """Round to increments a cook can actually measure"""
+    step = KITCHEN_STEPS.get(unit)
+    if step is None:
+        step = 5 if unit in ("g", "ml") and quantity >= 50 else (1 if unit in ("g", "ml") else 0.5)
+    rounded = round(quantity / step) * step
+    return rounded if rounded > 0 else step
+
+def to_kitchen_unit(quantity: float, base_unit: str, metric: bool = False) -> tuple:
+    """Convert a base-unit quantity back into the most natural kitchen unit"""
+    if base_unit == "ml":
+        if metric:
+            unit = "l" if quantity >= 1000 else "ml"
+        elif quantity >= VOLUME_TO_ML["cup"] / 4:
+            unit = "cup"
+        elif quantity >= VOLUME_TO_ML["tbsp"]:
+            unit = "tbsp"
+        else:
+            unit = "tsp"
+        value = quantity / VOLUME_TO_ML[unit]
+    elif base_unit == "g":
+        if metric:
+            unit = "kg" if quantity >= 1000 else "g"
+        else:
+            unit = "lb" if quantity >= WEIGHT_TO_G["lb"] else "oz"
+        value = quantity / WEIGHT_TO_G[unit]
+    else:
+        return quantity, base_unit
+    return round_kitchen(value, unit), unit
+
+def categorize_ingredient(ingredient_name: str) -> str:
+    name_lower = ingredient_name.lower()
+    for keyword, category in INGREDIENT_CATEGORIES.items():
+        if keyword in name_lower:
+            return category
+    return "Other"
+
+def parse_ingredient_string(ingredient_str: str) -> dict:
+    match = INGREDIENT_PATTERN.match(ingredient_str.strip())
+
+    if match:
+        quantity_str = match.group(1) or "1"
+        unit = match.group(2) or "unit"
+        name = match.group(3) or ingredient_str
+
+        try:
+            if '/' in quantity_str:
+                parts = quantity_str.strip().split()
+                total = 0
+                for part in parts:
+                    if '/' in part:
+                        num, denom = part.split('/')
+                        total += float(num) / float(denom)
+                    else:
+                        total += float(part) if part else 0
+                quantity = total
+            else:
+                quantity = float(quantity_str.strip()) if quantity_str.strip() else 1
+        except:
+            quantity = 1
+
+        return {
+            "name": name.strip(),
+            "quantity": quantity,
+            "unit": unit.lower(),
+            "category": categorize_ingredient(name)
+        }
+
+    return {
+        "name": ingredient_str.strip(),
+        "quantity": 1,
+        "unit": "unit",
+        "category": categorize_ingredient(ingredient_str)
+    }
+
+def parse_ingredient(ingredient: Any) -> Optional[dict]:
+    """Parse a recipe ingredient stored either as free text or as a structured dict"""
+    if isinstance(ingredient, str):
+        return parse_ingredient_string(ingredient)
+    if isinstance(ingredient, dict):
+        return {
+            "name": ingredient.get("name", "Unknown"),
+            "quantity": ingredient.get("quantity", 1),
+            "unit": ingredient.get("unit", "unit"),
+            "category": ingredient.get("category") or categorize_ingredient(ingredient.get("name", ""))
+        }
+    return None
+
+def ingredient_text(ingredient: Any) -> str:
+    """Render a meals-library ingredient dict as recipe text, e.g. "2 cup rice"; strings pass through"""
+    if not isinstance(ingredient, dict):
+        return str(ingredient)
+    parsed = parse_ingredient(ingredient)
+    quantity = parsed["quantity"]
+    if isinstance(quantity, (int, float)):
+        return _format_ingredient(quantity, parsed["unit"], parsed["name"])
+    return " ".join(str(part) for part in (quantity, parsed["unit"], parsed["name"]) if part and part != "unit")
+
+def ingredient_key(parsed: dict) -> str:
+    return f"{parsed['name'].lower()}_{parsed['unit']}"
+
+def slot_key(day_name: str, meal_type: str) -> str:
+    return f"{day_name}:{meal_type}"
+
+# ============== Contributions ==============
+#
+# A shopping list is kept as a materialized aggregate: `totals` holds the summed
+# quantity per ingredient key and `contributions` records what each plan slot
+# (e.g. "Monday:dinner") added to it. A plan edit only subtracts the old slot
+# contribution and adds the new one instead of re-aggregating the whole week.
+
+def recipe_contribution(recipe: Optional[dict]) -> Dict[str, dict]:
+    contribution = {}
+    for ingredient in (recipe or {}).get("ingredients", []) or []:
+        parsed = parse_ingredient(ingredient)
+        if not parsed:
+            continue
+        key = ingredient_key(parsed)
+        if key in contribution:
+            contribution[key]["quantity"] += parsed["quantity"]
+        else:
+            contribution[key] = parsed
+    return contribution
+
+def plan_contributions(days: List[dict]) -> Dict[str, Dict[str, dict]]:
+    contributions = {}
+    for day in days or []:
+        recipes = day.get("recipes") or {}
+        is_leftover = day.get("is_leftover") or {}
+        for meal_type in MEAL_TYPES:
+            if is_leftover.get(meal_type, False):
+                continue
+            contribution = recipe_contribution(recipes.get(meal_type))
+            if contribution:
+                contributions[slot_key(day.get("day", ""), meal_type)] = contribution
+    return contributions
+
+def _add_contribution(totals: Dict[str, dict], contribution: Dict[str, dict], sign: int) -> None:
+    for key, item in contribution.items():
+        if key in totals:
+            totals[key]["quantity"] += sign * item["quantity"]
+            if totals[key]["quantity"] <= 1e-9:
+                del totals[key]
+        elif sign > 0:
+            totals[key] = {
+                "name": item["name"],
+                "quantity": item["quantity"],
+                "unit": item["unit"],
+                "category": item["category"]
+            }
+
+def aggregate_contributions(contributions: Dict[str, Dict[str, dict]]) -> Dict[str, dict]:
+    totals = {}
+    for contribution in contributions.values():
+        _add_contribution(totals, contribution, 1)
+    return totals
+
+def apply_contribution_delta(
+    totals: Dict[str, dict],
+    old_contributions: Dict[str, Dict[str, dict]],
+    new_contributions: Dict[str, Dict[str, dict]]
+) -> List[str]:
+    """Update totals in place for every slot whose contribution changed; returns the changed slots"""
+    changed = []
+    for key in set(old_contributions) | set(new_contributions):
+        old = old_contributions.get(key, {})
+        new = new_contributions.get(key, {})
+        if old == new:
+            continue
+        _add_contribution(totals, old, -1)
+        _add_contribution(totals, new, 1)
+        changed.append(key)
+    return changed
+
+# ============== Materialization ==============
+
+def subtract_pantry(totals: Dict[str, dict], pantry_items: List[dict]) -> Dict[str, dict]:
+    items = {
+        key: {**item, "checked": False, "in_pantry": False, "pantry_has": 0}
+        for key, item in totals.items()
+    }
+
+    for pantry_item in pantry_items:
+        pantry_name = pantry_item["name"].lower()
+        pantry_unit = pantry_item["unit"].lower()
+        pantry_qty = pantry_item["quantity"]
+
+        for item in items.values():
+            item_name = item["name"].lower()
+
+            if pantry_name in item_name or item_name in pantry_name:
+                if pantry_unit == item["unit"].lower() or pantry_unit in item["unit"].lower():
+                    item["in_pantry"] = True
+                    item["pantry_has"] = pantry_qty
+
+                    new_qty = item["quantity"] - pantry_qty
+                    if new_qty <= 0:
+                        item["quantity"] = 0
+                        item["checked"] = True
+                    else:
+                        item["quantity"] = new_qty
+
+    return items
+
+def finalize_items(items: Dict[str, dict], previous_items: Optional[List[dict]] = None) -> List[dict]:
+    """Round quantities and carry over the user's checks from a previous version of the list.
+
+    Only checks the user made (`checked_by_user`) carry over; items checked because
+    the pantry covered them are re-evaluated against the current pantry.
+    """
+    previously_checked = {
+        ingredient_key(item) for item in previous_items or [] if item.get("checked_by_user")
+    }
+
+    final_items = []
+    for key, item in items.items():
+        item.setdefault("checked", False)
+        item.setdefault("checked_by_user", False)
+        item.setdefault("in_pantry", False)
+        item.setdefault("pantry_has", 0)
+        if key in previously_checked:
+            item["checked"] = True
+            item["checked_by_user"] = True
+
+        qty = item["quantity"]
+        if qty > 0:
+            if qty == int(qty):
+                item["quantity"] = int(qty)
+            else:
+                item["quantity"] = round(qty, 2)
+            final_items.append(item)
+        elif item.get("in_pantry"):
+            item["quantity"] = 0
+            final_items.append(item)
+
+    return final_items
+
+# ============== Servings rescaling ==============
+
+QUANTITY_PREFIX = re.compile(r'^\s*\d')
+
+def format_quantity(quantity: float) -> str:
+    """Render a quantity as a kitchen fraction, e.g. 1.5 -> "1 1/2" """
+    whole = int(quantity)
+    fraction = quantity - whole
+    fractions = {0.25: "1/4", 1 / 3: "1/3", 0.5: "1/2", 2 / 3: "2/3", 0.75: "3/4"}
+    for value, text in fractions.items():
+        if abs(fraction - value) < 0.02:
+            return f"{whole} {text}" if whole else text
+    if fraction < 0.02:
+        return str(whole)
+    return f"{quantity:g}" if quantity >= 10 else f"{round(quantity, 2):g}"
+
+# Recipes remember the quantities they were generated with under this key, so every
+# rescale starts from the original amounts instead of compounding earlier rounding
+SCALE_BASE_KEY = "scale_base"
+
+def scale_quantities(
+    quantities: List[float],
+    units: List[str],
+    ratios: List[float]
+) -> Tuple[List[float], List[str]]:
+    """Scale many ingredient quantities at once with numpy.
+
+    Volumes and weights are converted to ml/g, multiplied, re-expressed in the
+    most natural kitchen unit and rounded to a measurable step, as
+    `to_kitchen_unit` does for one value. Countable items (eggs, cloves, cans)
+    round up to whole units, or to halves when the original was fractional.
+    """
+    if not quantities:
+        return [], []
+    canonical = [canonical_unit(unit) for unit in units]
+    original = np.asarray(quantities, dtype=float)
+    is_volume = np.array([unit in VOLUME_TO_ML for unit in canonical])
+    is_weight = np.array([unit in WEIGHT_TO_G for unit in canonical])
+    metric = np.array([unit in METRIC_UNITS for unit in canonical])
+    to_base = np.array([VOLUME_TO_ML.get(unit) or WEIGHT_TO_G.get(unit) or 1.0 for unit in canonical])
+
+    base = original * np.asarray(ratios, dtype=float) * to_base
+    kitchen_unit = np.select(
+        [
+            is_volume & metric & (base >= 1000), is_volume & metric,
+            is_volume & (base >= VOLUME_TO_ML["cup"] / 4), is_volume & (base >= VOLUME_TO_ML["tbsp"]), is_volume,
+            is_weight & metric & (base >= 1000), is_weight & metric,
+            is_weight & (base >= WEIGHT_TO_G["lb"]), is_weight,
+        ],
+        ["l", "ml", "cup", "tbsp", "tsp", "kg", "g", "lb", "oz"],
+        default=""
+    )
+    measured = is_volume | is_weight
+    from_base = np.array([VOLUME_TO_ML.get(unit) or WEIGHT_TO_G.get(unit) or 1.0 for unit in kitchen_unit])
+    value = base / from_base
+
+    step = np.array([KITCHEN_STEPS.get(unit, 0.5) for unit in kitchen_unit])
+    fine = np.isin(kitchen_unit, ["g", "ml"])
+    step = np.where(fine, np.where(value >= 50, 5.0, 1.0), step)
+    measured_value = np.round(value / step) * step
+    measured_value = np.where(measured_value > 0, measured_value, step)
+
+    count_step = np.where(original == np.floor(original), 1.0, 0.5)
+    # The 0.1 slack keeps 2.05 eggs at 2 rather than 3
+    count_value = np.maximum(count_step, np.ceil(base / count_step - 0.1) * count_step)
+
+    scaled = np.where(measured, measured_value, count_value)
+    scaled_units = [str(kitchen) if is_measured else unit for kitchen, is_measured, unit in zip(kitchen_unit, measured, units)]
+    return scaled.tolist(), scaled_units
+
+def _format_ingredient(quantity: float, unit: str, name: str) -> str:
+    if unit == "unit":
+        return f"{format_quantity(quantity)} {name}"
+    return f"{format_quantity(quantity)} {unit} {name}"
+
+def scale_days(days: List[dict], from_servings: int, to_servings: int) -> List[dict]:
+    """Rescale every recipe in a plan from `from_servings` to `to_servings`.
+
+    Each recipe is scaled from its stored base (the ingredients and servings it
+    had before the first rescale), so repeated rescales never drift and going
+    back to the original count restores the original text exactly. All numeric
+    quantities in the plan go through one `scale_quantities` call.
+    """
+    scaled_days = []
+    # (recipe, index in its ingredient list, parsed ingredient or None for dicts)
+    pending: List[Tuple[dict, int, Optional[dict]]] = []
+    quantities, units, ratios = [], [], []
+
+    for day in days or []:
+        recipes = {}
+        for meal_type, recipe in (day.get("recipes") or {}).items():
+            if not recipe:
+                recipes[meal_type] = recipe
+                continue
+            base = recipe.get(SCALE_BASE_KEY) or {
+                "plan_servings": from_servings,
+                "servings": recipe.get("servings"),
+                "ingredients": list(recipe.get("ingredients") or []),
+            }
+            ratio = to_servings / (base.get("plan_servings") or from_servings)
+            base_servings = base.get("servings")
+            scaled = {k: v for k, v in recipe.items() if k != SCALE_BASE_KEY}
+            scaled["ingredients"] = list(base["ingredients"])
+            # Dinners cooked for leftovers keep their doubled portion count
+            scaled["servings"] = max(1, round(base_servings * ratio)) if isinstance(base_servings, (int, float)) else base_servings
+            recipes[meal_type] = scaled
+            if ratio == 1:
+                continue
+            scaled[SCALE_BASE_KEY] = base
+
+            for index, ingredient in enumerate(base["ingredients"]):
+                if isinstance(ingredient, dict):
+                    if not isinstance(ingredient.get("quantity"), (int, float)):
+                        continue
+                    pending.append((scaled, index, None))
+                    quantities.append(ingredient["quantity"])
+                    units.append(ingredient.get("unit", "unit"))
+                elif isinstance(ingredient, str) and QUANTITY_PREFIX.match(ingredient):
+                    parsed = parse_ingredient_string(ingredient)
+                    pending.append((scaled, index, parsed))
+                    quantities.append(parsed["quantity"])
+                    units.append(parsed["unit"])
+                else:
+                    # "Salt and pepper to taste" has nothing to scale
+                    continue
+                ratios.append(ratio)
+        scaled_days.append({**day, "recipes": recipes})
+
+    scaled_quantities, scaled_units = scale_quantities(quantities, units, ratios)
+    for (recipe, index, parsed), quantity, unit in zip(pending, scaled_quantities, scaled_units):
+        if parsed is None:
+            recipe["ingredients"][index] = {**recipe["ingredients"][index], "quantity": quantity, "unit": unit}
+        else:
+            recipe["ingredients"][index] = _format_ingredient(quantity, unit, parsed["name"])
+    return scaled_days
+
+# ============== Cross-plan aggregation ==============
+
+def aggregate_normalized(contribution_sets: List[Dict[str, Dict[str, dict]]]) -> Dict[str, dict]:
+    """Sum contributions from several plans, merging units of the same family"""
+    totals = {}
+    for contributions in contribution_sets:
+        for contribution in contributions.values():
+            for item in contribution.values():
+                quantity, base_unit = to_base_unit(item["quantity"], item["unit"])
+                key = f"{item['name'].lower()}_{base_unit}"
+                if key in totals:
+                    totals[key]["quantity"] += quantity
+                    totals[key]["metric"] = totals[key]["metric"] and canonical_unit(item["unit"]) in METRIC_UNITS
+                else:
+                    totals[key] = {
+                        "name": item["name"],
+                        "quantity": quantity,
+                        "unit": base_unit,
+                        "category": item["category"],
+                        "metric": canonical_unit(item["unit"]) in METRIC_UNITS
+                    }
+    return totals
+
+def subtract_pantry_normalized(totals: Dict[str, dict], pantry_items: List[dict]) -> Dict[str, dict]:
+    """Pantry subtraction over base-unit totals, then conversion back to kitchen units"""
+    items = {
+        key: {**item, "checked": False, "in_pantry": False, "pantry_has": 0}
+        for key, item in totals.items()
+    }
+
+    for pantry_item in pantry_items:
+        pantry_name = pantry_item["name"].lower()
+        pantry_qty, pantry_base = to_base_unit(pantry_item["quantity"], pantry_item["unit"])
+
+        for item in items.values():
+            item_name = item["name"].lower()
+            if item["unit"] != pantry_base:
+                continue
+            if pantry_name in item_name or item_name in pantry_name:
+                item["in_pantry"] = True
+                item["pantry_has"] = pantry_item["quantity"]
+                item["quantity"] = max(0, item["quantity"] - pantry_qty)
+                if item["quantity"] == 0:
+                    item["checked"] = True
+
+    for item in items.values():
+        metric = item.pop("metric", False)
+        if item["quantity"] > 0:
+            item["quantity"], item["unit"] = to_kitchen_unit(item["quantity"], item["unit"], metric)
+        else:
+            item["unit"] = to_kitchen_unit(1, item["unit"], metric)[1]
+
+    return items
+
+def group_by_category(items: List[dict]) -> Dict[str, List[dict]]:
+    grouped = {}
+    for item in sorted(items, key=lambda i: i["name"].lower()):
+        grouped.setdefault(item["category"], []).append(item)
+    return dict(sorted(grouped.items()))
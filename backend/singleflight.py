@@ -0,0 +1,85 @@
+import asyncio
+import hashlib
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+def _normalize(value: Any) -> Any:
+    """Canonical form of request inputs so equivalent requests hash the same"""
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in sorted(value.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(value, (list, tuple, set)):
+        items = [_normalize(v) for v in value]
+        if all(isinstance(v, str) for v in items):
+            # Selections like dietary preferences are unordered
+            return sorted(items)
+        return items
+    if isinstance(value, str):
+        return value.strip().lower()
+    return value
+
+def flight_key(user_id: str, operation: str, inputs: Dict[str, Any]) -> str:
+    digest = hashlib.sha256(json.dumps(_normalize(inputs), sort_keys=True, default=str).encode()).hexdigest()
+    return f"{user_id}:{operation}:{digest}"
+
+def _is_cancelling() -> bool:
+    task = asyncio.current_task()
+    return task is not None and task.cancelling() > 0
+
+class SingleFlight:
+    """Coalesce concurrent identical calls into one execution.
+
+    While a call for a key is in flight, later callers await the same result
+    instead of starting their own. Successful results are also replayed for
+    `ttl_seconds` after completion, which absorbs double clicks and client
+    retries that arrive just after the first call finished. Errors are never
+    cached, so a retry after a failure runs again. If the caller running the
+    call is cancelled, the waiters run it again rather than being cancelled too.
+    """
+
+    def __init__(self, ttl_seconds: float = 10.0):
+        self.ttl_seconds = ttl_seconds
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._recent: Dict[str, Tuple[float, Any]] = {}
+
+    def _purge(self, now: float) -> None:
+        expired = [key for key, (expires_at, _) in self._recent.items() if expires_at <= now]
+        for key in expired:
+            del self._recent[key]
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        while True:
+            self._purge(time.monotonic())
+            if key in self._recent:
+                return self._recent[key][1]
+
+            owner = self._inflight.get(key)
+            if owner is None:
+                break
+            try:
+                return await asyncio.shield(owner)
+            except asyncio.CancelledError:
+                # The owner was cancelled (e.g. its client disconnected), not this
+                # caller; run the call again, with the first waiter becoming owner
+                if not owner.cancelled() or _is_cancelling():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            if self.ttl_seconds > 0:
+                self._recent[key] = (time.monotonic() + self.ttl_seconds, result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
@@ -5,6 +5,7 @@ Tests: Auth, Meal Plans, Supplements, Shopping Lists, AI Config, Subscriptions,
 import pytest
 import requests
 import os
+import json
 import uuid
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'https://platepal-6.preview.emergentagent.com').rstrip('/')
@@ -151,6 +152,52 @@ class TestAIConfig:
         assert response.status_code == 200
         print("AI config updated successfully")
 
+    def test_reject_unknown_provider(self):
+        """Test that unsupported providers are rejected"""
+        response = requests.put(f"{BASE_URL}/api/ai-config",
+            json={
+                "provider": "openai",
+                "model": "gpt-4",
+                "fallback_provider": "not-a-provider"
+            },
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+
+        assert response.status_code == 400
+        print("Unknown fallback provider rejected")
+
+    def test_ai_provider_health(self):
+        """Test per-provider health stats"""
+        response = requests.get(f"{BASE_URL}/api/ai-config/health", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+
+        assert response.status_code == 200, f"Provider health failed: {response.text}"
+        data = response.json()
+        assert "openai" in data["providers"]
+        assert "healthy" in data["providers"]["openai"]
+        print(f"Provider health: {list(data['providers'].keys())}")
+
+    def test_llm_governor_stats(self):
+        """Test that LLM admission control state is reported"""
+        response = requests.get(f"{BASE_URL}/api/ai-config/health", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+
+        assert response.status_code == 200
+        governor = response.json()["governor"]
+        assert governor["active"] <= governor["max_concurrency"]
+        print(f"LLM governor: {governor}")
+
+    def test_ai_batches_admin_only(self):
+        """Test that provider batch status is restricted to admins"""
+        response = requests.get(f"{BASE_URL}/api/admin/ai-batches", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+
+        assert response.status_code == 403
+        print("Batch status correctly restricted to admins")
+
 
 class TestMealPlans:
     """Meal plan CRUD tests"""
@@ -230,6 +277,127 @@ class TestMealPlans:
         assert verify_data["days"][0]["meals"]["breakfast"] == "Oatmeal with berries"
         print("Meal plan updated successfully")
 
+    def test_unknown_job_status(self):
+        """Test polling a job id that does not exist"""
+        response = requests.get(f"{BASE_URL}/api/jobs/{uuid.uuid4()}", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+
+        assert response.status_code == 404
+        print("Unknown job correctly rejected")
+
+    def test_rescale_meal_plan(self):
+        """Test rescaling a meal plan to a new serving count"""
+        response = requests.post(f"{BASE_URL}/api/meal-plans/{meal_plan_id}/rescale",
+            json={"servings": 4},
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+
+        assert response.status_code == 200, f"Rescale failed: {response.text}"
+        assert response.json()["servings"] == 4
+        print("Meal plan rescaled to 4 servings")
+
+    def test_swap_meal_from_local_store(self):
+        """Test swapping a single dinner using a saved meal"""
+        meal_response = requests.post(f"{BASE_URL}/api/meals",
+            json={
+                "name": f"TEST_Swap Stir Fry {uuid.uuid4().hex[:6]}",
+                "ingredients": [{"name": "tofu", "quantity": 1, "unit": "lb"}],
+                "instructions": ["Cube tofu", "Stir fry"],
+                "cooking_method": "Air Fryer",
+                "prep_time": 10,
+                "cook_time": 15,
+                "servings": 2
+            },
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+        assert meal_response.status_code == 200
+
+        response = requests.post(f"{BASE_URL}/api/meal-plans/{meal_plan_id}/days/Tuesday/dinner/swap",
+            json={},
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+
+        assert response.status_code == 200, f"Swap failed: {response.text}"
+        tuesday = next(d for d in response.json()["days"] if d["day"] == "Tuesday")
+        assert tuesday["meals"]["dinner"]
+        print(f"Tuesday dinner swapped to {tuesday['meals']['dinner']}")
+
+    def test_meal_plan_nutrition(self):
+        """Test that plan responses carry locally computed macros"""
+        response = requests.get(f"{BASE_URL}/api/meal-plans/{meal_plan_id}", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+
+        assert response.status_code == 200
+        nutrition = response.json()["nutrition"]
+        assert "week" in nutrition and "calories" in nutrition["week"]
+        assert len(nutrition["days"]) == 7
+        print(f"Weekly calories: {nutrition['week']['calories']}")
+
+    def test_accept_draft_meal_plan(self):
+        """Test draft listing and that only drafts can be accepted"""
+        response = requests.get(f"{BASE_URL}/api/meal-plans/drafts", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+
+        assert response.status_code == 200
+        drafts = response.json()
+        assert isinstance(drafts, list)
+
+        response = requests.post(f"{BASE_URL}/api/meal-plans/{meal_plan_id}/accept", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+
+        assert response.status_code == 400
+        print(f"Drafts waiting: {len(drafts)}")
+
+    def test_screen_meal_plan_allergens(self):
+        """Test allergen screening of a stored plan"""
+        response = requests.get(f"{BASE_URL}/api/meal-plans/{meal_plan_id}/allergens", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+
+        assert response.status_code == 200, f"Allergen screen failed: {response.text}"
+        data = response.json()
+        assert "restrictions" in data
+        assert isinstance(data["violations"], list)
+        print(f"Allergen screen found {len(data['violations'])} offending slots")
+
+    def test_optimize_meal_plan(self):
+        """Test ingredient-overlap optimization suggestions"""
+        response = requests.post(f"{BASE_URL}/api/meal-plans/{meal_plan_id}/optimize",
+            json={"apply": False},
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+
+        assert response.status_code == 200, f"Optimize failed: {response.text}"
+        data = response.json()
+        assert data["distinct_ingredients_after"] <= data["distinct_ingredients_before"]
+        assert data["applied"] is False
+        print(f"Optimizer suggested {len(data['swaps'])} swaps")
+
+    def test_local_plan_without_api_key(self):
+        """Test that users without an AI key get a plan from the local meals library"""
+        register = requests.post(f"{BASE_URL}/api/auth/register", json={
+            "email": f"test_local_{uuid.uuid4().hex[:8]}@example.com",
+            "password": TEST_PASSWORD,
+            "name": TEST_NAME
+        })
+        assert register.status_code == 200
+        local_token = register.json()["token"]
+
+        response = requests.post(f"{BASE_URL}/api/meal-plans",
+            json={"plan_type": "weekly", "generate_with_ai": True},
+            headers={"Authorization": f"Bearer {local_token}"}
+        )
+
+        assert response.status_code == 200, f"Local plan failed: {response.text}"
+        data = response.json()
+        assert len(data["days"]) == 7
+        assert any(day["meals"]["dinner"] for day in data["days"])
+        print(f"Local plan created: {data['id']}")
+
 
 class TestSupplements:
     """Supplement library and user supplement tests"""
@@ -315,6 +483,28 @@ class TestSupplements:
         assert "id" in data
         print("Supplement intake logged")
     
+    def test_log_supplement_idempotent_retry(self):
+        """Test that a retried log with the same Idempotency-Key is replayed, not logged twice"""
+        headers = {
+            "Authorization": f"Bearer {auth_token}",
+            "Idempotency-Key": f"test-log-{uuid.uuid4()}"
+        }
+        body = {"user_supplement_id": user_supplement_id, "dose_taken": 500}
+        first = requests.post(f"{BASE_URL}/api/supplement-logs", json=body, headers=headers)
+        retry = requests.post(f"{BASE_URL}/api/supplement-logs", json=body, headers=headers)
+        
+        assert first.status_code == 200
+        assert retry.status_code == 200
+        assert retry.json()["id"] == first.json()["id"]
+        assert retry.headers.get("Idempotent-Replayed") == "true"
+        
+        mismatch = requests.post(f"{BASE_URL}/api/supplement-logs",
+            json={**body, "dose_taken": 250},
+            headers=headers
+        )
+        assert mismatch.status_code == 422
+        print("Idempotent supplement log replayed")
+    
     def test_get_supplement_logs(self):
         """Test getting supplement logs"""
         response = requests.get(f"{BASE_URL}/api/supplement-logs", headers={
@@ -345,7 +535,36 @@ class TestShoppingLists:
         assert "items" in data
         assert data["meal_plan_id"] == meal_plan_id
         print(f"Shopping list generated with {len(data['items'])} items")
-    
+
+    def test_regenerate_shopping_list_reuses_row(self):
+        """Test that generating again for the same plan updates the existing list"""
+        first = requests.post(f"{BASE_URL}/api/shopping-lists?meal_plan_id={meal_plan_id}",
+            json={},
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+        second = requests.post(f"{BASE_URL}/api/shopping-lists?meal_plan_id={meal_plan_id}",
+            json={},
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+
+        assert first.status_code == 200
+        assert second.status_code == 200
+        assert first.json()["id"] == second.json()["id"]
+        print("Shopping list refreshed in place")
+
+    def test_consolidated_shopping_list(self):
+        """Test streaming a combined list for several meal plans"""
+        response = requests.post(f"{BASE_URL}/api/shopping-lists/consolidated",
+            json={"meal_plan_ids": [meal_plan_id]},
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+
+        assert response.status_code == 200, f"Consolidated list failed: {response.text}"
+        lines = [json.loads(line) for line in response.text.splitlines() if line]
+        assert lines[0]["meal_plan_ids"] == [meal_plan_id]
+        assert len(lines) == len(lines[0]["categories"]) + 1
+        print(f"Consolidated list has {lines[0]['item_count']} items")
+
     def test_get_shopping_lists(self):
         """Test getting all shopping lists"""
         response = requests.get(f"{BASE_URL}/api/shopping-lists", headers={
@@ -394,6 +613,19 @@ class TestSubscription:
         assert response.status_code in [200, 500]
         print("Yearly checkout test completed")
     
+    def test_checkout_invalid_package(self):
+        """Test that unknown packages are rejected before any Stripe call"""
+        response = requests.post(f"{BASE_URL}/api/subscriptions/checkout",
+            json={
+                "package_id": "lifetime",
+                "origin_url": "https://platepal-6.preview.emergentagent.com"
+            },
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+        
+        assert response.status_code == 400
+        print("Unknown checkout package correctly rejected")
+    
     def test_subscription_details(self):
         """Test getting subscription details"""
         response = requests.get(f"{BASE_URL}/api/subscriptions/details", headers={
@@ -404,6 +636,46 @@ class TestSubscription:
         data = response.json()
         assert "status" in data
         print(f"Subscription status: {data['status']}")
+    
+    def test_subscription_entitlement(self):
+        """Test the locally resolved premium entitlement"""
+        response = requests.get(f"{BASE_URL}/api/subscriptions/entitlement", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert isinstance(data["is_premium"], bool)
+        assert data["source"] in ["stripe", "grant", "none"]
+        print(f"Entitlement: premium={data['is_premium']} source={data['source']}")
+    
+    def test_webhook_rejects_invalid_payload(self):
+        """Test that unverifiable webhook bodies are rejected before being queued"""
+        response = requests.post(f"{BASE_URL}/api/webhook/stripe",
+            data="not json",
+            headers={"Stripe-Signature": "t=0,v1=invalid"}
+        )
+        
+        assert response.status_code == 400
+        print("Invalid webhook payload rejected")
+    
+    def test_stripe_events_admin_only(self):
+        """Test that the webhook event log and replay are restricted to admins"""
+        response = requests.get(f"{BASE_URL}/api/admin/stripe-events", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+        
+        assert response.status_code == 403
+        print("Stripe event log correctly restricted to admins")
+    
+    def test_reconciliation_admin_only(self):
+        """Test that subscription reconciliation runs are restricted to admins"""
+        response = requests.post(f"{BASE_URL}/api/admin/reconciliation/run", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+        
+        assert response.status_code == 403
+        print("Reconciliation correctly restricted to admins")
 
 
 class TestPromoCode:
@@ -418,6 +690,16 @@ class TestPromoCode:
         
         assert response.status_code == 404
         print("Invalid promo code correctly rejected")
+    
+    def test_bulk_promo_admin_only(self):
+        """Test that bulk code generation is restricted to admins"""
+        response = requests.post(f"{BASE_URL}/api/admin/promo/bulk",
+            json={"prefix": "TEST", "count": 10},
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+        
+        assert response.status_code == 403
+        print("Bulk promo generation correctly restricted to admins")
 
 
 class TestOAuthStatus:
@@ -0,0 +1,262 @@
+"""
+Postgres-backed tests for Conqueror's Court backend queries
+Need DATABASE_URL pointing at a database with the app schema; skipped otherwise
+"""
+import asyncio
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import server
+
+pytestmark = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason="DATABASE_URL not set")
+
+
+def run_with_db(test):
+    """Run an async test body against a fresh pool with the additive schema applied"""
+    async def wrapper():
+        await db.init_pool()
+        try:
+            await db.init_schema()
+            await test()
+        finally:
+            await db.close_pool()
+    asyncio.run(wrapper())
+
+
+async def create_user(**fields):
+    user = {
+        "id": str(uuid.uuid4()),
+        "email": f"test_{uuid.uuid4().hex[:8]}@example.com",
+        "name": "DB Test User",
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        **fields,
+    }
+    await db.insert_user(user)
+    return user
+
+
+class TestPregeneration:
+    """Scheduled pre-generation queues one draft job per plan"""
+    
+    def test_two_ticks_enqueue_one_job(self, monkeypatch):
+        """A batched job still blocks the next tick, and so does a recent failure"""
+        monkeypatch.setattr(server, "_is_offpeak", lambda now: True)
+        monkeypatch.setattr(server, "PREGEN_DAILY_TOKEN_BUDGET", 10 ** 12)
+        monkeypatch.setattr(server, "AI_BATCH_ENABLED", True)
+        
+        async def find_ai_config(user_id):
+            return {"user_id": user_id, "provider": "openai", "api_key": "sk-test"}
+        monkeypatch.setattr(server, "find_ai_config", find_ai_config)
+        
+        async def body():
+            user = await create_user()
+            now = datetime.now(timezone.utc)
+            plan_id = str(uuid.uuid4())
+            await db.insert_meal_plan({
+                "id": plan_id,
+                "user_id": user["id"],
+                "plan_type": "weekly",
+                "start_date": (now - timedelta(days=5)).isoformat(),
+                "end_date": (now + timedelta(hours=36)).isoformat(),
+                "created_at": now.isoformat(),
+                "status": "active",
+            })
+            count_jobs = lambda: db.fetch_count(
+                "SELECT COUNT(*) FROM ai_jobs WHERE payload->>'source_plan_id' = $1", plan_id
+            )
+            try:
+                await server.schedule_pregeneration()
+                await server.schedule_pregeneration()
+                assert await count_jobs() == 1
+                
+                await db.execute(
+                    "UPDATE ai_jobs SET status = 'failed', updated_at = NOW() WHERE payload->>'source_plan_id' = $1", plan_id
+                )
+                await server.schedule_pregeneration()
+                assert await count_jobs() == 1
+                print(f"Jobs for plan after three ticks: {await count_jobs()}")
+            finally:
+                await db.execute("DELETE FROM ai_jobs WHERE payload->>'source_plan_id' = $1", plan_id)
+                await db.execute("DELETE FROM meal_plans WHERE id = $1", plan_id)
+                await db.execute("DELETE FROM users WHERE id = $1", user["id"])
+        
+        run_with_db(body)
+
+
+async def create_promo(**fields):
+    promo = {
+        "id": str(uuid.uuid4()),
+        "code": f"TEST{uuid.uuid4().hex[:8].upper()}",
+        "max_uses": 0,
+        "active": True,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        **fields,
+    }
+    assert await db.insert_promo_code(promo)
+    return promo
+
+
+async def delete_promo(code, *user_ids):
+    await db.execute("DELETE FROM promo_redemptions WHERE promo_code = $1", code)
+    await db.execute("DELETE FROM promo_codes WHERE code = $1", code)
+    for user_id in user_ids:
+        await db.execute("DELETE FROM users WHERE id = $1", user_id)
+
+
+class TestPromoRedemption:
+    """Atomic promo redemption and its rejection reasons"""
+    
+    def test_same_user_twice_is_rejected(self, monkeypatch):
+        """The second redemption by one user gets 400 and does not use up the code"""
+        async def body():
+            user = await create_user()
+            promo = await create_promo(max_uses=5)
+            
+            async def get_current_user(authorization=None):
+                return user
+            monkeypatch.setattr(server, "get_current_user", get_current_user)
+            monkeypatch.setattr(server, "unavailable_promo_codes", server._cache_mod.TTLCache())
+            try:
+                first = await server.redeem_promo_code(server.PromoCodeRedeem(code=promo["code"]), authorization="Bearer x")
+                assert first["subscription_status"] == "active"
+                with pytest.raises(server.HTTPException) as exc:
+                    await server.redeem_promo_code(server.PromoCodeRedeem(code=promo["code"]), authorization="Bearer x")
+                assert exc.value.status_code == 400
+                assert "already redeemed" in exc.value.detail
+                assert (await db.find_promo_by_code(promo["code"]))["uses"] == 1
+                print(f"Second redemption: {exc.value.detail}")
+            finally:
+                await delete_promo(promo["code"], user["id"])
+        
+        run_with_db(body)
+    
+    def test_last_use_race(self):
+        """Concurrent redemptions of a code's last use grant it exactly once"""
+        async def body():
+            users = [await create_user() for _ in range(8)]
+            promo = await create_promo(max_uses=3, uses=2)
+            end = datetime(2099, 12, 31, tzinfo=timezone.utc).isoformat()
+            try:
+                results = await asyncio.gather(*[db.redeem_promo(promo["code"], user["id"], end) for user in users])
+                statuses = sorted(result["status"] for result in results)
+                assert statuses.count("redeemed") == 1
+                assert statuses.count("exhausted") == len(users) - 1
+                assert (await db.find_promo_by_code(promo["code"]))["uses"] == 3
+                granted = await db.fetch_count(
+                    "SELECT COUNT(*) FROM users WHERE id = ANY($1::text[]) AND subscription_status = 'active'",
+                    [user["id"] for user in users]
+                )
+                assert granted == 1
+                print(f"Race results: {statuses}")
+            finally:
+                await delete_promo(promo["code"], *[user["id"] for user in users])
+        
+        run_with_db(body)
+    
+    def test_rejection_reasons(self):
+        """Unknown, deactivated, expired and used-up codes each report their own reason"""
+        async def body():
+            user = await create_user()
+            end = datetime(2099, 12, 31, tzinfo=timezone.utc).isoformat()
+            past = (datetime.now(timezone.utc) - timedelta(days=1)).isoformat()
+            promos = {
+                "inactive": await create_promo(active=False),
+                "expired": await create_promo(valid_until=past),
+                "exhausted": await create_promo(max_uses=1, uses=1),
+            }
+            try:
+                assert (await db.redeem_promo("TESTNOSUCHCODE", user["id"], end))["status"] == "not_found"
+                for reason, promo in promos.items():
+                    assert (await db.redeem_promo(promo["code"], user["id"], end))["status"] == reason
+                assert (await db.find_user_by_id(user["id"]))["subscription_status"] != "active"
+                print(f"Rejections checked: not_found, {', '.join(promos)}")
+            finally:
+                for promo in promos.values():
+                    await delete_promo(promo["code"])
+                await db.execute("DELETE FROM users WHERE id = $1", user["id"])
+        
+        run_with_db(body)
+
+
+class TestShoppingListLocking:
+    """Shopping list read-modify-writes are serialized per list"""
+    
+    def test_concurrent_checks_are_not_lost(self, monkeypatch):
+        """Checking two items at the same time keeps both checks"""
+        async def body():
+            user = await create_user()
+            now = datetime.now(timezone.utc).isoformat()
+            list_id = str(uuid.uuid4())
+            await db.insert_shopping_list({
+                "id": list_id,
+                "user_id": user["id"],
+                "meal_plan_id": str(uuid.uuid4()),
+                "items": [
+                    {"name": "rice", "quantity": 2, "unit": "cup", "category": "Grains", "checked": False},
+                    {"name": "onion", "quantity": 1, "unit": "unit", "category": "Produce", "checked": False},
+                ],
+                "created_at": now,
+            })
+            
+            async def get_current_user(authorization=None):
+                return user
+            monkeypatch.setattr(server, "get_current_user", get_current_user)
+            try:
+                await asyncio.gather(*[
+                    server.check_shopping_list_item(list_id, server.ShoppingItemCheck(name=name, unit=unit, checked=True), authorization="Bearer x")
+                    for name, unit in (("rice", "cup"), ("onion", "unit"))
+                ])
+                row = await db.fetch_one("SELECT items FROM shopping_lists WHERE id = $1", list_id)
+                items = db._deserialize_jsonb(row["items"])
+                assert all(item["checked"] and item["checked_by_user"] for item in items)
+                print(f"Checked items: {[item['name'] for item in items]}")
+            finally:
+                await db.execute("DELETE FROM shopping_lists WHERE id = $1", list_id)
+                await db.execute("DELETE FROM users WHERE id = $1", user["id"])
+        
+        run_with_db(body)
+
+
+class TestConsolidationRange:
+    """The consolidation date range includes plans on its boundary days"""
+    
+    def test_plans_on_boundary_dates_are_included(self):
+        """Plans starting on the first or last day of the range are found; one ending before it is not"""
+        async def body():
+            user = await create_user()
+            start = datetime(2026, 10, 19, 8, 30, tzinfo=timezone.utc)
+            plans = {
+                "before": start - timedelta(days=7),
+                "first_day": start,
+                "last_day": start + timedelta(days=13),
+            }
+            ids = {}
+            for label, plan_start in plans.items():
+                ids[label] = str(uuid.uuid4())
+                await db.insert_meal_plan({
+                    "id": ids[label],
+                    "user_id": user["id"],
+                    "plan_type": "weekly",
+                    "start_date": plan_start.isoformat(),
+                    "end_date": (plan_start + timedelta(days=7)).isoformat(),
+                    "created_at": plan_start.isoformat(),
+                    "status": "active",
+                })
+            try:
+                found = await db.find_meal_plans_for_consolidation(
+                    user["id"], [], start.date(), (start + timedelta(days=13)).date()
+                )
+                assert {plan["id"] for plan in found} == {ids["first_day"], ids["last_day"]}
+                print(f"Plans in range: {len(found)}")
+            finally:
+                await db.execute("DELETE FROM meal_plans WHERE user_id = $1", user["id"])
+                await db.execute("DELETE FROM users WHERE id = $1", user["id"])
+        
+        run_with_db(body)
@@ -0,0 +1,779 @@
+"""
+Offline tests for Conqueror's Court backend modules
+Run without a server or database: business logic is exercised directly
+"""
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+import shopping
+
+USER = {"id": "user-1", "email": "cook@example.com", "allergies": [], "role": "user"}
+
+
+def _meal(name, ingredients, tags=(), cooking_method="stovetop"):
+    # Library meals store structured ingredients, as POST /meals does
+    parsed = [shopping.parse_ingredient_string(ingredient) for ingredient in ingredients]
+    return {
+        "id": f"meal-{name.lower().replace(' ', '-')}",
+        "name": name,
+        "description": None,
+        "ingredients": [{"name": p["name"], "quantity": p["quantity"], "unit": p["unit"]} for p in parsed],
+        "instructions": ["Cook it"],
+        "tags": list(tags),
+        "cooking_method": cooking_method,
+        "prep_time": 10,
+        "cook_time": 20,
+        "servings": 2,
+        "created_at": "2026-01-01T00:00:00+00:00",
+    }
+
+
+def _day(name, dinner=None, lunch=None, lunch_is_leftover=False, locked=False):
+    meals = {"breakfast": None, "lunch": None, "dinner": None, "snack": None}
+    recipes = {}
+    for meal_type, meal in (("lunch", lunch), ("dinner", dinner)):
+        if meal:
+            meals[meal_type] = meal["name"]
+            recipes[meal_type] = server._meal_to_recipe(meal)
+    return {
+        "day": name,
+        "meals": meals,
+        "is_leftover": {"breakfast": False, "lunch": lunch_is_leftover, "dinner": False, "snack": False},
+        "instructions": {},
+        "recipes": recipes,
+        "locked": locked,
+    }
+
+
+def _stored_plan(days, **overrides):
+    return {
+        "id": "plan-1",
+        "user_id": USER["id"],
+        "plan_type": "weekly",
+        "start_date": "2026-10-19",
+        "end_date": "2026-10-25",
+        "days": days,
+        "dietary_preferences": [],
+        "cooking_methods": [],
+        "servings": 2,
+        "created_at": "2026-10-19T00:00:00+00:00",
+        **overrides,
+    }
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """Patch the database aliases server.py uses with in-memory state"""
+    state = {"plan": None, "meals": [], "user": dict(USER), "ai_config": None, "writes": []}
+    
+    async def get_current_user(authorization=None):
+        return state["user"]
+    
+    async def find_meal_plan_by_id(plan_id, user_id):
+        return state["plan"]
+    
+    async def find_meals(*args, **kwargs):
+        return list(state["meals"])
+    
+    async def find_ai_config(user_id):
+        return state["ai_config"]
+    
+    async def update_meal_plan(plan_id, user_id, fields):
+        state["writes"].append(("plan", fields))
+        return 1
+    
+    async def update_meal_plan_slot(plan_id, user_id, day_index, meal_type, meal_name, recipe, instruction):
+        state["writes"].append(("slot", day_index, meal_type, meal_name))
+        return 1
+    
+    async def refresh_shopping_list_for_plan(user_id, plan):
+        return None
+    
+    for fn in (
+        get_current_user, find_meal_plan_by_id, find_meals, find_ai_config,
+        update_meal_plan, update_meal_plan_slot, refresh_shopping_list_for_plan
+    ):
+        monkeypatch.setattr(server, fn.__name__, fn)
+    return state
+
+
+def _plan(*ingredients, servings=2):
+    return [{"day": "Monday", "recipes": {"dinner": {"name": "Test", "servings": servings, "ingredients": list(ingredients)}}}]
+
+
+class TestRescale:
+    """Plan rescaling always starts from the recipe's original quantities"""
+    
+    def test_round_trip_restores_original(self):
+        """Scaling 2 -> 3 -> 2 gives back the exact original ingredients"""
+        original = ["3 cloves garlic", "1 egg", "1/2 onion", "2 tbsp butter", "Salt to taste"]
+        days = _plan(*original)
+        up = shopping.scale_days(days, 2, 3)
+        back = shopping.scale_days(up, 3, 2)
+        recipe = back[0]["recipes"]["dinner"]
+        
+        assert recipe["ingredients"] == original
+        assert recipe["servings"] == 2
+        assert shopping.SCALE_BASE_KEY not in recipe
+        print(f"Round trip ingredients: {recipe['ingredients']}")
+    
+    def test_repeated_rescale_does_not_drift(self):
+        """Going through several sizes scales from the base, not the last rounded values"""
+        days = _plan("3 cloves garlic", "1 egg", "1/2 onion")
+        current = 2
+        for servings in (3, 1, 5, 3):
+            days = shopping.scale_days(days, current, servings)
+            current = servings
+        direct = shopping.scale_days(_plan("3 cloves garlic", "1 egg", "1/2 onion"), 2, 3)
+        
+        assert days[0]["recipes"]["dinner"]["ingredients"] == direct[0]["recipes"]["dinner"]["ingredients"]
+        print(f"Scaled to 3 servings: {direct[0]['recipes']['dinner']['ingredients']}")
+    
+    def test_scaled_units_are_measurable(self):
+        """Volumes are re-expressed in kitchen units and counts round up"""
+        days = shopping.scale_days(_plan("2 tbsp butter", "1 egg", "1/2 onion", {"name": "rice", "quantity": 1, "unit": "cup"}), 2, 6)
+        ingredients = days[0]["recipes"]["dinner"]["ingredients"]
+        
+        assert ingredients[0] == "1/2 cup butter"
+        assert ingredients[1] == "3 egg"
+        assert ingredients[2] == "1 1/2 onion"
+        assert ingredients[3]["quantity"] == 3 and ingredients[3]["unit"] == "cup"
+        print(f"Tripled ingredients: {ingredients}")
+
+
+class TestLocalSwap:
+    """Swaps from the meals library respect the plan and fall back to the AI otherwise"""
+    
+    def test_swap_respects_dietary_preferences(self, store):
+        """A meat dinner is never swapped into a vegetarian plan"""
+        store["meals"] = [
+            _meal("Beef Rice Bowl", ["1 lb beef", "1 cup rice", "1 onion"]),
+            _meal("Veggie Rice Bowl", ["1 cup rice", "1 onion", "1 pepper"], tags=["vegetarian"]),
+        ]
+        current = _meal("Bean Chili", ["1 can beans", "1 onion"], tags=["vegetarian"])
+        store["plan"] = _stored_plan(
+            [_day("Monday", dinner=current), _day("Tuesday", dinner=_meal("Fried Rice", ["1 cup rice"]))],
+            dietary_preferences=["vegetarian"]
+        )
+        
+        plan = asyncio.run(server.swap_meal("plan-1", "Monday", "dinner", server.SwapRequest(), authorization="Bearer x"))
+        
+        assert plan.days[0].meals["dinner"] == "Veggie Rice Bowl"
+        print(f"Swapped to {plan.days[0].meals['dinner']}")
+    
+    def test_swap_without_overlap_uses_ai(self, store):
+        """A library meal that shares no ingredients does not replace the AI suggestion"""
+        store["meals"] = [_meal("Fruit Salad", ["1 apple", "1 banana"])]
+        store["plan"] = _stored_plan([
+            _day("Monday", dinner=_meal("Bean Chili", ["1 can beans", "1 onion"])),
+            _day("Tuesday", dinner=_meal("Onion Soup", ["2 onion", "1 cup broth"])),
+        ])
+        
+        with pytest.raises(server.HTTPException) as exc:
+            asyncio.run(server.swap_meal("plan-1", "Monday", "dinner", server.SwapRequest(), authorization="Bearer x"))
+        
+        assert exc.value.status_code == 400
+        assert store["writes"] == []
+        print(f"No local match: {exc.value.detail}")
+    
+    def test_swap_dinner_moves_leftover_lunch(self, store):
+        """The next day's leftover lunch follows the new dinner"""
+        store["meals"] = [_meal("Onion Pasta", ["1 onion", "8 oz pasta"])]
+        chili = _meal("Bean Chili", ["1 can beans", "1 onion"])
+        store["plan"] = _stored_plan([
+            _day("Monday", dinner=chili),
+            _day("Tuesday", lunch=chili, lunch_is_leftover=True, dinner=_meal("Onion Soup", ["2 onion"])),
+        ])
+        
+        plan = asyncio.run(server.swap_meal("plan-1", "Monday", "dinner", server.SwapRequest(), authorization="Bearer x"))
+        
+        assert plan.days[0].meals["dinner"] == "Onion Pasta"
+        assert plan.days[1].meals["lunch"] == "Onion Pasta"
+        assert plan.days[1].is_leftover["lunch"] is True
+        assert store["writes"][0][0] == "plan"
+        print(f"Tuesday lunch: {plan.days[1].meals['lunch']}")
+
+
+class TestLocalPlanner:
+    """Plans built from the meals library without an AI key"""
+    
+    def test_library_plan_passes_response_validation(self, store):
+        """Library meals with structured ingredients become servable recipe text"""
+        store["meals"] = [
+            _meal("Veggie Omelette", ["2 egg", "1 pepper"], tags=["breakfast"]),
+            _meal("Bean Chili", ["1 can beans", "1 onion", "1 lb beef"]),
+            _meal("Onion Pasta", ["8 oz pasta", "1 onion"]),
+            _meal("Fried Rice", ["1 cup rice", "2 egg"]),
+        ]
+        
+        plan = asyncio.run(server._build_meal_plan(store["user"], server.MealPlanCreate(generate_with_ai=True, servings=2)))
+        response = server._plan_response(plan)
+        
+        recipes = [recipe for day in response.days for recipe in (day.recipes or {}).values()]
+        assert recipes
+        assert all(isinstance(ingredient, str) for recipe in recipes for ingredient in recipe.ingredients)
+        print(f"Monday: {response.days[0].meals}")
+
+
+class TestAllergenSafety:
+    """Library meals used by the optimizer and the allergen fixer pass the allergen matcher"""
+    
+    def test_optimizer_skips_dairy_for_dairy_allergy(self, store, monkeypatch):
+        """A dairy-allergic user's optimized plan has no butter, cheese or milk"""
+        monkeypatch.setattr(server, "optimizer_executor", None)
+        store["user"] = {**USER, "allergies": ["dairy"]}
+        store["meals"] = [
+            _meal("Buttered Noodles", ["8 oz pasta", "2 tbsp butter", "1 onion"]),
+            _meal("Mac and Cheese", ["8 oz pasta", "1 cup cheese", "1 cup milk"]),
+            _meal("Pasta Primavera", ["8 oz pasta", "1 onion", "1 pepper"]),
+        ]
+        store["plan"] = _stored_plan([
+            _day("Monday", dinner=_meal("Onion Pasta", ["8 oz pasta", "1 onion"])),
+            _day("Tuesday", dinner=_meal("Lentil Stew", ["1 cup lentils", "1 carrot", "1 celery"])),
+            _day("Wednesday", dinner=_meal("Tofu Curry", ["1 block tofu", "1 can coconut", "1 lime"])),
+        ])
+        
+        result = asyncio.run(server.optimize_meal_plan(
+            "plan-1", server.OptimizeRequest(apply=True), authorization="Bearer x"
+        ))
+        
+        dairy = {"butter", "cheese", "milk"}
+        for day in store["plan"]["days"]:
+            for recipe in day["recipes"].values():
+                names = {item["name"].lower() for item in shopping.recipe_contribution(recipe).values()}
+                assert not any(word in name for name in names for word in dairy), names
+        assert all(swap["to"] == "Pasta Primavera" for swap in result["swaps"])
+        print(f"Optimizer swaps: {result['swaps']}")
+    
+    def test_applied_optimizer_plan_is_servable(self, store, monkeypatch):
+        """Swaps applied from the library write recipe text that validates on read"""
+        monkeypatch.setattr(server, "optimizer_executor", None)
+        store["meals"] = [_meal("Onion Rice", ["1 cup rice", "1 onion"])]
+        store["plan"] = _stored_plan([
+            _day("Monday", dinner=_meal("Fried Rice", ["1 cup rice", "2 egg"])),
+            _day("Tuesday", dinner=_meal("Lamb Tagine", ["1 lb lamb", "1 onion", "1 tsp saffron"])),
+        ])
+        
+        result = asyncio.run(server.optimize_meal_plan(
+            "plan-1", server.OptimizeRequest(apply=True), authorization="Bearer x"
+        ))
+        
+        assert result["applied"]
+        written = store["writes"][0][1]["days"]
+        response = server._plan_response({**store["plan"], "days": written})
+        assert "Onion Rice" in {day.meals["dinner"] for day in response.days}
+        print(f"Applied swaps: {result['swaps']}")
+    
+    def test_allergen_fix_swaps_in_library_meal(self, store):
+        """An offending slot is replaced from the library with recipe text, without the AI"""
+        store["meals"] = [
+            _meal("Cheese Pasta", ["8 oz pasta", "1 cup cheese"]),
+            _meal("Garlic Pasta", ["8 oz pasta", "2 cloves garlic"]),
+        ]
+        days = [
+            _day("Monday", dinner=_meal("Mac and Cheese", ["8 oz pasta", "1 cup cheese"])),
+            _day("Tuesday", dinner=_meal("Pasta Salad", ["8 oz pasta", "1 tomato"])),
+        ]
+        
+        found = asyncio.run(server._enforce_allergens(
+            USER, days, ["dairy"], None, {"servings": 2, "dietary_preferences": [], "cooking_methods": []}
+        ))
+        
+        assert found[0]["day"] == "Monday"
+        assert days[0]["meals"]["dinner"] == "Garlic Pasta"
+        response = server._plan_response(_stored_plan(days))
+        assert all(isinstance(ingredient, str) for ingredient in response.days[0].recipes["dinner"].ingredients)
+        print(f"Monday dinner: {response.days[0].recipes['dinner'].ingredients}")
+    
+    def test_allergen_fix_survives_rate_limit(self, store, monkeypatch):
+        """A governor 429 during the fix clears the slot instead of failing the job"""
+        async def rate_limited(*args, **kwargs):
+            raise server.HTTPException(status_code=429, detail="Too many AI requests")
+        
+        monkeypatch.setattr(server, "call_llm", rate_limited)
+        store["meals"] = [_meal("Beef Stew", ["1 lb beef", "1 carrot"])]
+        days = [
+            _day("Monday", dinner=_meal("Mac and Cheese", ["8 oz pasta", "1 cup cheese"])),
+            _day("Tuesday", dinner=_meal("Carrot Soup", ["2 carrot"])),
+        ]
+        
+        found = asyncio.run(server._enforce_allergens(
+            USER, days, ["dairy"], {"provider": "openai", "api_key": "sk-test"},
+            {"servings": 2, "dietary_preferences": ["vegetarian"], "cooking_methods": []}
+        ))
+        
+        assert found[0]["day"] == "Monday"
+        assert days[0]["meals"]["dinner"] is None
+        print(f"Cleared after rate limit: {found}")
+
+
+def _stripe_subscription(sub_id, customer, status="active", period_end=1800000000, interval="month", cancel=False):
+    return {
+        "id": sub_id,
+        "customer": customer,
+        "status": status,
+        "cancel_at_period_end": cancel,
+        "items": {"data": [{"current_period_end": period_end, "price": {"recurring": {"interval": interval}}}]},
+    }
+
+
+class TestReconciliation:
+    """Stripe reconciliation against an in-memory subscription source"""
+    
+    def test_drift_report_and_corrections(self, monkeypatch):
+        """Drifted rows are reported and corrected; matching and unknown customers are not"""
+        source = server._reconcile_mod.FakeSubscriptionSource([
+            _stripe_subscription("sub_ok", "cus_ok"),
+            _stripe_subscription("sub_canceled", "cus_drift", status="canceled"),
+            _stripe_subscription("sub_stranger", "cus_unknown"),
+        ])
+        period_end = server._timestamp_dt(1800000000)
+        local_rows = [
+            {"user_id": "u-ok", "stripe_customer_id": "cus_ok", "user_status": "active", "subscription_end_date": period_end.isoformat(),
+             "stripe_subscription_id": "sub_ok", "status": "active", "plan": "month", "current_period_end": period_end, "cancel_at_period_end": False},
+            {"user_id": "u-drift", "stripe_customer_id": "cus_drift", "user_status": "active", "subscription_end_date": period_end.isoformat(),
+             "stripe_subscription_id": "sub_canceled", "status": "active", "plan": "month", "current_period_end": period_end, "cancel_at_period_end": False},
+        ]
+        applied, finished = [], []
+        
+        async def find_subscription_state_by_customers(customer_ids):
+            return [row for row in local_rows if row["stripe_customer_id"] in customer_ids]
+        
+        async def apply_subscription_corrections(subscriptions, users):
+            applied.append((subscriptions, users))
+        
+        async def checkpoint_reconciliation_run(run_id, cursor, report):
+            pass
+        
+        async def finish_reconciliation_run(run_id, status, report, error=None):
+            finished.append((status, report))
+        
+        for fn in (find_subscription_state_by_customers, apply_subscription_corrections,
+                   checkpoint_reconciliation_run, finish_reconciliation_run):
+            monkeypatch.setattr(server, fn.__name__, fn)
+        monkeypatch.setattr(server, "subscription_source", source)
+        
+        report = asyncio.run(server._execute_reconciliation({"id": "run-1", "dry_run": False, "cursor": None, "report": None}))
+        
+        assert report["scanned"] == 3
+        assert report["drifted"] == 1 and report["corrected"] == 1 and report["skipped"] == 1
+        assert report["fields"] == {"status": 1, "user.subscription_status": 1}
+        assert report["samples"][0]["user_id"] == "u-drift"
+        subscriptions, users = applied[0]
+        assert [(s["user_id"], s["status"]) for s in subscriptions] == [("u-drift", "canceled")]
+        assert users == [{"user_id": "u-drift", "subscription_status": "inactive", "subscription_end_date": None}]
+        assert finished[0][0] == "completed"
+        print(f"Drift report: {report['fields']}")
+    
+    def test_resume_starts_from_checkpoint(self):
+        """A run that dies mid-way resumes after its last checkpoint instead of from the start"""
+        reconcile = server._reconcile_mod
+        source = reconcile.FakeSubscriptionSource(
+            [_stripe_subscription(f"sub_{i:02d}", f"cus_{i:02d}") for i in range(10)]
+        )
+        checkpoints = []
+        
+        async def checkpoint(cursor, report):
+            checkpoints.append((cursor, report.scanned))
+        
+        async def failing_page(items):
+            if items[0]["id"] == "sub_06":
+                raise RuntimeError("database went away")
+            return reconcile.PageOutcome(drifts=[])
+        
+        first = reconcile.Reconciler(source, failing_page, checkpoint, concurrency=1, page_size=2)
+        with pytest.raises(RuntimeError):
+            asyncio.run(first.run())
+        cursor, scanned = checkpoints[-1]
+        assert cursor == "sub_05" and scanned == 6
+        
+        seen = []
+        
+        async def record_page(items):
+            seen.extend(item["id"] for item in items)
+            return reconcile.PageOutcome(drifts=[])
+        
+        source.pages_served = 0
+        second = reconcile.Reconciler(source, record_page, checkpoint, concurrency=1, page_size=2)
+        report = asyncio.run(second.run(cursor, reconcile.DriftReport(scanned=scanned)))
+        
+        assert source.pages_served == 2
+        assert seen == ["sub_06", "sub_07", "sub_08", "sub_09"]
+        assert report.scanned == 10
+        print(f"Resumed after {cursor}, {source.pages_served} pages fetched")
+
+
+class TestStripeHelpers:
+    """Customer lookup cache and invoice period parsing"""
+    
+    def test_ttl_cache_expiry_and_eviction(self):
+        """Entries expire after their TTL and the least recently used one is evicted"""
+        cache = server._cache_mod.TTLCache(maxsize=2, ttl_seconds=60)
+        cache.set("cus_a", "user-a")
+        cache.set("cus_b", "user-b")
+        assert cache.get("cus_a") == "user-a"
+        cache.set("cus_c", "user-c")
+        assert cache.get("cus_b") is None
+        assert cache.get("cus_a") == "user-a"
+        
+        cache.set("cus_d", "user-d", ttl_seconds=-1)
+        assert cache.get("cus_d") is None
+        assert cache.stats()["hits"] == 2
+        print(f"Cache stats: {cache.stats()}")
+    
+    def test_resolve_customer_user_uses_cache(self, monkeypatch):
+        """A cached customer resolves without a database or Stripe lookup"""
+        async def find_user_id_by_stripe_customer(customer_id):
+            raise AssertionError("database should not be queried")
+        
+        monkeypatch.setattr(server, "find_user_id_by_stripe_customer", find_user_id_by_stripe_customer)
+        monkeypatch.setattr(server, "stripe_customer_users", server._cache_mod.TTLCache(maxsize=10, ttl_seconds=60))
+        server.stripe_customer_users.set("cus_cached", "user-1")
+        
+        assert asyncio.run(server.resolve_customer_user("cus_cached")) == "user-1"
+        assert asyncio.run(server.resolve_customer_user("cus_other", {"user_id": "user-2"})) == "user-2"
+        print("Cached customer resolved locally")
+    
+    def test_invoice_period_uses_latest_line(self):
+        """The invoice period comes from the line item that ends last"""
+        invoice = {"lines": {"data": [
+            {"period": {"start": 100, "end": 200}},
+            {"period": {"start": 200, "end": 300}},
+            {"description": "proration"},
+        ]}}
+        
+        assert server._invoice_period(invoice) == (200, 300)
+        assert server._invoice_period({"lines": {"data": []}}) == (None, None)
+        assert server._invoice_period({}) == (None, None)
+        print(f"Invoice period: {server._invoice_period(invoice)}")
+
+
+class TestJobContract:
+    """AI-backed plan endpoints hand back a job to poll"""
+    
+    def test_create_with_ai_returns_job_handle(self, store, monkeypatch):
+        """Creating a plan with AI answers 202 with a JobAccepted body"""
+        inserted = []
+        
+        async def insert_ai_job(job_doc):
+            inserted.append(job_doc)
+        
+        monkeypatch.setattr(server, "insert_ai_job", insert_ai_job)
+        monkeypatch.setattr(server, "ai_request_flights", server._singleflight_mod.SingleFlight())
+        store["ai_config"] = {"provider": "openai", "api_key": "sk-test"}
+        
+        response = asyncio.run(server.create_meal_plan(
+            server.MealPlanCreate(generate_with_ai=True), authorization="Bearer x"
+        ))
+        
+        assert response.status_code == 202
+        body = server.JobAccepted.model_validate_json(response.body)
+        assert body.job_id == inserted[0]["id"]
+        assert body.status_url == f"/api/jobs/{body.job_id}"
+        print(f"Job handle: {body}")
+    
+    def test_openapi_documents_202(self):
+        """The OpenAPI schema lists the job response next to the plan"""
+        paths = server.app.openapi()["paths"]
+        for path in ("/api/meal-plans", "/api/meal-plans/{plan_id}/regenerate"):
+            responses = paths[path]["post"]["responses"]
+            assert responses["202"]["content"]["application/json"]["schema"]["$ref"].endswith("/JobAccepted")
+            assert responses["200"]["content"]["application/json"]["schema"]["$ref"].endswith("/MealPlan")
+        print("Create and regenerate document 200 MealPlan and 202 JobAccepted")
+
+
+class TestProviderConfig:
+    """Provider selection and structured output requests"""
+    
+    def test_mock_provider_needs_dev_setting(self, monkeypatch):
+        """A stored mock config is not real LLM access unless mock is enabled"""
+        llm = server._llm_mod
+        mock_config = {"provider": "mock"}
+        fallback_config = {"provider": "openai", "api_key": "sk-test", "fallback_provider": "mock"}
+        
+        assert not llm.has_llm_access(mock_config)
+        assert llm.has_llm_access(mock_config, allow_mock=True)
+        assert len(llm.targets_from_config(fallback_config)) == 1
+        assert len(llm.targets_from_config(fallback_config, allow_mock=True)) == 2
+        
+        monkeypatch.setattr(server, "LLM_MOCK_ENABLED", False)
+        assert not server.has_llm_access(mock_config)
+        assert "mock" not in server.SELECTABLE_LLM_PROVIDERS
+        print(f"Selectable providers: {sorted(server.SELECTABLE_LLM_PROVIDERS)}")
+    
+    def test_openai_schema_is_strict(self):
+        """Every object in the OpenAI schema requires all its properties and allows no others"""
+        request = server._llm_mod.openai_response_format(server.MEAL_PLAN_FORMAT)
+        assert request["json_schema"]["strict"] is True
+        
+        def objects(node):
+            if isinstance(node, dict):
+                if "properties" in node:
+                    yield node
+                for value in node.values():
+                    yield from objects(value)
+            elif isinstance(node, list):
+                for value in node:
+                    yield from objects(value)
+        
+        checked = list(objects(request["json_schema"]["schema"]))
+        assert len(checked) == 3
+        for node in checked:
+            assert node["additionalProperties"] is False
+            assert sorted(node["required"]) == sorted(node["properties"])
+        print(f"Checked {len(checked)} strict objects")
+
+
+class TestPrompts:
+    """Prompt system messages are static and cacheable"""
+    
+    def test_system_prefix_is_static(self):
+        """Different users get byte-identical system prompts; their details go in the user message"""
+        prompts = server._prompts_mod
+        first = prompts.meal_plan_prompt(2, "lose_weight", ["peanuts"], ["Vegetarian"], ["Oven"], True)
+        second = prompts.meal_plan_prompt(5, "gain_muscle", ["shellfish"], [], ["Air Fryer"], True)
+        regen_a = prompts.regenerate_prompt(2, {"Monday": ["dinner"]}, "", ["dairy"], None, [], [])
+        regen_b = prompts.regenerate_prompt(4, {"Friday": ["lunch"]}, "Tuesday: Chili", ["gluten"], "eat_healthy", ["Vegan"], [])
+        
+        assert first.system == second.system
+        assert regen_a.system == regen_b.system
+        for prompt in (first, second, regen_a, regen_b):
+            assert prompt.static_tokens == prompts.count_tokens(prompt.system)
+        assert "peanuts" in first.user and "peanuts" not in first.system
+        assert "Servings per meal: 5" in second.user
+        print(f"Meal plan prefix: {first.static_tokens} tokens")
+    
+    def test_examples_do_not_fix_servings(self):
+        """The format examples leave servings to the request instead of hardcoding a number"""
+        prompts = server._prompts_mod
+        for system in (prompts.MEAL_PLAN_SYSTEM, prompts.REGENERATE_SYSTEM, prompts.SWAP_SYSTEM):
+            assert '"servings": 2' not in system
+            assert '"servings": <servings>' in system
+        print("Examples use a <servings> placeholder")
+
+
+class TestStructuredOutput:
+    """Malformed model output is repaired locally before giving up"""
+    
+    def test_repairs_fenced_truncated_output(self):
+        """Prose, code fences, trailing commas and a cut-off last day are repaired"""
+        raw = (
+            "Here is your plan:\n```json\n"
+            '{"days": [{"day": "Monday", "breakfast": "Oats", "snack": "Apple",},'
+            ' {"day": "Tuesday", "breakfast": "Eggs", "dinner_recipe": {"ingredients": ["2 eg'
+        )
+        plan = server.parse_structured(server.AIMealPlan, raw)
+        
+        assert [day.day for day in plan.days] == ["Monday", "Tuesday"]
+        assert plan.days[0].breakfast == "Oats"
+        assert plan.days[1].breakfast == "Eggs" and plan.days[1].dinner_recipe is None
+        print(f"Repaired days: {[day.day for day in plan.days]}")
+    
+    def test_normalizes_recipe_fields(self):
+        """Step lists, object ingredients and "4 people" servings are coerced into the schema"""
+        raw = '{"name": "Chili", "recipe": {"ingredients": ["1 onion", {"item": "beans"}], "instructions": ["Chop", "Simmer"], "servings": "4 people"}}'
+        swap = server.parse_structured(server.AIMealSwap, raw)
+        
+        assert swap.recipe.instructions == "1. Chop\n2. Simmer"
+        assert swap.recipe.servings == 4
+        assert swap.recipe.ingredients[1] == '{"item": "beans"}'
+        print(f"Normalized recipe: {swap.recipe}")
+    
+    def test_unrepairable_output_raises(self):
+        """Output with no JSON object raises StructuredOutputError"""
+        with pytest.raises(server.StructuredOutputError):
+            server.parse_structured(server.AIMealPlan, "Sorry, I can't help with that.")
+        print("Unrepairable output rejected")
+
+
+class TestSingleFlight:
+    """Identical concurrent AI requests share one execution"""
+    
+    def test_concurrent_calls_coalesce(self):
+        """Five identical calls in flight run the work once and all get its result"""
+        flights = server._singleflight_mod.SingleFlight(ttl_seconds=0)
+        calls = []
+        
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {"job_id": f"job-{len(calls)}"}
+        
+        async def body():
+            key = server.flight_key("user-1", "create_meal_plan", {"plan_data": {"dietary_preferences": ["Vegan", "Keto"]}})
+            same = server.flight_key("user-1", "create_meal_plan", {"plan_data": {"dietary_preferences": ["keto", "vegan "]}})
+            assert key == same
+            return await asyncio.gather(*[flights.do(key, work) for _ in range(5)])
+        
+        results = asyncio.run(body())
+        
+        assert len(calls) == 1
+        assert all(result == {"job_id": "job-1"} for result in results)
+        print(f"Coalesced results: {results[0]}")
+    
+    def test_errors_are_not_cached(self):
+        """A failed call is not replayed; the next caller runs again"""
+        flights = server._singleflight_mod.SingleFlight(ttl_seconds=30)
+        attempts = []
+        
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RuntimeError("provider down")
+            return "ok"
+        
+        async def body():
+            with pytest.raises(RuntimeError):
+                await flights.do("key", flaky)
+            first = await flights.do("key", flaky)
+            second = await flights.do("key", flaky)
+            return first, second
+        
+        assert asyncio.run(body()) == ("ok", "ok")
+        assert len(attempts) == 2
+        print(f"Attempts after a failure: {len(attempts)}")
+
+    
+    def test_cancelled_owner_does_not_cancel_waiters(self):
+        """When the first caller is cancelled, a waiter runs the call instead of failing"""
+        flights = server._singleflight_mod.SingleFlight(ttl_seconds=0)
+        calls = []
+        
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return f"run-{len(calls)}"
+        
+        async def body():
+            owner = asyncio.create_task(flights.do("key", work))
+            await asyncio.sleep(0.01)
+            waiters = [asyncio.create_task(flights.do("key", work)) for _ in range(3)]
+            await asyncio.sleep(0.01)
+            owner.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await owner
+            return await asyncio.gather(*waiters)
+        
+        results = asyncio.run(body())
+        
+        assert results == ["run-2"] * 3
+        assert len(calls) == 2
+        print(f"Waiters after owner cancel: {results}")
+
+class TestLockedDays:
+    """Regeneration never touches locked days"""
+    
+    def test_locked_day_is_byte_identical(self, store, monkeypatch):
+        """Even when the model answers for every day, a locked day comes back unchanged"""
+        async def call_llm(ai_config, prompt, system_message=None, response_format=None):
+            return json.dumps({"days": [
+                {"day": day, "breakfast": f"New Breakfast {day}", "dinner": f"New Dinner {day}",
+                 "dinner_recipe": {"ingredients": ["1 cup rice"], "instructions": "1. Cook", "servings": 2}}
+                for day in ("Monday", "Tuesday")
+            ]})
+        
+        monkeypatch.setattr(server, "call_llm", call_llm)
+        locked = _day("Monday", dinner=_meal("Bean Chili", ["1 can beans", "1 onion"]), locked=True)
+        locked["meal_times"] = dict(server.DEFAULT_MEAL_TIMES)
+        open_day = _day("Tuesday", dinner=_meal("Onion Soup", ["2 onion"]))
+        before = json.dumps(locked, sort_keys=True)
+        plan = _stored_plan([locked, open_day])
+        store["plan"] = plan
+        
+        targets = server._regeneration_targets(plan["days"], None)
+        assert "Monday" not in targets
+        updated = asyncio.run(server._regenerate_plan(
+            USER, plan, server.RegenerateRequest(), {"provider": "openai", "api_key": "sk-test"}, targets
+        ))
+        
+        written = store["writes"][-1][1]["days"]
+        assert json.dumps(updated["days"][0], sort_keys=True) == before
+        assert json.dumps(written[0], sort_keys=True) == before
+        assert updated["days"][1]["meals"]["dinner"] == "New Dinner Tuesday"
+        print(f"Locked Monday kept: {updated['days'][0]['meals']['dinner']}")
+
+
+class _FakeProvider:
+    def __init__(self, name, fail=False):
+        self.name = name
+        self.fail = fail
+        self.calls = 0
+    
+    async def complete(self, target, prompt, system_message, timeout, response_format=None):
+        self.calls += 1
+        if self.fail:
+            raise server.LLMProviderError(self.name, "unavailable", retryable=True, status_code=503)
+        return '{"days": []}'
+
+
+class TestGovernor:
+    """LLM admission control charges only requests that run, on every key they use"""
+    
+    def test_concurrency_rejection_is_not_charged(self):
+        """A request turned away for lack of a slot leaves the user's budget untouched"""
+        governor = server._governor_mod.LLMGovernor(max_concurrency=1, user_rpm=5, max_wait_seconds=0.05)
+        
+        async def body():
+            async with governor.slot("user-1", "sk-a", 100):
+                with pytest.raises(server.RateLimited) as exc:
+                    async with governor.slot("user-1", "sk-a", 100):
+                        pass
+                assert exc.value.scope == "concurrency"
+        
+        asyncio.run(body())
+        
+        requests_bucket = governor._user_buckets["user-1"][0]
+        assert requests_bucket.capacity - requests_bucket.tokens < 1.5
+        print(f"User requests left: {requests_bucket.tokens:.2f}")
+    
+    def test_fallback_key_is_governed(self, monkeypatch):
+        """A fallback attempt is charged to the fallback key and rejected when it is over its limit"""
+        primary, fallback = _FakeProvider("openai", fail=True), _FakeProvider("claude")
+        monkeypatch.setattr(server, "llm_router", server._llm_mod.LLMRouter(providers={"openai": primary, "claude": fallback}))
+        monkeypatch.setattr(server, "llm_governor", server._governor_mod.LLMGovernor(key_rpm=2))
+        ai_config = {
+            "user_id": "user-1", "provider": "openai", "api_key": "sk-primary",
+            "fallback_provider": "claude", "fallback_api_key": "sk-fallback",
+        }
+        
+        assert asyncio.run(server.call_llm(ai_config, "prompt")) == '{"days": []}'
+        fallback_requests = server.llm_governor._key_buckets[server._governor_mod._key_id("sk-fallback")][0]
+        assert fallback_requests.tokens < 2
+        
+        server.llm_governor.admit_key("sk-fallback", 1)
+        with pytest.raises(server.HTTPException) as exc:
+            asyncio.run(server.call_llm(ai_config, "prompt"))
+        assert exc.value.status_code == 429
+        assert fallback.calls == 1
+        print(f"Fallback calls: {fallback.calls}, then {exc.value.detail}")
+
+
+class TestShoppingChecks:
+    """Only the user's own checks carry over when a list is rebuilt"""
+    
+    def test_pantry_checks_do_not_stick(self):
+        """An item the pantry used to cover is unchecked once the pantry no longer covers it"""
+        totals = {
+            "rice_cup": {"name": "rice", "quantity": 2, "unit": "cup", "category": "Grains"},
+            "onion_unit": {"name": "onion", "quantity": 1, "unit": "unit", "category": "Produce"},
+        }
+        pantry = [{"name": "rice", "quantity": 5, "unit": "cup"}]
+        first = shopping.finalize_items(shopping.subtract_pantry(totals, pantry))
+        rice = next(item for item in first if item["name"] == "rice")
+        assert rice["checked"] and not rice["checked_by_user"]
+        
+        onion = next(item for item in first if item["name"] == "onion")
+        onion["checked"] = onion["checked_by_user"] = True
+        second = shopping.finalize_items(shopping.subtract_pantry(totals, []), first)
+        
+        by_name = {item["name"]: item for item in second}
+        assert not by_name["rice"]["checked"]
+        assert by_name["onion"]["checked"] and by_name["onion"]["checked_by_user"]
+        print(f"After pantry ran out: {[(item['name'], item['checked']) for item in second]}")
@@ -5,12 +5,13 @@ import { Button } from '@/components/ui/button';
 import { Input } from '@/components/ui/input';
 import { Label } from '@/components/ui/label';
 import { Dialog, DialogContent, DialogHeader, DialogTitle } from '@/components/ui/dialog';
-import { Crown, Plus, Users, Scroll, Copy, Trash2, Shield } from 'lucide-react';
+import { Crown, Plus, Users, Scroll, Copy, Trash2, Shield, Download, ChevronLeft, ChevronRight } from 'lucide-react';
 import { toast } from 'sonner';
 import { motion } from 'framer-motion';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+const PAGE_SIZE = 30;
 
 function AdminPanel({ user }) {
   const [promoCodes, setPromoCodes] = useState([]);
@@ -20,20 +21,38 @@ function AdminPanel({ user }) {
   const [creating, setCreating] = useState(false);
   const [deleteDialogOpen, setDeleteDialogOpen] = useState(false);
   const [codeToDelete, setCodeToDelete] = useState(null);
+  const [page, setPage] = useState(1);
+  const [total, setTotal] = useState(0);
+  const [summary, setSummary] = useState(null);
+  const [search, setSearch] = useState('');
+  const [statusFilter, setStatusFilter] = useState('');
+  const [bulkPrefix, setBulkPrefix] = useState('');
+  const [bulkCount, setBulkCount] = useState(100);
+  const [bulkMaxUses, setBulkMaxUses] = useState(1);
+  const [bulkValidUntil, setBulkValidUntil] = useState('');
+  const [generating, setGenerating] = useState(false);
 
   useEffect(() => {
     if (user?.role === 'admin') {
       fetchPromoCodes();
     }
-  }, [user]);
+  }, [user, page, statusFilter]);
 
   const fetchPromoCodes = async () => {
     const token = localStorage.getItem('token');
     try {
       const response = await axios.get(`${API}/admin/promo/list`, {
-        headers: { Authorization: `Bearer ${token}` }
+        headers: { Authorization: `Bearer ${token}` },
+        params: {
+          page,
+          page_size: PAGE_SIZE,
+          search: search || undefined,
+          status: statusFilter || undefined
+        }
       });
-      setPromoCodes(response.data);
+      setPromoCodes(response.data.items);
+      setTotal(response.data.total);
+      setSummary(response.data.summary);
     } catch (error) {
       toast.error('Failed to summon the royal decrees');
     } finally {
@@ -66,6 +85,51 @@ function AdminPanel({ user }) {
     }
   };
 
+  const applySearch = () => {
+    if (page === 1) {
+      fetchPromoCodes();
+    } else {
+      setPage(1);
+    }
+  };
+
+  const generateBulkCodes = async () => {
+    if (!bulkPrefix) {
+      toast.error('The decrees require a prefix, Your Majesty');
+      return;
+    }
+
+    setGenerating(true);
+    const token = localStorage.getItem('token');
+
+    try {
+      const response = await axios.post(`${API}/admin/promo/bulk`, {
+        prefix: bulkPrefix,
+        count: bulkCount,
+        max_uses: bulkMaxUses,
+        valid_until: bulkValidUntil ? new Date(bulkValidUntil).toISOString() : null
+      }, {
+        headers: { Authorization: `Bearer ${token}` },
+        responseType: 'blob'
+      });
+
+      const url = window.URL.createObjectURL(response.data);
+      const link = document.createElement('a');
+      link.href = url;
+      link.download = `promo-${bulkPrefix.toLowerCase()}.csv`;
+      link.click();
+      window.URL.revokeObjectURL(url);
+
+      toast.success(`${response.headers['x-codes-created'] || bulkCount} decrees inscribed and delivered!`);
+      setPage(1);
+      fetchPromoCodes();
+    } catch (error) {
+      toast.error('The scribes failed to inscribe the decrees');
+    } finally {
+      setGenerating(false);
+    }
+  };
+
   const revokePromoCode = async () => {
     if (!codeToDelete) return;
     
@@ -166,6 +230,73 @@ function AdminPanel({ user }) {
           </div>
         </motion.div>
 
+        {/* Bulk Generation */}
+        <motion.div
+          initial={{ opacity: 0, y: 20 }}
+          animate={{ opacity: 1, y: 0 }}
+          transition={{ delay: 0.15 }}
+          className="bg-zinc-950/50 backdrop-blur-xl border border-zinc-800/50 p-6 mb-6"
+        >
+          <h2 className="text-2xl font-cinzel font-semibold mb-2 flex items-center gap-2">
+            <Download className="w-6 h-6 text-violet-500" />
+            MASS PROCLAMATION
+          </h2>
+          <p className="text-zinc-500 text-sm mb-6 italic">Inscribe a campaign of unique decrees and receive them as a CSV scroll</p>
+
+          <div className="grid grid-cols-1 md:grid-cols-5 gap-4">
+            <div>
+              <Label className="text-zinc-300 mb-2 block">Prefix</Label>
+              <Input
+                value={bulkPrefix}
+                onChange={(e) => setBulkPrefix(e.target.value.toUpperCase())}
+                placeholder="LAUNCH"
+                className="bg-zinc-900 border-zinc-800 uppercase font-mono"
+                data-testid="bulk-prefix-input"
+              />
+            </div>
+            <div>
+              <Label className="text-zinc-300 mb-2 block">Number of Decrees</Label>
+              <Input
+                type="number"
+                value={bulkCount}
+                onChange={(e) => setBulkCount(parseInt(e.target.value) || 0)}
+                className="bg-zinc-900 border-zinc-800"
+                data-testid="bulk-count-input"
+              />
+            </div>
+            <div>
+              <Label className="text-zinc-300 mb-2 block">Blessings Each</Label>
+              <Input
+                type="number"
+                value={bulkMaxUses}
+                onChange={(e) => setBulkMaxUses(parseInt(e.target.value) || 0)}
+                className="bg-zinc-900 border-zinc-800"
+                data-testid="bulk-max-uses-input"
+              />
+            </div>
+            <div>
+              <Label className="text-zinc-300 mb-2 block">Expires</Label>
+              <Input
+                type="date"
+                value={bulkValidUntil}
+                onChange={(e) => setBulkValidUntil(e.target.value)}
+                className="bg-zinc-900 border-zinc-800"
+                data-testid="bulk-valid-until-input"
+              />
+            </div>
+            <div className="flex items-end">
+              <Button
+                onClick={generateBulkCodes}
+                disabled={generating || !bulkPrefix || bulkCount < 1}
+                className="w-full bg-violet-600 hover:bg-violet-700"
+                data-testid="bulk-generate-button"
+              >
+                {generating ? 'INSCRIBING...' : 'PROCLAIM'}
+              </Button>
+            </div>
+          </div>
+        </motion.div>
+
         {/* Existing Promo Codes */}
         <motion.div
           initial={{ opacity: 0, y: 20 }}
@@ -178,6 +309,37 @@ function AdminPanel({ user }) {
             ROYAL DECREES
           </h2>
           <p className="text-zinc-500 text-sm mb-6 italic">Active codes that grant premium access to your kingdom</p>
+
+          <div className="flex flex-col md:flex-row gap-3 mb-6">
+            <Input
+              value={search}
+              onChange={(e) => setSearch(e.target.value.toUpperCase())}
+              onKeyDown={(e) => e.key === 'Enter' && applySearch()}
+              placeholder="Search by code prefix"
+              className="bg-zinc-900 border-zinc-800 uppercase font-mono md:max-w-xs"
+              data-testid="promo-search-input"
+            />
+            <select
+              value={statusFilter}
+              onChange={(e) => { setStatusFilter(e.target.value); setPage(1); }}
+              className="bg-zinc-900 border border-zinc-800 text-zinc-300 px-3 py-2 text-sm"
+              data-testid="promo-status-filter"
+            >
+              <option value="">All decrees</option>
+              <option value="active">Blessed</option>
+              <option value="exhausted">Exhausted</option>
+              <option value="expired">Expired</option>
+              <option value="revoked">Revoked</option>
+            </select>
+            <Button onClick={applySearch} variant="outline" className="border-zinc-700 hover:border-violet-500">
+              Search
+            </Button>
+            {summary && (
+              <p className="text-sm text-zinc-500 md:ml-auto self-center">
+                {total} decrees · {summary.active} blessed · {summary.total_uses} subjects blessed
+              </p>
+            )}
+          </div>
           
           {loading ? (
             <p className="text-zinc-400 italic">Consulting the royal archives...</p>
@@ -194,7 +356,7 @@ function AdminPanel({ user }) {
                   key={promo.code}
                   initial={{ opacity: 0, scale: 0.95 }}
                   animate={{ opacity: 1, scale: 1 }}
-                  transition={{ delay: index * 0.05 }}
+                  transition={{ delay: Math.min(index, 10) * 0.05 }}
                   className="bg-zinc-900/50 border border-zinc-800 p-4 hover:border-violet-500/30 transition-colors"
                   data-testid={`promo-code-${promo.code}`}
                 >
@@ -204,9 +366,9 @@ function AdminPanel({ user }) {
                     </h3>
                     <div className="flex items-center gap-2">
                       <span className={`px-2 py-1 text-xs font-bold ${
-                        promo.active ? 'bg-green-500/20 text-green-400' : 'bg-red-500/20 text-red-400'
+                        promo.status === 'active' ? 'bg-green-500/20 text-green-400' : 'bg-red-500/20 text-red-400'
                       }`}>
-                        {promo.active ? 'BLESSED' : 'REVOKED'}
+                        {{ active: 'BLESSED', revoked: 'REVOKED', exhausted: 'EXHAUSTED', expired: 'EXPIRED' }[promo.status]}
                       </span>
                     </div>
                   </div>
@@ -248,10 +410,38 @@ function AdminPanel({ user }) {
               ))}
             </div>
           )}
+
+          {total > PAGE_SIZE && (
+            <div className="flex items-center justify-center gap-4 mt-6">
+              <Button
+                onClick={() => setPage(page - 1)}
+                disabled={page <= 1}
+                variant="outline"
+                size="sm"
+                className="border-zinc-700"
+                data-testid="promo-prev-page"
+              >
+                <ChevronLeft className="w-4 h-4" />
+              </Button>
+              <span className="text-sm text-zinc-400">
+                Page {page} of {Math.ceil(total / PAGE_SIZE)}
+              </span>
+              <Button
+                onClick={() => setPage(page + 1)}
+                disabled={page >= Math.ceil(total / PAGE_SIZE)}
+                variant="outline"
+                size="sm"
+                className="border-zinc-700"
+                data-testid="promo-next-page"
+              >
+                <ChevronRight className="w-4 h-4" />
+              </Button>
+            </div>
+          )}
         </motion.div>
 
         {/* Quick Share Section */}
-        {promoCodes.filter(p => p.active).length > 0 && (
+        {promoCodes.filter(p => p.status === 'active').length > 0 && (
           <motion.div
             initial={{ opacity: 0, y: 20 }}
             animate={{ opacity: 1, y: 0 }}
@@ -263,7 +453,7 @@ function AdminPanel({ user }) {
               Click to copy these decrees and share with those worthy of premium access
             </p>
             <div className="flex flex-wrap gap-3">
-              {promoCodes.filter(p => p.active).slice(0, 5).map((promo) => (
+              {promoCodes.filter(p => p.status === 'active').slice(0, 5).map((promo) => (
                 <button
                   key={promo.code}
                   onClick={() => copyCode(promo.code)}
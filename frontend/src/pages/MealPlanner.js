@@ -14,6 +14,23 @@ import { motion } from 'framer-motion';
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+const JOB_POLL_INTERVAL_MS = 2000;
+
+// AI generation runs as a background job: the API answers 202 with a job id
+// that we poll until it succeeds or fails.
+const waitForJob = async (response, token) => {
+  if (response.status !== 202) return response.data;
+  const { job_id } = response.data;
+  for (;;) {
+    await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    const job = await axios.get(`${API}/jobs/${job_id}`, {
+      headers: { Authorization: `Bearer ${token}` }
+    });
+    if (job.data.status === 'succeeded') return job.data.result;
+    if (job.data.status === 'failed') throw new Error(job.data.error || 'AI generation failed');
+  }
+};
+
 const DIETARY_OPTIONS = ['Meat Eating', 'Poultry Only', 'Fish Only', 'Vegetarian', 'Vegan'];
 const COOKING_METHODS = ['Air Fryer', 'Microwave', 'Stovetop', 'Toaster', 'Instant Pot'];
 const HEALTH_GOALS = [
@@ -82,7 +99,7 @@ function MealPlanner({ user }) {
     const token = localStorage.getItem('token');
     
     try {
-      await axios.post(`${API}/meal-plans`, {
+      const response = await axios.post(`${API}/meal-plans`, {
         plan_type: 'weekly',
         goal: goal || null,
         dietary_preferences: selectedDietary,
@@ -93,12 +110,13 @@ function MealPlanner({ user }) {
       }, {
         headers: { Authorization: `Bearer ${token}` }
       });
+      await waitForJob(response, token);
       
       toast.success(useAI ? 'Meal plan generated with AI!' : 'Weekly meal plan created! Click Edit to add meals.');
       setDialogOpen(false);
       fetchMealPlans();
     } catch (error) {
-      toast.error(error.response?.data?.detail || 'Failed to create meal plan');
+      toast.error(error.response?.data?.detail || error.message || 'Failed to create meal plan');
     } finally {
       setCreating(false);
     }
@@ -137,14 +155,18 @@ function MealPlanner({ user }) {
       }, {
         headers: { Authorization: `Bearer ${token}` }
       });
+      await waitForJob(response, token);
+      const planResponse = await axios.get(`${API}/meal-plans/${selectedPlan.id}`, {
+        headers: { Authorization: `Bearer ${token}` }
+      });
       
       toast.success('Plan regenerated with your restrictions!');
       setRegenerateDialogOpen(false);
       setExtraRestriction('');
-      setSelectedPlan(response.data);
+      setSelectedPlan(planResponse.data);
       fetchMealPlans();
     } catch (error) {
-      toast.error(error.response?.data?.detail || 'Failed to regenerate plan');
+      toast.error(error.response?.data?.detail || error.message || 'Failed to regenerate plan');
     } finally {
       setRegenerating(false);
     }